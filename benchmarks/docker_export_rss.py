@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+# tile-generator
+#
+# Copyright (c) 2015-Present Pivotal Software, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Reports peak RSS while exporting a large docker image to disk, comparing
+# the old approach (buffering image.data) with util.export_image.
+#
+# A fake docker client stands in for the daemon so the benchmark runs
+# anywhere. Each mode runs in its own process since peak RSS only grows.
+#
+#   python benchmarks/docker_export_rss.py --size-mb 1024
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from tile_generator import util
+
+CHUNK = b'\0' * (1024 * 1024)
+
+class FakeImage(object):
+	"""Looks like the raw urllib3 response returned by get_image()."""
+
+	def __init__(self, size_mb):
+		self.remaining = size_mb * len(CHUNK)
+
+	def read(self, amount):
+		amount = min(amount, self.remaining, len(CHUNK))
+		self.remaining -= amount
+		return CHUNK[:amount]
+
+	@property
+	def data(self):
+		return b''.join(iter(lambda: self.read(len(CHUNK)), b''))
+
+class FakeDockerClient(object):
+	def __init__(self, size_mb):
+		self.size_mb = size_mb
+
+	def get_image(self, image):
+		return FakeImage(self.size_mb)
+
+def peak_rss_mb():
+	rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	# Linux reports KB, macOS reports bytes
+	return rss / 1024.0 / (1024.0 if sys.platform == 'darwin' else 1.0)
+
+def run(mode, size_mb):
+	docker_cli = FakeDockerClient(size_mb)
+	baseline = peak_rss_mb()
+	with tempfile.NamedTemporaryFile(suffix='.tgz') as target:
+		start = time.time()
+		if mode == 'buffer':
+			with open(target.name, 'wb') as f:
+				f.write(docker_cli.get_image('image').data)
+		else:
+			util.export_image(docker_cli, 'image', target.name, compress=(mode == 'stream-gzip'))
+		elapsed = time.time() - start
+		size = os.path.getsize(target.name) / 1048576.0
+	print('{:12} {:8.1f} MB on disk {:8.1f} MB peak RSS ({:+.1f} MB) {:6.2f}s'.format(
+		mode, size, peak_rss_mb(), peak_rss_mb() - baseline, elapsed))
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--size-mb', type=int, default=512)
+	parser.add_argument('--mode', choices=['buffer', 'stream', 'stream-gzip'])
+	args = parser.parse_args()
+	if args.mode:
+		run(args.mode, args.size_mb)
+		return
+	for mode in ['buffer', 'stream', 'stream-gzip']:
+		subprocess.check_call([sys.executable, __file__, '--mode', mode, '--size-mb', str(args.size_mb)])
+
+if __name__ == '__main__':
+	main()
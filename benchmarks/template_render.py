@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+
+# tile-generator
+#
+# Copyright (c) 2015-Present Pivotal Software, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Reports the cost of loading every template in tile_generator/templates:
+#
+#   cold        a fresh environment compiling from source (every process, before)
+#   bytecode    a fresh environment loading from a warm bytecode cache (a new process now)
+#   memory      the same environment again (within one process)
+#
+# and of the inline `render` filter, compiling each snippet every time
+# versus once through the memo.
+#
+#   python benchmarks/template_render.py --repeat 20
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from jinja2 import Template
+from tile_generator import template
+
+def template_names():
+	names = []
+	for root, dirs, files in os.walk(template.TEMPLATE_PATH):
+		for name in sorted(files):
+			names.append(os.path.relpath(os.path.join(root, name), template.TEMPLATE_PATH))
+	return sorted(names)
+
+def load_all(environment, names):
+	start = time.time()
+	for name in names:
+		environment.get_template(name)
+	return time.time() - start
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--repeat', type=int, default=10)
+	parser.add_argument('--renders', type=int, default=2000)
+	args = parser.parse_args()
+
+	names = template_names()
+	cache_dir = tempfile.mkdtemp()
+	try:
+		cold = min(load_all(template.make_environment(), names) for i in range(args.repeat))
+		load_all(template.make_environment(template.bytecode_cache(cache_dir)), names)
+		bytecode = min(load_all(template.make_environment(template.bytecode_cache(cache_dir)), names) for i in range(args.repeat))
+		environment = template.make_environment()
+		load_all(environment, names)
+		memory = min(load_all(environment, names) for i in range(args.repeat))
+	finally:
+		shutil.rmtree(cache_dir)
+
+	print('{} templates'.format(len(names)))
+	for mode, seconds in [('cold', cold), ('bytecode', bytecode), ('memory', memory)]:
+		print('  {:10} {:8.2f} ms'.format(mode, seconds * 1000))
+
+	snippet = '{% for plan in plans %}{{ plan.name }}: {{ plan.description | default("none") }}\n{% endfor %}'
+	context = { 'plans': [{ 'name': 'plan' + str(i), 'description': 'Plan ' + str(i) } for i in range(5)] }
+	start = time.time()
+	for i in range(args.renders):
+		Template(snippet).render(context)
+	uncached = time.time() - start
+	template.compile_inline.cache_clear()
+	start = time.time()
+	for i in range(args.renders):
+		template.compile_inline(snippet).render(context)
+	memoized = time.time() - start
+	print('{} inline renders'.format(args.renders))
+	for mode, seconds in [('compile', uncached), ('memo', memoized)]:
+		print('  {:10} {:8.2f} ms'.format(mode, seconds * 1000))
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+
+# tile-generator
+#
+# Copyright (c) 2015-Present Pivotal Software, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Reports the time to parse and emit a synthetic Ops Manager
+# installation_settings document (20 MB by default) with the pure Python
+# SafeLoader/SafeDumper, as used before, and through yaml_util, which
+# uses the libyaml bindings when they are available.
+#
+#   python benchmarks/yaml_parse.py --size 20
+
+import argparse
+import os
+import random
+import sys
+import time
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+from tile_generator import yaml_util
+
+def product(rng, index):
+	return {
+		'identifier': 'product-' + str(index),
+		'guid': 'product-{}-{:020x}'.format(index, rng.getrandbits(80)),
+		'installation_name': 'product-{}-{:020x}'.format(index, rng.getrandbits(80)),
+		'product_version': '1.{}.{}'.format(index % 20, index % 7),
+		'jobs': [{
+			'identifier': 'job-' + str(j),
+			'guid': 'job-{:020x}'.format(rng.getrandbits(80)),
+			'instances': [{ 'identifier': 'instances', 'value': rng.randint(0, 5) }],
+			'properties': [{
+				'identifier': 'property_{}'.format(p),
+				'value': rng.choice([True, False, rng.randint(0, 65535), 'value-{:016x}'.format(rng.getrandbits(64)), None]),
+			} for p in range(20)],
+			'vm_credentials': { 'identity': 'vcap', 'password': '{:032x}'.format(rng.getrandbits(128)) },
+		} for j in range(10)],
+		'properties': [{
+			'identifier': 'certificate',
+			'value': { 'cert_pem': '-----BEGIN CERTIFICATE-----\n' + '{:064x}\n'.format(rng.getrandbits(256)) * 20 + '-----END CERTIFICATE-----\n' },
+		}],
+	}
+
+def installation_settings(size, seed=0):
+	rng = random.Random(seed)
+	first = product(rng, 0)
+	count = max(size // len(yaml_util.dump([first], default_flow_style=False)), 1)
+	products = [first] + [product(rng, i) for i in range(1, count)]
+	settings = { 'infrastructure': { 'director_configuration': { 'ntp_servers_string': '0.pool.ntp.org' } }, 'products': products }
+	return yaml_util.dump(settings, default_flow_style=False)
+
+def timed(function, *args, **kwargs):
+	start = time.time()
+	result = function(*args, **kwargs)
+	return time.time() - start, result
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--size', type=float, default=20, help='document size in MB')
+	args = parser.parse_args()
+
+	text = installation_settings(int(args.size * 1048576))
+	print('installation_settings ({:.1f} MB), libyaml {}'.format(len(text) / 1048576.0, 'available' if yaml_util.LIBYAML else 'unavailable'))
+	python_load, expected = timed(yaml.load, text, Loader=yaml.SafeLoader)
+	util_load, loaded = timed(yaml_util.load, text)
+	assert loaded == expected
+	python_dump, dumped = timed(yaml.dump, expected, Dumper=yaml.SafeDumper, default_flow_style=False)
+	util_dump, util_dumped = timed(yaml_util.dump, expected, default_flow_style=False)
+	assert util_dumped == dumped
+	for mode, load, dump in [('python', python_load, python_dump), ('yaml_util', util_load, util_dump)]:
+		print('  {:10} load {:7.2f}s  dump {:7.2f}s'.format(mode, load, dump))
+
+if __name__ == '__main__':
+	main()
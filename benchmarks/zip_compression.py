@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+# tile-generator
+#
+# Copyright (c) 2015-Present Pivotal Software, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Reports archive size and build time for the zip compression policy,
+# comparing storing every entry (the old behaviour) with deflating
+# compressible entries on one and on several threads.
+#
+# Two archives are measured:
+#
+#   sample    the entries of the sample tile's .pivotal: its release
+#             tarballs from sample/resources, tile.yml and the tile's
+#             rendered-size metadata (approximated by the repo's templates)
+#   app       a synthetic 200 file app: source, json and some binaries
+#
+#   python benchmarks/zip_compression.py --jobs 8
+
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import zipfile
+
+REPO_PATH = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..')
+sys.path.insert(0, REPO_PATH)
+from tile_generator import util
+
+def sample_entries():
+	sample = os.path.join(REPO_PATH, 'sample')
+	entries = []
+	for name in sorted(os.listdir(os.path.join(sample, 'resources'))):
+		if name.endswith('.tgz'):
+			entries.append((os.path.join(sample, 'resources', name), 'releases/' + name))
+	entries.append((os.path.join(sample, 'tile.yml'), 'tile-generator/tile.yml'))
+	templates = os.path.join(REPO_PATH, 'tile_generator', 'templates')
+	for root, dirs, files in os.walk(templates):
+		for name in sorted(files):
+			path = os.path.join(root, name)
+			entries.append((path, 'metadata/' + os.path.relpath(path, templates)))
+	return entries
+
+def synthetic_app(directory, files=200, seed=0):
+	rng = random.Random(seed)
+	words = ['function', 'return', 'const', 'value', 'request', 'response', 'config', 'module', 'export', 'require']
+	for i in range(files):
+		subdir = os.path.join(directory, 'lib' if i % 4 else 'static')
+		if not os.path.isdir(subdir):
+			os.makedirs(subdir)
+		if i % 10 == 0:
+			# Images and vendored archives are already compressed
+			with open(os.path.join(subdir, 'asset%d.png' % i), 'wb') as f:
+				f.write(os.urandom(rng.randint(16, 256) * 1024))
+		else:
+			ext = '.json' if i % 3 == 0 else '.js'
+			with open(os.path.join(subdir, 'file%d%s' % (i, ext)), 'w') as f:
+				for line in range(rng.randint(200, 2000)):
+					f.write(' '.join(rng.choice(words) for w in range(8)) + ';\n')
+	entries = []
+	for root, dirs, names in os.walk(directory):
+		for name in sorted(names):
+			path = os.path.join(root, name)
+			entries.append((path, os.path.relpath(path, directory)))
+	return entries
+
+def build(entries, target, level, jobs):
+	start = time.time()
+	with zipfile.ZipFile(target, 'w', allowZip64=True) as archive:
+		writer = util.ZipWriter(archive, level, jobs)
+		for path, arcname in entries:
+			writer.add_file(path, arcname)
+		writer.close()
+	return time.time() - start, os.path.getsize(target)
+
+def main():
+	parser = argparse.ArgumentParser()
+	parser.add_argument('--jobs', type=int, default=os.cpu_count() or 4)
+	parser.add_argument('--level', type=int, default=util.ZIP_COMPRESSION_LEVEL)
+	parser.add_argument('--repeat', type=int, default=3)
+	args = parser.parse_args()
+
+	tmpdir = tempfile.mkdtemp()
+	try:
+		archives = [
+			('sample', sample_entries()),
+			('app', synthetic_app(os.path.join(tmpdir, 'app'))),
+		]
+		modes = [
+			('stored', 0, 1),
+			('deflate x1', args.level, 1),
+			('deflate x' + str(args.jobs), args.level, args.jobs),
+		]
+		for name, entries in archives:
+			raw = sum(os.path.getsize(path) for path, arcname in entries)
+			print('{} ({} entries, {:.1f} MB)'.format(name, len(entries), raw / 1048576.0))
+			for mode, level, jobs in modes:
+				target = os.path.join(tmpdir, name + '.zip')
+				elapsed, size = min(build(entries, target, level, jobs) for i in range(args.repeat))
+				print('  {:12} {:8.2f} MB {:7.3f}s'.format(mode, size / 1048576.0, elapsed))
+	finally:
+		shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+	main()
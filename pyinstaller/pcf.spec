@@ -10,12 +10,17 @@ arch = '64bit' if sys.maxsize > 2**32 else '32bit'
 dirs = [os.path.abspath(d[0]) for d in os.walk(os.path.join('.', 'tile_generator', 'templates'))]
 files = [(os.path.join(d,'*'), os.path.relpath(d)) for d in dirs]
 
+# Subcommand modules are imported by name on first use (see
+# tile_generator/lazy.py), which analysis can't follow
+modules = ['tile_generator.' + f[:-3] for f in os.listdir(os.path.join('.', 'tile_generator'))
+           if f.endswith('.py') and not f.endswith('_unittest.py') and f != '__init__.py']
+
 a = Analysis(['pcf_entrypoint.py'],
              pathex=['.'],
              binaries=[],
              datas=files,
              # work-around for https://github.com/pypa/setuptools/issues/1963
-             hiddenimports=['pkg_resources.py2_warn'],
+             hiddenimports=['pkg_resources.py2_warn'] + modules,
              hookspath=[],
              runtime_hooks=[],
              excludes=[],
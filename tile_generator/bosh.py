@@ -17,6 +17,8 @@
 # limitations under the License.
 
 
+import concurrent.futures
+import hashlib
 import os
 import sys
 import errno
@@ -25,6 +27,8 @@ import shutil
 import subprocess
 import tarfile
 import tempfile
+import threading
+import time
 from distutils import spawn
 from . import template
 try:
@@ -34,11 +38,99 @@ except ImportError:
 	# Python 2
 	from urllib.request import urlretrieve
 import zipfile
-import yaml
+from . import yaml_util
 import re
 import datetime
 
 from .util import *
+from .cache import DownloadCache, materialize
+from .release_builder import build_release
+
+class BlobRegistrar:
+	"""Registers blobs in a release directory the way `bosh add-blob` does.
+
+	Blobs are queued with add() and registered together by commit(): every
+	file is hashed once, in parallel, hardlinked into the release's blobs/
+	directory (copied only when it can't be linked) and config/blobs.yml is
+	rewritten a single time, rather than once per blob.
+	"""
+
+	def __init__(self, release_dir, jobs=4):
+		self.release_dir = release_dir
+		self.jobs = max(jobs, 1)
+		self.pending = []
+
+	def add(self, path, blob_path, sha1=None):
+		self.pending.append((path, blob_path, sha1))
+
+	def index_path(self):
+		return os.path.join(self.release_dir, 'config', 'blobs.yml')
+
+	def read_index(self):
+		try:
+			with open(self.index_path()) as f:
+				return yaml_util.load(f) or {}
+		except IOError:
+			return {}
+
+	def register(self, path, blob_path, sha1=None):
+		target = os.path.join(self.release_dir, 'blobs', blob_path)
+		if not os.path.exists(target) or not os.path.samefile(path, target):
+			mkdir_p(os.path.dirname(target))
+			materialize(path, target)
+		if sha1 is None:
+			digest = hashlib.sha1()
+			with open(target, 'rb') as f:
+				for chunk in iter(lambda: f.read(DOWNLOAD_CHUNK_SIZE), b''):
+					digest.update(chunk)
+			sha1 = digest.hexdigest()
+		return { 'size': os.path.getsize(target), 'sha': sha1 }
+
+	def commit(self):
+		if not self.pending:
+			return {}
+		index = self.read_index()
+		with concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs) as executor:
+			futures = [(blob_path, submit_in_context(executor, self.register, path, blob_path, sha1)) for path, blob_path, sha1 in self.pending]
+			for blob_path, future in futures:
+				index[blob_path] = future.result()
+		mkdir_p(os.path.dirname(self.index_path()))
+		with open(self.index_path(), 'w') as f:
+			f.write(yaml_util.dump(index, default_flow_style=False, explicit_start=True))
+		self.pending = []
+		return index
+
+def zip_entry_name(name, prefix):
+	"""Name of a staged file inside a zip of the prefix directory, or None if it falls outside."""
+	if not prefix:
+		return name
+	if name == prefix:
+		return os.path.basename(name)
+	if name.startswith(prefix + '/'):
+		return name[len(prefix) + 1:]
+	return None
+
+# Outputs of a previous build of a generated release, relative to its directory
+STALE_RELEASE_OUTPUTS = ['.dev_builds', 'dev_releases', '.final_builds', 'releases', os.path.join('config', 'blobs.yml')]
+
+# Release manifests already read this process, keyed by manifest_key()
+_manifests = {}
+
+def manifest_key(tarball):
+	stat = os.stat(tarball)
+	return (os.path.realpath(tarball), stat.st_size, stat.st_mtime_ns)
+
+def read_manifest(tarball):
+	# Read the tarball as a stream and stop at release.MF, which bosh
+	# writes near the front, instead of indexing every member first.
+	with tarfile.open(tarball, 'r|*') as tar:
+		for member in tar:
+			if member.name in ['./release.MF', 'release.MF']:
+				manifest_file = tar.extractfile(member)
+				manifest = yaml_util.load(manifest_file)
+				manifest_file.close()
+				return manifest
+	raise Exception('No release manifest found in ' + tarball)
 
 class BoshRelease:
 
@@ -51,6 +143,9 @@ class BoshRelease:
 		self.context = context
 		self.config = release
 		self.tarball = None
+		self.blobs = BlobRegistrar(self.release_dir, (context or {}).get('download_jobs', 4))
+		# (path, changed) for every file rendered into the release directory
+		self.rendered = []
 
 	def get_metadata(self):
 		tarball = self.get_tarball()
@@ -63,16 +158,12 @@ class BoshRelease:
 		}
 
 	def get_manifest(self, tarball):
-		with tarfile.open(tarball) as tar:
-			if './release.MF' in tar.getnames():
-				manifest_file = tar.extractfile('./release.MF')
-			elif 'release.MF' in tar.getnames():
-				manifest_file = tar.extractfile('release.MF')
-			else:
-				raise Exception('No release manifest found in ' + tarball)
-			manifest = yaml.safe_load(manifest_file)
-			manifest_file.close()
-			return manifest
+		key = manifest_key(tarball)
+		manifest = _manifests.get(key)
+		if manifest is None:
+			manifest = read_manifest(tarball)
+			_manifests[key] = manifest
+		return manifest
 
 	def get_tarball(self):
 		if self.tarball is not None and os.path.isfile(self.tarball):
@@ -92,7 +183,8 @@ class BoshRelease:
 
 		mkdir_p(self.release_dir)
 		tarball = os.path.join(self.release_dir, self.name + '.tgz')
-		download(self.path, tarball, self.context.get('cache'))
+		download(self.path, tarball, self.cache(), self.config.get('sha256'), self.context.get('download_segments', 1),
+			offline=self.context.get('offline', False))
 		manifest = self.get_manifest(tarball)
 		if manifest['name'] == 'cf-cli':
 			# Enforce at least version 1.15 as prior versions have a CVE
@@ -101,13 +193,25 @@ class BoshRelease:
 				raise RuntimeError('The cf-cli bosh release should be version 1.15.0 or higher. Detected %s' % manifest['version'])
 		self.tarball = os.path.join(self.release_dir, manifest['name'] + '-' + manifest['version'] + '.tgz')
 		os.rename(tarball, self.tarball)
+		_manifests[manifest_key(self.tarball)] = manifest
 		return self.tarball
 
+	def native(self):
+		return self.context.get('native_release', False)
+
+	def epoch(self):
+		"""The time everything archived by a reproducible build is stamped with, else None."""
+		if not self.context.get('reproducible'):
+			return None
+		return source_date_epoch(self.context['version'])
+
 	def build_tarball(self):
 		mkdir_p(self.release_dir)
+		self.clean_release_dir()
 
-		self.__bosh('init-release')
-		template.render(
+		if not self.native() and not os.path.isdir(os.path.join(self.release_dir, 'config')):
+			self.__bosh('init-release')
+		self.render(
 			os.path.join(self.release_dir, 'config/final.yml'),
 			'config/final.yml',
 			self.context)
@@ -117,9 +221,17 @@ class BoshRelease:
 
 		for job in self.jobs:
 			self.add_job(job)
-		self.__bosh('upload-blobs')
+		self.prune_release_dir()
 		filename=self.name + '-' + self.context['version'] + '.tgz'
 
+		if self.native():
+			return self.build_native_tarball(filename)
+
+		if self.epoch() is not None:
+			print('warning: bosh create-release timestamps', filename + ',', 'so it is only reproducible with --native-release', file=sys.stderr)
+		self.blobs.commit()
+		self.__bosh('upload-blobs')
+
 		args = ['create-release', '--force','--final', '--tarball', filename, '--version', self.context['version']]
 		if self.context.get('sha1'):
 			args.insert(3, '--sha2')
@@ -128,6 +240,51 @@ class BoshRelease:
 		self.tarball = os.path.join(self.release_dir,filename)
 		return self.tarball
 
+	def build_native_tarball(self, filename):
+		print('build release', filename)
+		tarball = os.path.join(self.release_dir, filename)
+		manifest = build_release(self.release_dir, self.name, self.context['version'], tarball,
+			jobs=self.context.get('download_jobs', 4), sha2=bool(self.context.get('sha1')), epoch=self.epoch())
+		_manifests[manifest_key(tarball)] = manifest
+		self.tarball = tarball
+		return self.tarball
+
+	def clean_release_dir(self):
+		"""Remove what the last build of this release produced, keeping rendered files.
+
+		Specs, packaging scripts and job templates stay where they are, so
+		the ones that render to the same content keep their modification
+		times between builds.
+		"""
+		for name in STALE_RELEASE_OUTPUTS:
+			path = os.path.join(self.release_dir, name)
+			if os.path.isdir(path):
+				shutil.rmtree(path)
+			elif os.path.exists(path):
+				os.remove(path)
+		for name in os.listdir(self.release_dir):
+			if name.endswith('.tgz'):
+				os.remove(os.path.join(self.release_dir, name))
+
+	def prune_release_dir(self):
+		# Drop jobs and packages that are no longer part of the release
+		current = {
+			'jobs': [job.get('type', job['name']) for job in self.jobs],
+			'packages': [package['name'] for package in self.packages],
+			'blobs': [package['name'] for package in self.packages],
+		}
+		for dir, names in current.items():
+			path = os.path.join(self.release_dir, dir)
+			if os.path.isdir(path):
+				for name in os.listdir(path):
+					if name not in names and os.path.isdir(os.path.join(path, name)):
+						shutil.rmtree(os.path.join(path, name))
+
+	def render(self, target_path, template_file, context):
+		changed = template.render(target_path, template_file, context)
+		self.rendered.append((target_path, changed))
+		return changed
+
 	def add_job(self, job):
 		job_name = job['name']
 		job_type = job.get('type', job_name)
@@ -135,7 +292,8 @@ class BoshRelease:
 		is_errand = job.get('lifecycle', None) == 'errand'
 		package = job.get('package', None)
 		packages = job.get('packages', [])
-		self.__bosh('generate-job', job_type)
+		if not self.native() and not os.path.isdir(os.path.join(self.release_dir, 'jobs', job_type)):
+			self.__bosh('generate-job', job_type)
 		job_context = {
 			'job_name': job_name,
 			'job_type': job_type,
@@ -145,22 +303,22 @@ class BoshRelease:
 			'errand': is_errand,
 		}
 
-		template.render(
+		self.render(
 			os.path.join(self.release_dir, 'jobs', job_type, 'spec'),
 			os.path.join('jobs', 'spec'),
 			job_context
 		)
-		template.render(
+		self.render(
 			os.path.join(self.release_dir, 'jobs', job_type, 'templates', job_type + '.sh.erb'),
 			os.path.join('jobs', job_template + '.sh.erb'),
 			job_context
 		)
-		template.render(
+		self.render(
 			os.path.join(self.release_dir, 'jobs', job_type, 'templates', 'opsmgr.env.erb'),
 			os.path.join('jobs', 'opsmgr.env.erb'),
 			job_context
 		)
-		template.render(
+		self.render(
 			os.path.join(self.release_dir, 'jobs', job_type, 'monit'),
 			os.path.join('jobs', 'monit'),
 			job_context
@@ -181,29 +339,25 @@ class BoshRelease:
 
 	def add_blob(self,package):
 		for file in package ['files']:
-			self.__bosh('add-blob',os.path.realpath(file['path']),file['name'])
+			self.blobs.add(os.path.realpath(file['path']),file['name'])
 
 	def add_package(self, package):
 		name = package['name']
 		dir = package.get('dir', 'blobs')
-		self.__bosh('generate-package', name)
+		if not self.native() and not os.path.isdir(os.path.join(self.release_dir, 'packages', name)):
+			self.__bosh('generate-package', name)
 		target_dir = os.path.realpath(os.path.join(self.release_dir, dir, name))
 		package_dir = os.path.realpath(os.path.join(self.release_dir, 'packages', name))
 		mkdir_p(target_dir)
 		template_dir = 'packages'
 		# Download files for package
 		if self.needs_zip(package):
-			staging_dir = tempfile.mkdtemp()
 			file_options = dict()
 			for file in package.get('files', []):
-				for key in [k for k in file.keys() if k not in ['name', 'path']]:
+				for key in [k for k in file.keys() if k not in ['name', 'path', 'sha256']]:
 					file_options[key] = file[key]
-				download(file['path'], os.path.join(staging_dir, file['name']), cache=self.context.get('cache', None))
-			path = package.get('manifest', {}).get('path', '')
-			dir_to_zip = os.path.join(staging_dir, path) if path else staging_dir
 			zipfilename = os.path.realpath(os.path.join(target_dir, package['name'] + '.zip'))
-			zip_dir(zipfilename, dir_to_zip)
-			shutil.rmtree(staging_dir)
+			sha1 = self.zip_package(package, zipfilename)
 			newpath = os.path.basename(zipfilename)
 			for job in self.jobs:
 				if job.get('manifest', {}).get(package['name'], {}).get('app_manifest'):
@@ -211,61 +365,186 @@ class BoshRelease:
 			result = { 'path': zipfilename, 'name': os.path.basename(zipfilename) }
 			result.update(file_options)
 			package['files'] = [result]
-			self.__bosh('add-blob',zipfilename,os.path.join(name,os.path.basename(zipfilename)))
+			self.blobs.add(zipfilename,os.path.join(name,os.path.basename(zipfilename)), sha1)
 		else:
+			self.download_files(package, target_dir)
 			for file in package.get('files', []):
-				download(file['path'], os.path.join(target_dir, file['name']), cache=self.context.get('cache', None))
-				self.__bosh('add-blob',os.path.join(target_dir, file['name']),os.path.join(name,file['name']))
+				self.blobs.add(os.path.join(target_dir, file['name']),os.path.join(name,file['name']))
 		# Construct context for template rendering
 		package_context = {
 			'context': self.context,
 			'package': package,
 			'files': package.get('files', []),
 		}
-		template.render(
+		self.render(
 			os.path.join(package_dir, 'spec'),
 			os.path.join(template_dir, 'spec'),
 			package_context
 		)
-		template.render(
+		self.render(
 			os.path.join(package_dir, 'packaging'),
 			os.path.join(template_dir, 'packaging'),
 			package_context
 		)
 
+	def zip_package(self, package, zipfilename):
+		"""Write the package's files straight into a single zip and return its sha1.
+
+		Local files are read where they are, cached files from the cache
+		and plain http(s) downloads are streamed into their entries, so the
+		zip is the only copy written. The zip holds what staging the files
+		by name and zipping the manifest's path below that would have.
+		"""
+		prefix = package.get('manifest', {}).get('path', '').strip('/')
+		with open(zipfilename, 'wb') as f:
+			output = HashingFile(f)
+			with zipfile.ZipFile(output, 'w', allowZip64=True) as archive:
+				writer = ZipWriter(archive, self.context.get('compression_level'), epoch=self.epoch())
+				try:
+					for file in package.get('files', []):
+						self.zip_file(writer, file, prefix, os.path.dirname(zipfilename))
+				finally:
+					writer.close()
+		return output.hexdigest()
+
+	def zip_file(self, writer, file, prefix, scratch_dir):
+		url = file['path']
+		if url.startswith('github:'):
+			url = resolve_github_url(url, self.context.get('offline', False))
+		if not is_remote(url):
+			if os.path.isdir(url):
+				for root, dirs, files in os.walk(url):
+					dirs.sort()
+					for name in sorted(files):
+						path = os.path.join(root, name)
+						arcname = zip_entry_name(os.path.join(file['name'], os.path.relpath(path, url)), prefix)
+						if arcname is not None:
+							writer.add_file(path, arcname)
+				return
+			arcname = zip_entry_name(file['name'], prefix)
+			if arcname is not None:
+				writer.add_file(url, arcname)
+		else:
+			arcname = zip_entry_name(file['name'], prefix)
+			if arcname is None:
+				return
+			cache = self.cache()
+			digest = cached_digest(cache, url, file.get('sha256'), self.context.get('offline', False))
+			if digest is not None:
+				print('- using cached version of', file['name'])
+				os.utime(cache.object_path(digest), None)
+				writer.add_file(cache.object_path(digest), arcname)
+			elif cache is None and url.split(':', 1)[0] in ['http', 'https']:
+				size, chunks = stream_download(url)
+				writer.add_stream(chunks, arcname, size)
+			else:
+				# docker: sources, and downloads headed for the cache, land
+				# on disk first
+				fd, filename = tempfile.mkstemp(dir=scratch_dir, prefix='.download-')
+				os.close(fd)
+				try:
+					os.remove(filename)
+					download(url, filename, cache, file.get('sha256'), self.context.get('download_segments', 1),
+						self.context.get('compress_images', False))
+					writer.add_file(filename, arcname)
+					writer.flush()
+				finally:
+					if os.path.exists(filename):
+						os.remove(filename)
+		writer.flush()
+		if file.get('sha256') and arcname in writer.digests and writer.digests[arcname] != file['sha256']:
+			print('sha256 mismatch for', url, 'expected', file['sha256'], 'but got', writer.digests[arcname], file=sys.stderr)
+			sys.exit(1)
+
+	def download_files(self, package, target_dir):
+		downloads = [(file['path'], os.path.join(target_dir, file['name']), file.get('sha256')) for file in package.get('files', [])]
+		download_all(downloads, cache=self.cache(), jobs=self.context.get('download_jobs', 4),
+			segments=self.context.get('download_segments', 1),
+			compress_images=self.context.get('compress_images', False),
+			offline=self.context.get('offline', False))
+
+	def cache(self):
+		cache = self.context.get('cache', None)
+		if cache is None:
+			return None
+		return DownloadCache.open(cache, self.context.get('cache_max_size'))
+
 	def __bosh(self, *argv, **kw):
+		kw.setdefault('verbose', self.context.get('verbose', False))
 		return run_bosh(self.release_dir, *argv, **kw)
 
 
-def ensure_bosh():
-	bosh_exec = spawn.find_executable('bosh')
-	if not bosh_exec:
-		print("'bosh' command should be on the path. See https://bosh.io for installation instructions")
-		sys.exit(1)
-
-	if bosh_exec:
-		output = subprocess.check_output(["bosh", "--version"], stderr=subprocess.STDOUT, cwd=".")
-		if output.startswith(b"version 1."):
-			print("You are running an older version of bosh. Please upgrade to the latest version. See https://bosh.io/docs/cli-v2.html for installation instructions")
+def bosh_toolchain():
+	"""Resolve the bosh executable and its version, once per process."""
+	with bosh_toolchain.lock:
+		if bosh_toolchain.probe is not None:
+			return bosh_toolchain.probe
+		bosh_exec = spawn.find_executable('bosh')
+		if not bosh_exec:
+			print("'bosh' command should be on the path. See https://bosh.io for installation instructions")
 			sys.exit(1)
 
+		if bosh_exec:
+			output = subprocess.check_output([bosh_exec, "--version"], stderr=subprocess.STDOUT, cwd=".")
+			if output.startswith(b"version 1."):
+				print("You are running an older version of bosh. Please upgrade to the latest version. See https://bosh.io/docs/cli-v2.html for installation instructions")
+				sys.exit(1)
+			bosh_toolchain.probe = {
+				'path': bosh_exec,
+				'version': output.split(b'\n')[0].decode('utf-8', 'replace').strip(),
+			}
+		return bosh_toolchain.probe
+
+bosh_toolchain.probe = None
+bosh_toolchain.lock = threading.Lock()
+
+def ensure_bosh():
+	return bosh_toolchain()
+
+def in_git_repo(path):
+	path = os.path.realpath(path)
+	while True:
+		if os.path.exists(os.path.join(path, '.git')):
+			return True
+		parent = os.path.dirname(path)
+		if parent == path:
+			return False
+		path = parent
+
+# Wall clock seconds spent in each bosh subcommand
+bosh_timings = {}
+
+def timing_report():
+	lines = []
+	for command, (count, seconds) in sorted(bosh_timings.items(), key=lambda t: -t[1][1]):
+		lines.append('{:>8.2f}s {:4}x bosh {}'.format(seconds, count, command))
+	return '\n'.join(lines)
+
+def record_timing(command, seconds, verbose=False):
+	with bosh_toolchain.lock:
+		count, total = bosh_timings.get(command, (0, 0.0))
+		bosh_timings[command] = (count + 1, total + seconds)
+	if verbose:
+		print('- bosh {} took {:.2f}s'.format(command, seconds))
+
 def run_bosh(working_dir, *argv, **kw):
-	ensure_bosh()
+	toolchain = ensure_bosh()
 
 	# Ensure that the working_dir is a git repo, needed for bosh's create-release.
 	# This is used to avoid this bug https://www.pivotaltracker.com/story/show/159156765
-	if 'create-release' in argv:
+	if 'create-release' in argv and not in_git_repo(working_dir):
 		print(working_dir)
-		cmd = 'if ! git rev-parse --git-dir 2> /dev/null; then git init; fi'
-		subprocess.call(cmd, shell=True, cwd=working_dir)
+		subprocess.call(['git', 'init'], cwd=working_dir)
 
 	# Change the commands
 	argv = list(argv)
 	print('bosh', ' '.join(argv))
-	command = ['bosh', '--no-color', '--non-interactive'] + argv
+	command = [toolchain['path'], '--no-color', '--non-interactive'] + argv
 	capture = kw.get('capture', None)
+	start = time.time()
 	try:
 		output = subprocess.check_output(command, stderr=subprocess.STDOUT, cwd=working_dir)
+		record_timing(argv[0], time.time() - start, kw.get('verbose', False))
 		if capture is not None:
 			for l in output.split(b'\n'):
 				if l.startswith(bytes(capture, 'utf-8')):
@@ -14,10 +14,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hashlib
+import os
+import requests
+import shutil
 import sys
 import tarfile
 import tempfile
+import threading
+import time
 import yaml
+import zipfile
 from contextlib import contextmanager
 from io import StringIO, BytesIO
 
@@ -37,6 +44,12 @@ def capture_output():
 
 
 class TestBoshCheck(unittest.TestCase):
+	def setUp(self):
+		bosh.bosh_toolchain.probe = None
+
+	def tearDown(self):
+		bosh.bosh_toolchain.probe = None
+
 	@mock.patch('distutils.spawn.find_executable')
 	@mock.patch('subprocess.check_output')
 	@mock.patch('sys.exit')
@@ -59,6 +72,62 @@ class TestBoshCheck(unittest.TestCase):
 
 		mock_sys_exit.assert_called()
 
+	@mock.patch('distutils.spawn.find_executable')
+	@mock.patch('subprocess.check_output')
+	def test_probes_once_per_process(self, mock_output, mock_find_executable):
+		mock_find_executable.return_value = '/usr/local/bin/bosh'
+		mock_output.return_value = b'version 7.0.1-abcdef\n\nSucceeded\n'
+
+		bosh.ensure_bosh()
+		toolchain = bosh.ensure_bosh()
+
+		self.assertEqual(mock_find_executable.call_count, 1)
+		self.assertEqual(mock_output.call_count, 1)
+		self.assertEqual(toolchain, { 'path': '/usr/local/bin/bosh', 'version': 'version 7.0.1-abcdef' })
+
+@mock.patch('tile_generator.bosh.ensure_bosh', return_value={ 'path': '/usr/local/bin/bosh', 'version': 'version 7' })
+@mock.patch('subprocess.call')
+@mock.patch('subprocess.check_output', return_value=b'')
+class TestRunBosh(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		bosh.bosh_timings.clear()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+		bosh.bosh_timings.clear()
+
+	def test_uses_resolved_executable(self, mock_output, mock_call, mock_ensure):
+		with capture_output():
+			bosh.run_bosh(self.tmpdir, 'generate-package', 'foo')
+		self.assertEqual(mock_output.call_args[0][0][0], '/usr/local/bin/bosh')
+
+	def test_git_init_only_outside_git_repo(self, mock_output, mock_call, mock_ensure):
+		with capture_output():
+			bosh.run_bosh(self.tmpdir, 'create-release')
+		mock_call.assert_called_once_with(['git', 'init'], cwd=self.tmpdir)
+		os.mkdir(os.path.join(self.tmpdir, '.git'))
+		release_dir = os.path.join(self.tmpdir, 'release')
+		os.mkdir(release_dir)
+		with capture_output():
+			bosh.run_bosh(release_dir, 'create-release')
+		self.assertEqual(mock_call.call_count, 1)
+
+	def test_records_timings(self, mock_output, mock_call, mock_ensure):
+		with capture_output() as (out, err):
+			bosh.run_bosh(self.tmpdir, 'add-blob', 'a', 'b')
+			bosh.run_bosh(self.tmpdir, 'add-blob', 'c', 'd', verbose=True)
+		self.assertEqual(bosh.bosh_timings['add-blob'][0], 2)
+		self.assertIn('- bosh add-blob took', out.getvalue())
+		self.assertIn('2x bosh add-blob', bosh.timing_report())
+
+def write_release(path, members, compression=''):
+	with tarfile.open(path, mode='w' + (':' + compression if compression else '')) as tar:
+		for name, content in members:
+			info = tarfile.TarInfo(name)
+			info.size = len(content)
+			tar.addfile(tarinfo=info, fileobj=BytesIO(content))
+
 class TestManifest(unittest.TestCase):
 	def test_get_manifest_finds_bare_release_mf(self):
 		with tempfile.NamedTemporaryFile() as tf:
@@ -94,5 +163,211 @@ class TestManifest(unittest.TestCase):
 			with self.assertRaises(Exception):
 				actual = br.get_manifest(tf.name)
 
+@mock.patch('tile_generator.bosh.template.render')
+@mock.patch('tile_generator.bosh.run_bosh')
+class TestAddPackage(unittest.TestCase):
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.tmpdir = tempfile.mkdtemp()
+		os.chdir(self.tmpdir)
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.tmpdir)
+
+	def test_downloads_files_concurrently(self, mock_run_bosh, mock_render):
+		lock = threading.Lock()
+		active = []
+		peak = []
+		def slow_download(url, filename, cache=None, sha256=None, **options):
+			with lock:
+				active.append(url)
+				peak.append(len(active))
+			time.sleep(0.05)
+			with lock:
+				active.remove(url)
+		package = {
+			'name': 'images',
+			'files': [{ 'name': 'image' + str(i), 'path': 'docker:image' + str(i) } for i in range(4)],
+		}
+		br = bosh.BoshRelease({'name': 'my-release', 'packages': [package]}, {'download_jobs': 4})
+		with mock.patch('tile_generator.util.download', side_effect=slow_download) as mock_download:
+			with capture_output():
+				br.add_package(package)
+		self.assertEqual(mock_download.call_count, 4)
+		self.assertGreater(max(peak), 1)
+		add_blobs = [blob_path for path, blob_path, sha1 in br.blobs.pending]
+		self.assertEqual(add_blobs, ['images/image0', 'images/image1', 'images/image2', 'images/image3'])
+		self.assertNotIn('add-blob', [c[0][1] for c in mock_run_bosh.call_args_list])
+
+	def write(self, path, content):
+		if not os.path.isdir(os.path.dirname(os.path.join(self.tmpdir, path))):
+			os.makedirs(os.path.dirname(os.path.join(self.tmpdir, path)))
+		with open(os.path.join(self.tmpdir, path), 'w') as f:
+			f.write(content)
+		return os.path.join(self.tmpdir, path)
+
+	def add_app(self, files, context={}, **package):
+		package.update({ 'name': 'app', 'is_cf': True, 'files': files })
+		br = bosh.BoshRelease({'name': 'my-release', 'packages': [package]}, context)
+		with capture_output():
+			br.add_package(package)
+		zipfilename = os.path.join(self.tmpdir, 'release', 'my-release', 'blobs', 'app', 'app.zip')
+		return br, zipfile.ZipFile(zipfilename), zipfilename
+
+	def test_zips_local_files_in_place(self, mock_run_bosh, mock_render):
+		self.write('src/app/index.js', 'index')
+		self.write('src/app/lib/util.js', 'util')
+		self.write('src/extra.txt', 'extra')
+		br, archive, zipfilename = self.add_app([
+			{ 'name': 'app', 'path': os.path.join(self.tmpdir, 'src', 'app') },
+			{ 'name': 'extra.txt', 'path': os.path.join(self.tmpdir, 'src', 'extra.txt') },
+		])
+		self.assertIsNone(archive.testzip())
+		self.assertEqual(sorted(archive.namelist()), ['app/index.js', 'app/lib/util.js', 'extra.txt'])
+		self.assertEqual(os.listdir(os.path.dirname(zipfilename)), ['app.zip'])
+		path, blob_path, sha1 = br.blobs.pending[0]
+		with open(zipfilename, 'rb') as f:
+			self.assertEqual(sha1, hashlib.sha1(f.read()).hexdigest())
+
+	def test_manifest_path_selects_a_subdirectory(self, mock_run_bosh, mock_render):
+		self.write('src/app/dist/index.js', 'index')
+		self.write('src/app/test/test.js', 'test')
+		br, archive, zipfilename = self.add_app(
+			[{ 'name': 'app', 'path': os.path.join(self.tmpdir, 'src', 'app') }],
+			manifest={ 'path': 'app/dist' })
+		self.assertEqual(archive.namelist(), ['index.js'])
+
+	@mock.patch('tile_generator.util.http_session')
+	def test_streams_remote_files(self, mock_session, mock_run_bosh, mock_render):
+		response = mock.Mock()
+		response.headers = { 'Content-Length': '7' }
+		response.iter_content.return_value = [b'con', b'tent']
+		mock_session.return_value.get.return_value = response
+		br, archive, zipfilename = self.add_app([
+			{ 'name': 'app.js', 'path': 'https://example.com/app.js', 'sha256': hashlib.sha256(b'content').hexdigest() },
+			{ 'name': 'other.js', 'path': 'https://example.com/other.js' },
+		])
+		self.assertEqual(archive.read('app.js'), b'content')
+		self.assertIsNone(archive.testzip())
+
+	@mock.patch('tile_generator.util.time.sleep')
+	@mock.patch('tile_generator.util.http_session')
+	def test_streamed_files_resume_after_dropped_connection(self, mock_session, mock_sleep, mock_run_bosh, mock_render):
+		def dropped(chunk_size=1):
+			yield b'con'
+			raise requests.exceptions.ConnectionError('connection reset')
+		first = mock.Mock(status_code=200, headers={ 'Content-Length': '7', 'ETag': '"1"' })
+		first.iter_content.side_effect = dropped
+		rest = mock.Mock(status_code=206, headers={ 'ETag': '"1"' })
+		rest.iter_content.return_value = [b'tent']
+		mock_session.return_value.get.side_effect = [first, rest]
+		br, archive, zipfilename = self.add_app([
+			{ 'name': 'app.js', 'path': 'https://example.com/app.js', 'sha256': hashlib.sha256(b'content').hexdigest() },
+			{ 'name': 'other.js', 'path': self.write('other.js', 'other') },
+		])
+		self.assertEqual(archive.read('app.js'), b'content')
+		self.assertEqual(mock_session.return_value.get.call_args_list[1][1]['headers'], { 'Range': 'bytes=3-', 'If-Range': '"1"' })
+
+	@mock.patch('tile_generator.util.http_session')
+	def test_streamed_digest_mismatch_fails(self, mock_session, mock_run_bosh, mock_render):
+		response = mock.Mock()
+		response.headers = {}
+		response.iter_content.return_value = [b'content']
+		mock_session.return_value.get.return_value = response
+		with self.assertRaises(SystemExit):
+			self.add_app([{ 'name': 'app.js', 'path': 'https://example.com/app.js', 'sha256': '0' * 64 }, { 'name': 'b', 'path': 'https://example.com/b' }])
+
+class TestBlobRegistrar(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.registrar = bosh.BlobRegistrar(self.tmpdir)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def write(self, path, content):
+		path = os.path.join(self.tmpdir, path)
+		bosh.mkdir_p(os.path.dirname(path))
+		with open(path, 'wb') as f:
+			f.write(content)
+		return path
+
+	def test_writes_blobs_yml_once(self):
+		source = self.write('downloads/app.zip', b'app')
+		in_place = self.write('blobs/images/busybox', b'image')
+		self.registrar.add(source, 'app/app.zip')
+		self.registrar.add(in_place, 'images/busybox')
+		with mock.patch('tile_generator.bosh.open', side_effect=open, create=True) as mock_open:
+			self.registrar.commit()
+		writes = [c for c in mock_open.call_args_list if len(c[0]) > 1 and c[0][1] == 'w']
+		self.assertEqual(len(writes), 1)
+		with open(os.path.join(self.tmpdir, 'config', 'blobs.yml')) as f:
+			index = yaml.safe_load(f)
+		self.assertEqual(index, {
+			'app/app.zip': { 'size': 3, 'sha': hashlib.sha1(b'app').hexdigest() },
+			'images/busybox': { 'size': 5, 'sha': hashlib.sha1(b'image').hexdigest() },
+		})
+
+	def test_hardlinks_into_blobs_dir(self):
+		source = self.write('downloads/app.zip', b'app')
+		self.registrar.add(source, 'app/app.zip')
+		self.registrar.commit()
+		target = os.path.join(self.tmpdir, 'blobs', 'app', 'app.zip')
+		self.assertEqual(os.stat(source).st_ino, os.stat(target).st_ino)
+
+	def test_merges_with_existing_blobs(self):
+		self.write('config/blobs.yml', b'other/file:\n  size: 1\n  sha: abc\n  object_id: xyz\n')
+		self.registrar.add(self.write('downloads/app.zip', b'app'), 'app/app.zip')
+		index = self.registrar.commit()
+		self.assertEqual(index['other/file']['object_id'], 'xyz')
+		self.assertIn('app/app.zip', index)
+
+class TestManifestMemo(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.tarball = os.path.join(self.tmpdir, 'release.tgz')
+		manifest = yaml.safe_dump({ 'name': 'my-release', 'version': '1.0.0' }, encoding='utf-8')
+		write_release(self.tarball, [('./release.MF', manifest), ('./packages/big.tgz', b'x' * 1024)], 'gz')
+		self.br = bosh.BoshRelease({'name': 'my-release'}, None)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def test_stops_at_release_mf(self):
+		with mock.patch('tarfile.TarFile.getnames') as mock_getnames:
+			manifest = bosh.read_manifest(self.tarball)
+		self.assertEqual(manifest['name'], 'my-release')
+		mock_getnames.assert_not_called()
+
+	def test_tarball_is_read_once(self):
+		with mock.patch('tile_generator.bosh.read_manifest', wraps=bosh.read_manifest) as mock_read:
+			self.br.get_manifest(self.tarball)
+			self.br.get_manifest(self.tarball)
+		self.assertEqual(mock_read.call_count, 1)
+
+	def test_downloaded_release_is_read_once(self):
+		cwd = os.getcwd()
+		os.chdir(self.tmpdir)
+		try:
+			br = bosh.BoshRelease({'name': 'my-release', 'path': 'https://example.com/release.tgz'}, {})
+			def fake_download(url, filename, *args, **kwargs):
+				shutil.copy(self.tarball, filename)
+			with mock.patch('tile_generator.bosh.download', side_effect=fake_download), \
+					mock.patch('tile_generator.bosh.read_manifest', wraps=bosh.read_manifest) as mock_read:
+				with capture_output():
+					metadata = br.get_metadata()
+			self.assertEqual(metadata['file'], 'my-release-1.0.0.tgz')
+			self.assertEqual(mock_read.call_count, 1)
+		finally:
+			os.chdir(cwd)
+
+	def test_changed_tarball_is_read_again(self):
+		self.br.get_manifest(self.tarball)
+		manifest = yaml.safe_dump({ 'name': 'my-release', 'version': '2.0.0' }, encoding='utf-8')
+		write_release(self.tarball, [('release.MF', manifest)], 'gz')
+		os.utime(self.tarball, ns=(0, 0))
+		self.assertEqual(self.br.get_manifest(self.tarball)['version'], '2.0.0')
+
 if __name__ == '__main__':
 	unittest.main()
@@ -17,6 +17,11 @@
 # limitations under the License.
 
 
+import concurrent.futures
+import contextvars
+import hashlib
+import io
+import json
 import os
 import sys
 import errno
@@ -32,70 +37,349 @@ except ImportError:
     # Python 2
     from urllib.request import urlretrieve
 import zipfile
-import yaml
 import datetime
 
 from .tile_metadata import TileMetadata
 from .bosh import *
 from .util import *
+from .build_state import BuildState, content_digest, file_digest, fingerprint
+from .version_cache import OfflineError
 from .version import version_string
 
 LIB_PATH = os.path.dirname(os.path.realpath(__file__))
 REPO_PATH = os.path.realpath(os.path.join(LIB_PATH, '..'))
 DOCKER_BOSHRELEASE_VERSION = '23'
+BUILD_STATE_FILE = os.path.join('release', '.build-state.json')
+
+# Configuration that has no effect on what a build produces
+VOLATILE_KEYS = ['verbose', 'cache', 'docker_cache', 'cache_max_size', 'build_jobs', 'download_jobs',
+    'download_segments', 'force', 'explain', 'history', 'tile_metadata', 'offline', 'version_lock']
+
+# Configuration read by the templates of generated bosh releases
+RELEASE_CONTEXT_KEYS = ['name', 'sha1', 'compress_images', 'native_release', 'reproducible', 'all_properties',
+    'packages', 'releases', 'service_plan_forms', 'purge_service_brokers']
+
+RELEASE_METADATA_KEYS = ['release_name', 'version', 'tarball', 'file']
 
 def build(config):
-    build_bosh_releases(config)
-    build_tile(config)
-
-def build_bosh_releases(config):
-    mkdir_p('release', clobber=True)
-    for release in config.get('releases', {}).values():
-        release_name = release['name']
-        bosh_release = BoshRelease(release, config)
-        tarball = bosh_release.get_tarball()
-        metadata = bosh_release.get_metadata()
-        release.update(metadata)
+    state = BuildState(BUILD_STATE_FILE, config.get('force', False), config.get('explain', False))
+    build_bosh_releases(config, state)
+    build_tile(config, state)
+
+def release_inputs(release, config, templates):
+    inputs = { 'release': release, 'tool': version_string }
+    if release.get('path') is None:
+        # Generated releases are versioned with the tile, so a new tile
+        # version rebuilds every one of them
+        inputs['version'] = config.get('version')
+        inputs['context'] = dict((key, config.get(key)) for key in RELEASE_CONTEXT_KEYS)
+        inputs['templates'] = templates
+        if config.get('reproducible'):
+            inputs['source_date_epoch'] = os.environ.get('SOURCE_DATE_EPOCH')
+        inputs['files'] = dict(
+            (file['path'], file_digest(file['path']))
+            for package in release.get('packages', [])
+            for file in package.get('files', []) if not is_remote(file['path']))
+        remote = [(file['path'], file.get('sha256'))
+            for package in release.get('packages', [])
+            for file in package.get('files', []) if is_remote(file['path'])]
+    elif is_remote(release['path']):
+        remote = [(release['path'], release.get('sha256'))]
+    else:
+        remote = []
+    inputs['remote'] = dict((url, remote_identity(url, sha256, config.get('offline', False))) for url, sha256 in remote)
+    return inputs
+
+def remote_identity(url, sha256=None, offline=False):
+    """Return what a remote input currently resolves to, or None if that can't be known.
+
+    A url alone doesn't identify what it serves (e.g. bosh.io's latest
+    release links, github: urls and docker tags), so releases built from
+    remote inputs are only reused while those still resolve to the same
+    content: a pinned sha256, the github release asset, or the final url
+    and validator of an http(s) HEAD request. Docker images are only
+    known when referenced by digest.
+    """
+    if sha256:
+        return 'sha256:' + sha256
+    if url.startswith('docker:'):
+        return url if '@sha256:' in url else None
+    try:
+        if url.startswith('github:'):
+            url = resolve_github_url(url, offline)
+        if offline:
+            return None
+        final_url, validator = head_validator(url)
+    except (OfflineError, requests.exceptions.RequestException):
+        return None
+    if not validator:
+        return None
+    return final_url + ' ' + validator
+
+def unpinned(release_input):
+    return sorted(url for url, identity in release_input['remote'].items() if identity is None)
+
+def release_outputs(release):
+    return {
+        'metadata': dict((key, release[key]) for key in RELEASE_METADATA_KEYS),
+        # Building a release rewrites some package files and job manifests
+        # (e.g. zipped apps) that the tile metadata is rendered from
+        'packages': dict((p['name'], p.get('files', [])) for p in release.get('packages', [])),
+        'jobs': dict((j['name'], j['manifest']) for j in release.get('jobs', []) if 'manifest' in j),
+    }
+
+def restore_release(release, outputs):
+    for package in release.get('packages', []):
+        if package['name'] in outputs['packages']:
+            package['files'] = outputs['packages'][package['name']]
+    for job in release.get('jobs', []):
+        if job['name'] in outputs['jobs']:
+            job['manifest'] = outputs['jobs'][job['name']]
+    release.update(outputs['metadata'])
+
+def prune_releases(releases):
+    mkdir_p('release')
+    names = set(release['name'] for release in releases)
+    for name in os.listdir('release'):
+        path = os.path.join('release', name)
+        if name not in names and os.path.isdir(path):
+            shutil.rmtree(path)
+
+def build_bosh_releases(config, state=None):
+    releases = list(config.get('releases', {}).values())
+    if state is None:
+        mkdir_p('release', clobber=True)
+        pending = releases
+    else:
+        prune_releases(releases)
+        templates = content_digest(template.TEMPLATE_PATH)
+        # Fingerprint every release before any of them is built, since
+        # building one updates the configuration the others see
+        raw_inputs = [release_inputs(release, config, templates) for release in releases]
+        inputs = dict((release['name'], fingerprint(raw_input)) for release, raw_input in zip(releases, raw_inputs))
+        pending = []
+        for release, raw_input in zip(releases, raw_inputs):
+            outputs = state.reuse('release ' + release['name'], inputs[release['name']], unpinned(raw_input))
+            if outputs is not None:
+                print('reusing release', outputs['metadata']['file'])
+                restore_release(release, outputs)
+            else:
+                # Generated releases keep their rendered files between builds
+                mkdir_p(os.path.join('release', release['name']), clobber=release.get('path') is not None)
+                pending.append(release)
+
+    def built(release):
+        # Saved as each release completes, so a later failure doesn't lose it
+        if state is not None:
+            state.record('release ' + release['name'], inputs[release['name']], release_outputs(release), [release['tarball']])
+            state.save()
+
+    jobs = config.get('build_jobs', 1)
+    if jobs > 1 and len(pending) > 1:
+        build_bosh_releases_parallel(config, pending, jobs, built)
+    else:
+        for release in pending:
+            release.update(build_bosh_release(release, config))
+            built(release)
+    if config.get('verbose') and bosh_timings:
+        print('time spent in bosh:')
+        print(timing_report())
     print()
 
+def build_bosh_release(release, config):
+    bosh_release = BoshRelease(release, config)
+    bosh_release.get_tarball()
+    if bosh_release.rendered:
+        changed = [path for path, changed in bosh_release.rendered if changed]
+        print(len(changed), 'of', len(bosh_release.rendered), 'generated files changed')
+        if config.get('verbose'):
+            for path in changed:
+                print('-', path)
+    return bosh_release.get_metadata()
+
+class ThreadOutput(object):
+    """A stream that diverts writes from worker threads into a per-release buffer.
+
+    The buffer is held in a context variable, so it follows the work a
+    release hands to its own thread pools through util.submit_in_context.
+    Anything that has not set a buffer writes straight through to the
+    wrapped stream.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.target = contextvars.ContextVar('target', default=None)
+
+    def write(self, data):
+        buffer = self.target.get()
+        if buffer is None:
+            return self.stream.write(data)
+        return buffer.write(data)
+
+    def flush(self):
+        if self.target.get() is None:
+            self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+def build_bosh_releases_parallel(config, releases, jobs, built=None):
+    # Releases are built concurrently, but each one's output is buffered and
+    # replayed in configuration order, prefixed with the release name, so the
+    # build log reads the same no matter which release finishes first.
+    # built is called with each release as soon as it completes.
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = ThreadOutput(stdout), ThreadOutput(stderr)
+    buffers = [(io.StringIO(), io.StringIO()) for release in releases]
+
+    def emit(index):
+        prefix = '[' + releases[index]['name'] + '] '
+        for buffer, stream in zip(buffers[index], (stdout, stderr)):
+            for line in buffer.getvalue().splitlines():
+                stream.write(prefix + line + '\n')
+            stream.flush()
+
+    def worker(index):
+        # Runs in a context of its own, so the buffers are dropped with it
+        sys.stdout.target.set(buffers[index][0])
+        sys.stderr.target.set(buffers[index][1])
+        return build_bosh_release(releases[index], config)
+
+    finished = set()
+
+    def finish(index):
+        finished.add(index)
+        releases[index].update(futures[index].result())
+        if built is not None:
+            built(releases[index])
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=jobs)
+    futures = []
+    emitted = 0
+    try:
+        futures = [executor.submit(contextvars.Context().run, worker, index) for index in range(len(releases))]
+        pending = set(futures)
+        while emitted < len(futures):
+            done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    raise future.exception()
+                finish(futures.index(future))
+            while emitted < len(futures) and futures[emitted].done():
+                emit(emitted)
+                emitted += 1
+    finally:
+        # After a failure, releases that have not started are skipped. Those
+        # already building can't be interrupted, so they are waited for with
+        # their output still buffered, and then everything that ran is
+        # replayed in order before the failure is raised.
+        executor.shutdown(wait=True, cancel_futures=True)
+        sys.stdout, sys.stderr = stdout, stderr
+        for index, future in enumerate(futures):
+            if index not in finished and not future.cancelled() and future.exception() is None:
+                finish(index)
+        for index in range(emitted, len(futures)):
+            if not futures[index].cancelled():
+                emit(index)
+
 def build_tile_metadata(context):
     tile_metadata = TileMetadata(context)
     return tile_metadata.build()
 
-def build_tile(context):
+def tile_inputs(context):
+    return {
+        'config': dict((key, value) for key, value in context.items() if key not in VOLATILE_KEYS),
+        'releases': dict((r['file'], file_digest(r['tarball'])) for r in context.get('releases', {}).values()),
+        'templates': content_digest(template.TEMPLATE_PATH),
+        'tile.yml': file_digest('tile.yml'),
+        'tool': version_string,
+        'source_date_epoch': os.environ.get('SOURCE_DATE_EPOCH'),
+    }
+
+def build_tile(context, state=None):
+    if state is not None:
+        inputs = fingerprint(tile_inputs(context))
+        outputs = state.reuse('tile', inputs)
+        if outputs is not None:
+            print('reusing tile', outputs['pivotal_file'])
+            return
+    _build_tile(context)
+    if state is not None:
+        pivotal_file = os.path.join('product', context['name'] + '-' + context['version'] + '.pivotal')
+        state.record('tile', inputs, { 'pivotal_file': pivotal_file }, [pivotal_file])
+        state.save()
+
+def write_staged(filename, data):
+    mkdir_p(os.path.dirname(filename))
+    with open(filename, 'wb') as f:
+        f.write(data)
+
+def write_digest_manifest(pivotal_file, entries):
+    digest = hashlib.sha256()
+    with open(pivotal_file, 'rb') as f:
+        for chunk in iter(lambda: f.read(ZIP_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    manifest_file = pivotal_file + '.digests.json'
+    with open(manifest_file, 'w') as f:
+        json.dump({
+            'file': os.path.basename(pivotal_file),
+            'sha256': digest.hexdigest(),
+            'entries': entries,
+        }, f, indent=2, sort_keys=True)
+        f.write('\n')
+    return manifest_file
+
+def _build_tile(context):
     mkdir_p('product', clobber=True)
-    mkdir_p('product/releases')
-    mkdir_p('product/tile-generator')
     tile_name = context['name']
     tile_version = context['version']
+    keep_staging = context.get('keep_staging', False)
+    epoch = source_date_epoch(tile_version) if context.get('reproducible') else None
     print('tile generate metadata')
     context['tile_metadata'] = build_tile_metadata(context)
-    template.render('product/metadata/' + tile_name + '.yml', 'tile/metadata.yml', context)
+    metadata = bytes(template.render_to_string('tile/metadata.yml', context), 'utf-8')
     print('tile generate migrations')
-    migrations = 'product/migrations/v1/' + datetime.datetime.now().strftime('%Y%m%d%H%M') + '_noop.js'
-    template.render(migrations, 'tile/migration.js', context)
+    if epoch is None:
+        timestamp = datetime.datetime.now()
+    else:
+        timestamp = datetime.datetime.fromtimestamp(epoch, datetime.timezone.utc)
+    migrations = 'migrations/v1/' + timestamp.strftime('%Y%m%d%H%M') + '_noop.js'
+    migration = bytes(template.render_to_string('tile/migration.js', context), 'utf-8')
     print('tile generate package')
     pivotal_file = os.path.join('product', tile_name + '-' + tile_version + '.pivotal')
     print('include tile generator version and inputs')
-    with open(os.path.join('product', 'tile-generator', 'version'), 'w') as f:
-        f.write(version_string)
-    shutil.copy('tile.yml', os.path.join('product', 'tile-generator', 'tile.yml'))
+    with open('tile.yml', 'rb') as f:
+        tile_yml = f.read()
+    # Generated files are written straight from memory and release
+    # tarballs streamed from release/, so only the .pivotal lands in
+    # product/ unless the staging files are asked for.
+    generated = [
+        (os.path.join('metadata', tile_name + '.yml'), metadata),
+        (migrations, migration),
+        (os.path.join('tile-generator', 'tile.yml'), tile_yml),
+        (os.path.join('tile-generator', 'version'), bytes(version_string, 'utf-8')),
+    ]
+    releases = list(context.get('releases', {}).values())
+    if epoch is not None:
+        releases.sort(key=lambda release: release['file'])
     with zipfile.ZipFile(pivotal_file, 'w', allowZip64=True) as f:
-        for release in context.get('releases', {}).values():
-            print('tile include release', release['release_name'] + '-' + release['version'])
-            shutil.copy(release['tarball'], os.path.join('product/releases', release['file']))
-            f.write(
-                os.path.join('product/releases', release['file']),
-                os.path.join('releases', release['file']))
-        f.write(
-            os.path.join('product/metadata', tile_name + '.yml'),
-            os.path.join('metadata', tile_name + '.yml'))
-        f.write(migrations, migrations.replace('product/', '', 1))
-        f.write(
-            os.path.join('product/tile-generator', 'tile.yml'),
-            os.path.join('tile-generator', 'tile.yml'))
-        f.write(
-            os.path.join('product/tile-generator', 'version'),
-            os.path.join('tile-generator', 'version'))
+        writer = ZipWriter(f, context.get('compression_level'), epoch=epoch)
+        try:
+            for release in releases:
+                print('tile include release', release['release_name'] + '-' + release['version'])
+                arcname = os.path.join('releases', release['file'])
+                writer.add_file(release['tarball'], arcname)
+                if keep_staging:
+                    mkdir_p(os.path.join('product', 'releases'))
+                    shutil.copy(release['tarball'], os.path.join('product', arcname))
+            for arcname, data in generated:
+                writer.add_data(data, arcname)
+                if keep_staging:
+                    write_staged(os.path.join('product', arcname), data)
+        finally:
+            writer.close()
+    entries = dict(writer.digests)
 
     print('created tile', pivotal_file)
+    if epoch is not None:
+        print('created digest manifest', write_digest_manifest(pivotal_file, entries))
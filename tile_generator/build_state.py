@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+# tile-generator
+#
+# Copyright (c) 2015-Present Pivotal Software, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import hashlib
+import json
+import os
+
+# Every build step records a digest for each of its named inputs and the
+# outputs it produced. On the next build a step whose inputs all digest
+# the same, and whose outputs are still on disk, is skipped and its
+# recorded outputs are reused.
+
+def digest(value):
+	encoded = json.dumps(value, sort_keys=True, default=str, separators=(',', ':'))
+	return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+def fingerprint(inputs):
+	return dict((name, digest(value)) for name, value in inputs.items())
+
+def stat_entry(name, filename):
+	try:
+		stat = os.stat(filename)
+	except OSError:
+		# A dangling symlink, or a file removed while walking
+		try:
+			stat = os.lstat(filename)
+		except OSError:
+			return [name, None, None]
+	return [name, stat.st_size, stat.st_mtime_ns]
+
+def file_digest(path):
+	"""Cheap digest of a file or directory tree, based on sizes and mtimes."""
+	entries = []
+	if os.path.isdir(path):
+		for root, dirs, files in os.walk(path):
+			dirs.sort()
+			for name in sorted(files):
+				filename = os.path.join(root, name)
+				entries.append(stat_entry(os.path.relpath(filename, path), filename))
+	elif os.path.lexists(path):
+		entries.append(stat_entry(os.path.basename(path), path))
+	return digest(entries)
+
+def content_digest(path):
+	"""Digest of the contents of every file below path."""
+	sha = hashlib.sha256()
+	for root, dirs, files in os.walk(path):
+		dirs.sort()
+		for name in sorted(files):
+			filename = os.path.join(root, name)
+			sha.update(os.path.relpath(filename, path).encode('utf-8'))
+			with open(filename, 'rb') as f:
+				sha.update(f.read())
+	return sha.hexdigest()
+
+class BuildState:
+
+	def __init__(self, path, force=False, explain=False):
+		self.path = path
+		self.force = force
+		self.explain = explain
+		self.steps = {}
+		if not force:
+			try:
+				with open(path) as f:
+					self.steps = json.load(f).get('steps', {})
+			except (IOError, ValueError):
+				pass
+
+	def changes(self, step, inputs, unpinned=()):
+		"""Return the reasons step has to run, or an empty list if it can be skipped.
+
+		inputs is a fingerprint(): a digest for each named input. unpinned
+		names inputs whose content can't be identified, which always rerun
+		the step.
+		"""
+		if self.force:
+			return ['--force']
+		prior = self.steps.get(step)
+		if prior is None:
+			return ['no previous build']
+		changed = sorted(name for name in set(inputs) | set(prior['inputs']) if inputs.get(name) != prior['inputs'].get(name))
+		if changed:
+			return ['changed ' + ', '.join(changed)]
+		if unpinned:
+			return ['unpinned ' + ', '.join(unpinned)]
+		missing = [path for path in prior.get('files', []) if not os.path.exists(path)]
+		if missing:
+			return ['missing ' + ', '.join(missing)]
+		return []
+
+	def reuse(self, step, inputs, unpinned=()):
+		"""Return the outputs recorded for step if its inputs are unchanged, else None."""
+		changes = self.changes(step, inputs, unpinned)
+		if self.explain:
+			print(step + ':', 'rerun (' + '; '.join(changes) + ')' if changes else 'up to date')
+		if changes:
+			self.steps.pop(step, None)
+			return None
+		return self.steps[step]['outputs']
+
+	def record(self, step, inputs, outputs, files=()):
+		self.steps[step] = {
+			'inputs': inputs,
+			'outputs': outputs,
+			'files': list(files),
+		}
+
+	def save(self):
+		staged = self.path + '.partial'
+		with open(staged, 'w') as f:
+			json.dump({ 'steps': self.steps }, f, indent=2, sort_keys=True, default=str)
+		os.rename(staged, self.path)
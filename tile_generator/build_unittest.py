@@ -15,8 +15,19 @@
 # limitations under the License.
 
 
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+import zipfile
+import mock
 from . import build
+from . import util
+from .build_state import BuildState
 import sys
 from contextlib import contextmanager
 from io import StringIO
@@ -31,5 +42,330 @@ def capture_output():
 	finally:
 		sys.stdout, sys.stderr = old_out, old_err
 
+def fake_build_bosh_release(release, config):
+	# Finish in reverse order to show output is still replayed in order
+	time.sleep(release.get('delay', 0))
+	if 'blocker' in release:
+		release['blocker'].wait()
+	print('building', release['name'])
+	if release.get('fail'):
+		raise RuntimeError('failed to build ' + release['name'])
+	return { 'release_name': release['name'], 'version': '1.0.0' }
+
+@mock.patch('tile_generator.build.mkdir_p')
+@mock.patch('tile_generator.build.build_bosh_release', side_effect=fake_build_bosh_release)
+class TestBuildBoshReleases(unittest.TestCase):
+	def config(self, *releases):
+		return { 'releases': { r['name']: r for r in releases }, 'build_jobs': 3 }
+
+	def test_parallel_output_is_deterministic(self, mock_build, mock_mkdir):
+		config = self.config({ 'name': 'a', 'delay': 0.2 }, { 'name': 'b', 'delay': 0.1 }, { 'name': 'c' })
+		with capture_output() as (out, err):
+			build.build_bosh_releases(config)
+		self.assertEqual(out.getvalue(), '[a] building a\n[b] building b\n[c] building c\n\n')
+		for name in 'abc':
+			self.assertEqual(config['releases'][name]['release_name'], name)
+
+	def test_first_failure_fails_the_build(self, mock_build, mock_mkdir):
+		config = self.config({ 'name': 'a', 'delay': 0.2 }, { 'name': 'b', 'fail': True }, { 'name': 'c', 'delay': 0.2 })
+		config['build_jobs'] = 2
+		threads = set(threading.enumerate())
+		with capture_output() as (out, err):
+			with self.assertRaises(RuntimeError):
+				build.build_bosh_releases(config)
+			running = [t for t in set(threading.enumerate()) - threads if t.is_alive()]
+		self.assertEqual(running, [])
+		lines = out.getvalue().splitlines()
+		# Releases still building when b failed are finished and replayed
+		self.assertEqual(lines[:2], ['[a] building a', '[b] building b'])
+		for line in lines:
+			self.assertTrue(line.startswith('['), line)
+		# a was already building, so it is finished and kept
+		self.assertEqual(config['releases']['a']['release_name'], 'a')
+
+	def test_download_threads_write_to_their_release(self, mock_build, mock_mkdir):
+		def fake_download(url, filename, cache, sha256, **options):
+			time.sleep(0.05 if filename.endswith('1') else 0)
+			print('- downloaded', filename)
+		def build_with_downloads(release, config):
+			util.download_all([(None, release['name'] + str(i), None) for i in range(3)], jobs=3)
+			return { 'release_name': release['name'] }
+		mock_build.side_effect = build_with_downloads
+		config = self.config({ 'name': 'a' }, { 'name': 'b' })
+		with mock.patch('tile_generator.util.download', side_effect=fake_download):
+			with capture_output() as (out, err):
+				build.build_bosh_releases(config)
+		lines = out.getvalue().splitlines()
+		self.assertEqual(sorted(lines[:3]), ['[a] - downloaded a0', '[a] - downloaded a1', '[a] - downloaded a2'])
+		self.assertEqual(sorted(lines[3:6]), ['[b] - downloaded b0', '[b] - downloaded b1', '[b] - downloaded b2'])
+
+	def test_single_job_builds_serially(self, mock_build, mock_mkdir):
+		config = self.config({ 'name': 'a' }, { 'name': 'b' })
+		config['build_jobs'] = 1
+		with capture_output() as (out, err):
+			build.build_bosh_releases(config)
+		self.assertEqual(out.getvalue(), 'building a\nbuilding b\n\n')
+
+def fake_tarball_build(release, config):
+	tarball = os.path.join('release', release['name'], release['name'] + '.tgz')
+	with open(tarball, 'w') as f:
+		f.write('tarball')
+	for package in release.get('packages', []):
+		package['files'] = [{ 'name': package['name'] + '.zip', 'path': 'zipped' }]
+	return { 'release_name': release['name'], 'version': config['version'], 'tarball': tarball, 'file': release['name'] + '.tgz' }
+
+@mock.patch('tile_generator.build.build_bosh_release', side_effect=fake_tarball_build)
+class TestIncrementalBuild(unittest.TestCase):
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.tmpdir = tempfile.mkdtemp()
+		os.chdir(self.tmpdir)
+		# What each remote url currently serves, as told by a HEAD request
+		self.etags = {}
+		session = mock.patch('tile_generator.util.http_session').start()
+		session.return_value.head.side_effect = self.head
+		self.addCleanup(mock.patch.stopall)
+
+	def head(self, url, **kw):
+		response = mock.Mock()
+		response.ok = True
+		response.url = url
+		response.headers = { 'ETag': self.etags[url] } if self.etags.get(url) else {}
+		return response
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.tmpdir)
+
+	def config(self, **kw):
+		config = {
+			'name': 'my-tile',
+			'version': '1.0.0',
+			'description': 'a tile',
+			'releases': {
+				'app': { 'name': 'app', 'packages': [{ 'name': 'app', 'files': [{ 'name': 'app.zip', 'path': 'http://example.com/app.zip' }] }] },
+				'cf-cli': { 'name': 'cf-cli', 'path': 'https://example.com/cf-cli.tgz' },
+			},
+		}
+		config.update(kw)
+		self.etags.setdefault('http://example.com/app.zip', '"1"')
+		self.etags.setdefault('https://example.com/cf-cli.tgz', '"1"')
+		return config
+
+	def build(self, config, **kw):
+		with capture_output() as (out, err):
+			build.build_bosh_releases(config, BuildState(build.BUILD_STATE_FILE, **kw))
+		return out.getvalue()
+
+	def test_unchanged_releases_are_reused(self, mock_build):
+		self.build(self.config())
+		config = self.config(description='a better tile')
+		out = self.build(config)
+		self.assertEqual(mock_build.call_count, 2)
+		self.assertIn('reusing release app.tgz', out)
+		self.assertEqual(config['releases']['app']['tarball'], os.path.join('release', 'app', 'app.tgz'))
+		self.assertEqual(config['releases']['app']['packages'][0]['files'][0]['path'], 'zipped')
+
+	def test_version_change_only_rebuilds_generated_releases(self, mock_build):
+		self.build(self.config())
+		self.build(self.config(version='1.0.1'))
+		self.assertEqual([c[0][0]['name'] for c in mock_build.call_args_list], ['app', 'cf-cli', 'app'])
+
+	def test_explain_names_a_version_change(self, mock_build):
+		self.build(self.config())
+		out = self.build(self.config(version='1.0.1'), explain=True)
+		self.assertIn('release app: rerun (changed version)', out)
+		self.assertIn('release cf-cli: up to date', out)
+
+	def check_built_releases_survive_a_failure(self, mock_build, **kw):
+		def fail_cf_cli(release, config):
+			if release['name'] == 'cf-cli':
+				raise RuntimeError('download failed')
+			return fake_tarball_build(release, config)
+		mock_build.side_effect = fail_cf_cli
+		with self.assertRaises(RuntimeError):
+			self.build(self.config(**kw))
+		mock_build.side_effect = fake_tarball_build
+		out = self.build(self.config(**kw), explain=True)
+		self.assertIn('release app: up to date', out)
+		self.assertIn('release cf-cli: rerun (no previous build)', out)
+
+	def test_built_releases_survive_a_failure(self, mock_build):
+		self.check_built_releases_survive_a_failure(mock_build)
+
+	def test_built_releases_survive_a_parallel_failure(self, mock_build):
+		self.check_built_releases_survive_a_failure(mock_build, build_jobs=2)
+
+	def test_force_rebuilds_everything(self, mock_build):
+		self.build(self.config())
+		self.build(self.config(), force=True)
+		self.assertEqual(mock_build.call_count, 4)
+
+	def test_missing_tarball_is_rebuilt(self, mock_build):
+		self.build(self.config())
+		shutil.rmtree(os.path.join('release', 'cf-cli'))
+		out = self.build(self.config(), explain=True)
+		self.assertIn('release app: up to date', out)
+		self.assertIn('release cf-cli: rerun (missing release/cf-cli/cf-cli.tgz)', out)
+
+	def test_explain_names_changed_inputs(self, mock_build):
+		self.build(self.config())
+		config = self.config()
+		config['releases']['cf-cli']['path'] = 'https://example.com/cf-cli-2.tgz'
+		self.etags['https://example.com/cf-cli-2.tgz'] = '"1"'
+		out = self.build(config, explain=True)
+		self.assertIn('release cf-cli: rerun (changed release, remote)', out)
+
+	def test_changed_remote_content_is_rebuilt(self, mock_build):
+		self.build(self.config())
+		self.etags['https://example.com/cf-cli.tgz'] = '"2"'
+		out = self.build(self.config(), explain=True)
+		self.assertIn('release app: up to date', out)
+		self.assertIn('release cf-cli: rerun (changed remote)', out)
+
+	def test_unpinned_remote_inputs_are_always_rebuilt(self, mock_build):
+		def config():
+			config = self.config()
+			config['releases']['app']['packages'][0]['files'].append({ 'name': 'nginx', 'path': 'docker:nginx:latest' })
+			return config
+		self.etags['https://example.com/cf-cli.tgz'] = None
+		self.build(config())
+		out = self.build(config(), explain=True)
+		self.assertIn('release app: rerun (unpinned docker:nginx:latest)', out)
+		self.assertIn('release cf-cli: rerun (unpinned https://example.com/cf-cli.tgz)', out)
+		self.assertEqual(mock_build.call_count, 4)
+
+	def test_pinned_remote_inputs_are_not_checked(self, mock_build):
+		def config():
+			config = self.config()
+			config['releases']['cf-cli']['sha256'] = '0' * 64
+			return config
+		self.etags['https://example.com/cf-cli.tgz'] = None
+		self.build(config())
+		out = self.build(config(), explain=True)
+		self.assertIn('release cf-cli: up to date', out)
+		heads = [c[0][0] for c in util.http_session.return_value.head.call_args_list]
+		self.assertNotIn('https://example.com/cf-cli.tgz', heads)
+
+	@mock.patch('tile_generator.build.resolve_github_url')
+	def test_github_inputs_follow_the_latest_release(self, mock_resolve, mock_build):
+		def config():
+			config = self.config()
+			config['releases']['cf-cli']['path'] = 'github://o/r/cf-cli.tgz'
+			return config
+		self.etags['https://example.com/cf-cli-1.tgz'] = '"1"'
+		self.etags['https://example.com/cf-cli-2.tgz'] = '"1"'
+		mock_resolve.return_value = 'https://example.com/cf-cli-1.tgz'
+		self.build(config())
+		mock_resolve.return_value = 'https://example.com/cf-cli-2.tgz'
+		out = self.build(config(), explain=True)
+		self.assertIn('release cf-cli: rerun (changed remote)', out)
+
+	def test_removed_releases_are_pruned(self, mock_build):
+		self.build(self.config())
+		config = self.config()
+		del config['releases']['cf-cli']
+		self.build(config)
+		self.assertEqual(sorted(os.listdir('release')), ['.build-state.json', 'app'])
+
+	@mock.patch('tile_generator.build._build_tile')
+	def test_unchanged_tile_is_reused(self, mock_build_tile, mock_build):
+		config = self.config()
+		self.build(config)
+		os.makedirs('product')
+		with open(os.path.join('product', 'my-tile-1.0.0.pivotal'), 'w') as f:
+			f.write('tile')
+		with open('tile.yml', 'w') as f:
+			f.write('name: my-tile')
+		with capture_output() as (out, err):
+			build.build_tile(config, BuildState(build.BUILD_STATE_FILE))
+			build.build_tile(config, BuildState(build.BUILD_STATE_FILE))
+			build.build_tile(self.built(description='changed'), BuildState(build.BUILD_STATE_FILE))
+		self.assertEqual(mock_build_tile.call_count, 2)
+		self.assertIn('reusing tile product/my-tile-1.0.0.pivotal', out.getvalue())
+
+	def built(self, **kw):
+		config = self.config(**kw)
+		self.build(config)
+		return config
+
+@mock.patch('tile_generator.build.build_tile_metadata')
+@mock.patch('tile_generator.template.render_to_string', side_effect=lambda template_file, config: template_file)
+class TestReproducibleTile(unittest.TestCase):
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.tmpdir = tempfile.mkdtemp()
+		os.chdir(self.tmpdir)
+		os.makedirs('release')
+		with open('tile.yml', 'w') as f:
+			f.write('name: my-tile')
+		self.releases = {}
+		for name in ['b', 'a']:
+			tarball = os.path.join('release', name + '.tgz')
+			with open(tarball, 'w') as f:
+				f.write('release ' + name)
+			self.releases[name] = { 'release_name': name, 'version': '1.0.0', 'tarball': tarball, 'file': name + '.tgz' }
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.tmpdir)
+
+	def build(self, **kw):
+		context = { 'name': 'my-tile', 'version': '1.2.3', 'releases': self.releases, 'reproducible': True }
+		context.update(kw)
+		with capture_output():
+			build._build_tile(context)
+		pivotal_file = os.path.join('product', 'my-tile-' + context['version'] + '.pivotal')
+		with open(pivotal_file, 'rb') as f:
+			return f.read()
+
+	def test_identical_inputs_give_identical_bytes(self, mock_render, mock_metadata):
+		first = self.build()
+		time.sleep(1.1)
+		os.utime('tile.yml', None)
+		self.assertEqual(self.build(), first)
+
+	def test_entries_are_ordered_and_normalized(self, mock_render, mock_metadata):
+		self.build()
+		with zipfile.ZipFile(os.path.join('product', 'my-tile-1.2.3.pivotal')) as z:
+			infos = z.infolist()
+		self.assertEqual([i.filename for i in infos][:2], ['releases/a.tgz', 'releases/b.tgz'])
+		self.assertEqual(set(i.date_time for i in infos), set([time.gmtime(build.source_date_epoch('1.2.3'))[:6]]))
+		self.assertEqual(set(i.external_attr >> 16 for i in infos), set([0o644]))
+		self.assertIn('migrations/v1/198003112003_noop.js', [i.filename for i in infos])
+
+	def test_source_date_epoch_overrides_version(self, mock_render, mock_metadata):
+		with mock.patch.dict(os.environ, { 'SOURCE_DATE_EPOCH': '1500000000' }):
+			self.build()
+		with zipfile.ZipFile(os.path.join('product', 'my-tile-1.2.3.pivotal')) as z:
+			self.assertIn('migrations/v1/201707140240_noop.js', z.namelist())
+
+	def test_digest_manifest(self, mock_render, mock_metadata):
+		content = self.build()
+		with open(os.path.join('product', 'my-tile-1.2.3.pivotal.digests.json')) as f:
+			manifest = json.load(f)
+		self.assertEqual(manifest['sha256'], hashlib.sha256(content).hexdigest())
+		self.assertEqual(manifest['entries']['releases/a.tgz'], hashlib.sha256(b'release a').hexdigest())
+
+	def test_default_build_has_no_digest_manifest(self, mock_render, mock_metadata):
+		self.build(reproducible=False)
+		self.assertFalse(os.path.exists(os.path.join('product', 'my-tile-1.2.3.pivotal.digests.json')))
+
+	def test_only_the_tile_is_left_in_product(self, mock_render, mock_metadata):
+		self.build(reproducible=False)
+		self.assertEqual(os.listdir('product'), ['my-tile-1.2.3.pivotal'])
+		with zipfile.ZipFile(os.path.join('product', 'my-tile-1.2.3.pivotal')) as z:
+			self.assertEqual(z.read('releases/a.tgz'), b'release a')
+			self.assertEqual(z.read('metadata/my-tile.yml'), b'tile/metadata.yml')
+			self.assertEqual(z.read('tile-generator/tile.yml'), b'name: my-tile')
+			self.assertEqual(z.getinfo('releases/a.tgz').compress_type, zipfile.ZIP_STORED)
+			self.assertEqual(z.getinfo('metadata/my-tile.yml').compress_type, zipfile.ZIP_DEFLATED)
+
+	def test_keep_staging(self, mock_render, mock_metadata):
+		self.build(reproducible=False, keep_staging=True)
+		self.assertEqual(sorted(os.listdir('product')), ['metadata', 'migrations', 'my-tile-1.2.3.pivotal', 'releases', 'tile-generator'])
+		with open(os.path.join('product', 'releases', 'b.tgz')) as f:
+			self.assertEqual(f.read(), 'release b')
+
 if __name__ == '__main__':
 	unittest.main()
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+
+# tile-generator
+#
+# Copyright (c) 2015-Present Pivotal Software, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import errno
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+try:
+	import fcntl
+except ImportError:
+	fcntl = None
+
+# ioctl number for FICLONE (copy-on-write clone) on Linux
+FICLONE = 0x40049409
+CHUNK_SIZE = 1024 * 1024
+
+# The download cache is content addressable:
+#
+#   <cache>/objects/<sha256>       the downloaded file
+#   <cache>/objects/<sha256>.json  sidecar recording its size and source urls
+#   <cache>/urls/<sha256 of url>   { sha256, validator } last downloaded from that url
+#
+# The validator is the ETag or Last-Modified the url served the object
+# with. Unless a sha256 is pinned, callers pass the url's current
+# validator, and an entry that doesn't match is a miss, so a url serving
+# new content is downloaded again.
+#
+# Every entry is written to a temporary file and renamed into place, so
+# concurrent builds sharing a cache never observe a partial entry. Objects
+# are copies (or copy-on-write clones) of what was stored, never links to
+# it, and are read-only, so nothing a build later writes to its working
+# files can change them. Fetching an object may hardlink it, because
+# downloads always replace their target by renaming a new file over it. The
+# modification time of an object is bumped on every hit and serves as
+# the LRU clock when the cache is trimmed to its size cap.
+
+def user_cache_dir(name, variable):
+	"""Return the directory of one of tile-generator's caches under $XDG_CACHE_HOME.
+
+	The environment variable named by variable overrides it, and an empty
+	value disables that cache.
+	"""
+	cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+	return os.environ.get(variable, os.path.join(cache_home, 'tile-generator', name))
+
+def hash_file(filename, algorithm=hashlib.sha256):
+	"""Return the hex digest of the contents of filename."""
+	digest = algorithm()
+	with open(filename, 'rb') as f:
+		for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+def sha256_file(filename):
+	return hash_file(filename, hashlib.sha256)
+
+def parse_size(size):
+	if size is None or isinstance(size, int):
+		return size
+	match = re.match(r'^\s*([0-9.]+)\s*([kmgt]?)i?b?\s*$', str(size), re.IGNORECASE)
+	if match is None:
+		raise ValueError('Invalid size: ' + str(size))
+	exponent = ' kmgt'.index(match.group(2).lower() or ' ')
+	return int(float(match.group(1)) * 1024 ** exponent)
+
+def materialize(source, target, link=True):
+	"""Make `target` a copy of `source` as cheaply as the filesystem allows.
+
+	Tries a hardlink first (unless `link` is false), then a copy-on-write
+	clone, and only falls back to copying the bytes when neither is
+	possible.
+	"""
+	if os.path.lexists(target):
+		os.remove(target)
+	if link:
+		try:
+			os.link(source, target)
+			return 'link'
+		except OSError:
+			pass
+	if fcntl is not None:
+		try:
+			with open(source, 'rb') as s, open(target, 'wb') as t:
+				fcntl.ioctl(t.fileno(), FICLONE, s.fileno())
+			return 'reflink'
+		except (OSError, IOError):
+			if os.path.exists(target):
+				os.remove(target)
+	shutil.copyfile(source, target)
+	return 'copy'
+
+class DownloadCache:
+
+	_caches = {}
+	_caches_lock = threading.Lock()
+
+	@classmethod
+	def open(cls, directory, max_size=None):
+		directory = os.path.realpath(os.path.expanduser(directory))
+		with cls._caches_lock:
+			cache = cls._caches.get(directory)
+			if cache is None:
+				cache = cls._caches[directory] = cls(directory)
+			if max_size is not None:
+				cache.max_size = parse_size(max_size)
+			return cache
+
+	def __init__(self, directory, max_size=None):
+		self.directory = directory
+		self.max_size = parse_size(max_size)
+		self.objects_dir = os.path.join(directory, 'objects')
+		self.urls_dir = os.path.join(directory, 'urls')
+		for d in [self.objects_dir, self.urls_dir]:
+			try:
+				os.makedirs(d)
+			except OSError as e:
+				if e.errno != errno.EEXIST:
+					raise
+
+	def object_path(self, digest):
+		return os.path.join(self.objects_dir, digest)
+
+	def url_path(self, url):
+		return os.path.join(self.urls_dir, hashlib.sha256(url.encode('utf-8')).hexdigest())
+
+	def url_entry(self, url):
+		try:
+			with open(self.url_path(url)) as f:
+				content = f.read().strip()
+		except IOError:
+			return None
+		try:
+			entry = json.loads(content)
+		except ValueError:
+			# Written before validators were recorded
+			return { 'sha256': content, 'validator': None }
+		return entry if isinstance(entry, dict) and entry.get('sha256') else None
+
+	def lookup(self, url, sha256=None, validator=None):
+		"""Return the digest of the cached content for url, or None.
+
+		A pinned sha256 is authoritative. Otherwise the digest last
+		downloaded from the url is used, if validator is None or the url
+		served it with that validator.
+		"""
+		digest = sha256
+		if digest is None:
+			entry = self.url_entry(url)
+			if entry is None:
+				return None
+			if validator is not None and entry.get('validator') != validator:
+				return None
+			digest = entry['sha256']
+		if not os.path.isfile(self.object_path(digest)):
+			return None
+		return digest
+
+	def fetch(self, url, filename, sha256=None, validator=None):
+		digest = self.lookup(url, sha256, validator)
+		if digest is None:
+			return False
+		path = self.object_path(digest)
+		try:
+			os.utime(path, None)
+			materialize(path, filename)
+		except OSError:
+			# Evicted by a concurrent build
+			return False
+		return True
+
+	def store(self, url, filename, sha256=None, validator=None):
+		digest = sha256 or sha256_file(filename)
+		path = self.object_path(digest)
+		if os.path.isfile(path):
+			os.utime(path, None)
+		else:
+			staged = self._tempname(self.objects_dir)
+			materialize(filename, staged, link=False)
+			os.chmod(staged, 0o444)
+			os.rename(staged, path)
+		self._write_sidecar(digest, url, os.path.getsize(path))
+		self._write(self.url_path(url), json.dumps({ 'sha256': digest, 'validator': validator }, sort_keys=True))
+		self.evict()
+		return digest
+
+	def entries(self):
+		entries = []
+		for name in os.listdir(self.objects_dir):
+			if name.startswith('.') or name.endswith('.json'):
+				continue
+			try:
+				stat = os.stat(self.object_path(name))
+			except OSError:
+				continue
+			entries.append((stat.st_mtime, stat.st_size, name))
+		return entries
+
+	def size(self):
+		return sum(size for mtime, size, name in self.entries())
+
+	def evict(self):
+		if self.max_size is None:
+			return []
+		entries = sorted(self.entries())
+		total = sum(size for mtime, size, name in entries)
+		evicted = []
+		for mtime, size, digest in entries:
+			if total <= self.max_size:
+				break
+			for path in [self.object_path(digest), self.object_path(digest) + '.json']:
+				try:
+					os.remove(path)
+				except OSError:
+					pass
+			total -= size
+			evicted.append(digest)
+		return evicted
+
+	def _write_sidecar(self, digest, url, size):
+		sidecar = self.object_path(digest) + '.json'
+		try:
+			with open(sidecar) as f:
+				metadata = json.load(f)
+		except (IOError, ValueError):
+			metadata = { 'sha256': digest, 'urls': [] }
+		metadata['size'] = size
+		if url not in metadata['urls']:
+			metadata['urls'].append(url)
+		metadata['stored'] = int(time.time())
+		self._write(sidecar, json.dumps(metadata, indent=2, sort_keys=True))
+
+	def _write(self, path, content):
+		staged = self._tempname(os.path.dirname(path))
+		with open(staged, 'w') as f:
+			f.write(content)
+		os.rename(staged, path)
+
+	def _tempname(self, directory):
+		fd, name = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+		os.close(fd)
+		return name
@@ -0,0 +1,226 @@
+# tile-generator
+#
+# Copyright (c) 2015-Present Pivotal Software, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import mock
+import os
+import requests
+import shutil
+import sys
+import tempfile
+import unittest
+from contextlib import contextmanager
+from io import StringIO
+
+from . import cache
+from . import util
+from .cache import DownloadCache
+
+@contextmanager
+def capture_output():
+	new_out, new_err = StringIO(), StringIO()
+	old_out, old_err = sys.stdout, sys.stderr
+	try:
+		sys.stdout, sys.stderr = new_out, new_err
+		yield sys.stdout, sys.stderr
+	finally:
+		sys.stdout, sys.stderr = old_out, old_err
+
+class CacheTest(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.cache = DownloadCache(os.path.join(self.tmpdir, 'cache'))
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def write(self, name, content):
+		path = os.path.join(self.tmpdir, name)
+		with open(path, 'w') as f:
+			f.write(content)
+		return path
+
+	def read(self, path):
+		with open(path) as f:
+			return f.read()
+
+class TestDownloadCache(CacheTest):
+	def test_same_basename_from_different_urls_does_not_collide(self):
+		self.cache.store('https://a.example.com/app.zip', self.write('a', 'from a'))
+		self.cache.store('https://b.example.com/app.zip', self.write('b', 'from b'))
+		target = os.path.join(self.tmpdir, 'app.zip')
+		self.assertTrue(self.cache.fetch('https://a.example.com/app.zip', target))
+		self.assertEqual(self.read(target), 'from a')
+		self.assertTrue(self.cache.fetch('https://b.example.com/app.zip', target))
+		self.assertEqual(self.read(target), 'from b')
+
+	def test_miss_for_unknown_url(self):
+		self.assertFalse(self.cache.fetch('https://example.com/app.zip', os.path.join(self.tmpdir, 'app.zip')))
+
+	def test_pinned_digest_must_match(self):
+		self.cache.store('https://example.com/app.zip', self.write('a', 'old'))
+		pinned = hashlib.sha256(b'new').hexdigest()
+		self.assertIsNone(self.cache.lookup('https://example.com/app.zip', pinned))
+		self.assertIsNotNone(self.cache.lookup('https://example.com/app.zip'))
+
+	def test_sidecar_records_urls(self):
+		digest = self.cache.store('https://a.example.com/app.zip', self.write('a', 'same'))
+		self.cache.store('https://b.example.com/app.zip', self.write('b', 'same'))
+		with open(self.cache.object_path(digest) + '.json') as f:
+			sidecar = json.load(f)
+		self.assertEqual(sidecar['size'], 4)
+		self.assertEqual(sidecar['urls'], ['https://a.example.com/app.zip', 'https://b.example.com/app.zip'])
+
+	def test_evicts_least_recently_used(self):
+		self.cache.max_size = 10
+		first = self.cache.store('https://example.com/1', self.write('1', '11111'))
+		second = self.cache.store('https://example.com/2', self.write('2', '22222'))
+		os.utime(self.cache.object_path(first), (1, 1))
+		os.utime(self.cache.object_path(second), (2, 2))
+		self.cache.fetch('https://example.com/1', os.path.join(self.tmpdir, 'out'))
+		self.cache.store('https://example.com/3', self.write('3', '33333'))
+		self.assertIsNotNone(self.cache.lookup('https://example.com/1'))
+		self.assertIsNone(self.cache.lookup('https://example.com/2'))
+		self.assertIsNotNone(self.cache.lookup('https://example.com/3'))
+		self.assertLessEqual(self.cache.size(), 10)
+
+	def test_materialize_prefers_hardlinks(self):
+		source = self.write('source', 'content')
+		target = os.path.join(self.tmpdir, 'target')
+		self.assertEqual(cache.materialize(source, target), 'link')
+		self.assertEqual(os.stat(source).st_ino, os.stat(target).st_ino)
+
+	def test_stored_objects_are_not_linked_to_the_working_file(self):
+		source = self.write('source', 'content')
+		digest = self.cache.store('https://example.com/app.zip', source)
+		path = self.cache.object_path(digest)
+		self.assertNotEqual(os.stat(source).st_ino, os.stat(path).st_ino)
+		self.assertFalse(os.stat(path).st_mode & 0o222)
+		with open(source, 'w') as f:
+			f.write('overwritten')
+		self.assertEqual(self.read(path), 'content')
+
+	def test_parse_size(self):
+		self.assertEqual(cache.parse_size('20G'), 20 * 1024 ** 3)
+		self.assertEqual(cache.parse_size('512m'), 512 * 1024 ** 2)
+		self.assertEqual(cache.parse_size('100'), 100)
+
+class TestDownloadWithCache(CacheTest):
+	def setUp(self):
+		super(TestDownloadWithCache, self).setUp()
+		# What the fake server serves, and the ETag it serves it with
+		self.content, self.etag = b'content', '"1"'
+		self.session = mock.patch('tile_generator.util.http_session').start().return_value
+		self.session.get.side_effect = self.get
+		self.session.head.side_effect = self.head
+		self.addCleanup(mock.patch.stopall)
+
+	def headers(self):
+		return { 'ETag': self.etag } if self.etag else {}
+
+	def get(self, url, **kw):
+		response = mock.Mock()
+		response.status_code = 200
+		response.headers = self.headers()
+		response.iter_content.return_value = [self.content]
+		return response
+
+	def head(self, url, **kw):
+		response = mock.Mock()
+		response.ok = True
+		response.url = url
+		response.headers = self.headers()
+		return response
+
+	def download(self, url, target, **kw):
+		with capture_output() as (out, err):
+			util.download(url, target, self.cache, **kw)
+		return out.getvalue()
+
+	def test_remote_download_is_cached(self):
+		target = os.path.join(self.tmpdir, 'app.zip')
+		self.download('https://example.com/app.zip', target)
+		os.remove(target)
+		out = self.download('https://example.com/app.zip', target)
+		self.assertEqual(self.session.get.call_count, 1)
+		self.assertIn('using cached version', out)
+		self.assertEqual(self.read(target), 'content')
+
+	def test_changed_content_is_downloaded_again(self):
+		target = os.path.join(self.tmpdir, 'app.zip')
+		self.download('https://example.com/app.zip', target)
+		self.content, self.etag = b'new content', '"2"'
+		out = self.download('https://example.com/app.zip', target)
+		self.assertNotIn('using cached version', out)
+		self.assertEqual(self.read(target), 'new content')
+		self.assertEqual(self.cache.url_entry('https://example.com/app.zip')['validator'], '"2"')
+
+	def test_content_without_validator_is_downloaded_again(self):
+		self.etag = None
+		target = os.path.join(self.tmpdir, 'app.zip')
+		self.download('https://example.com/app.zip', target)
+		self.download('https://example.com/app.zip', target)
+		self.assertEqual(self.session.get.call_count, 2)
+
+	def test_offline_uses_the_cached_copy(self):
+		target = os.path.join(self.tmpdir, 'app.zip')
+		self.download('https://example.com/app.zip', target)
+		self.content, self.etag = b'new content', '"2"'
+		out = self.download('https://example.com/app.zip', target, offline=True)
+		self.assertIn('using cached version', out)
+		self.assertEqual(self.session.head.call_count, 0)
+
+	def test_unreachable_server_uses_the_cached_copy(self):
+		target = os.path.join(self.tmpdir, 'app.zip')
+		self.download('https://example.com/app.zip', target)
+		self.session.head.side_effect = requests.exceptions.ConnectionError('unreachable')
+		out = self.download('https://example.com/app.zip', target)
+		self.assertIn('using cached version', out)
+
+	def test_entries_without_validator_are_revalidated(self):
+		# As written before validators were recorded
+		digest = self.cache.store('https://example.com/app.zip', self.write('old', 'old'))
+		with open(self.cache.url_path('https://example.com/app.zip'), 'w') as f:
+			f.write(digest)
+		self.assertEqual(self.cache.lookup('https://example.com/app.zip'), digest)
+		target = os.path.join(self.tmpdir, 'app.zip')
+		self.download('https://example.com/app.zip', target)
+		self.assertEqual(self.read(target), 'content')
+
+	def test_pinned_digest_mismatch_fails(self):
+		target = os.path.join(self.tmpdir, 'app.zip')
+		with self.assertRaises(SystemExit):
+			self.download('https://example.com/app.zip', target, sha256='0' * 64)
+		self.assertIsNone(self.cache.lookup('https://example.com/app.zip'))
+
+	def test_reusing_a_target_does_not_change_the_cached_object(self):
+		self.content = b'old'
+		target = os.path.join(self.tmpdir, 'blob.tgz')
+		self.download('https://example.com/old.tgz', target)
+		self.download('https://example.com/old.tgz', target)
+		self.download(self.write('new', 'new'), target)
+		self.assertEqual(self.read(target), 'new')
+		digest = self.cache.lookup('https://example.com/old.tgz')
+		self.assertEqual(cache.sha256_file(self.cache.object_path(digest)), digest)
+
+	def test_local_files_are_not_cached(self):
+		source = self.write('source', 'content')
+		util.download(source, os.path.join(self.tmpdir, 'target'), self.cache)
+		self.assertEqual(self.cache.entries(), [])
+
+if __name__ == '__main__':
+	unittest.main()
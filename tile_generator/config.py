@@ -22,15 +22,26 @@ import copy
 import cerberus
 import os.path
 import sys
-import yaml
 import re
-import requests
 from collections import OrderedDict
+from . import config_cache
 from . import package_definitions
+from . import stemcell
 from . import template
+from . import version_cache
+from . import yaml_util
 
 CONFIG_FILE = "tile.yml"
 HISTORY_FILE = "tile-history.yml"
+LOCK_FILE = "tile-lock.yml"
+
+# Keys set on the Config before tile.yml is validated, that are not part of the tile
+INTERNAL_KEYS = ['history', 'version_lock', 'offline']
+# Keys that are read or set afresh on every run, rather than cached with the transformed config
+UNCACHED_KEYS = ['history', 'offline']
+# Stands in for a latest version that is not known offline, when the
+# configuration is only being reported (e.g. by tile expand)
+UNRESOLVED_VERSION = 'latest'
 
 # The Config object describes exactly what the Tile Generator is going to generate.
 # It starts with a minimal configuration passed in as keyword arguments or read
@@ -105,6 +116,10 @@ class Config(dict):
 		# list of options in the schema it has to be set to pass
 		self._validator.allow_unknown = True
 
+		# Names of versions left as UNRESOLVED_VERSION, see set_unresolved_ok()
+		self.unresolved_ok = False
+		self.unresolved = []
+
 		self._package_defs = dict()
 		# Nasty way of mapping package types to the relevant classes
 		# reall should be explictly importing them
@@ -134,9 +149,19 @@ class Config(dict):
 		}
 
 	def read(self):
+		cache = config_cache.ConfigCache(CONFIG_FILE, LOCK_FILE, offline=self.get('offline', False))
+		cached = cache.load()
+		if cached is not None:
+			self.update(cached)
+			self.read_history()
+			return self
 		self.read_config()
+		files = config_cache.referenced_files(dict(self))
 		self.read_history()
+		self.read_lock()
 		self.transform()
+		if not self.unresolved:
+			cache.save(dict((k, v) for k, v in self.items() if k not in UNCACHED_KEYS), files)
 		return self
 
 	def read_config(self):
@@ -154,6 +179,13 @@ class Config(dict):
 		except IOError as e:
 			self['history'] = {}
 
+	def read_lock(self):
+		try:
+			with open(LOCK_FILE) as lock_file:
+				self['version_lock'] = read_yaml(lock_file) or {}
+		except IOError as e:
+			pass
+
 	def transform(self):
 		self.validate()
 		self.upgrade()
@@ -242,7 +274,7 @@ class Config(dict):
 
 		# Because we are populating the config with internal data structures. We have to pass 
 		# any additionally unknown keys semi-manually to tile_metadata class.
-		unknown_keys = list(set(self) - set(schema.keys()) - set(['history']))
+		unknown_keys = list(set(self) - set(schema.keys()) - set(INTERNAL_KEYS))
 		if unknown_keys:
 			self['unknown_keys'] = unknown_keys
 
@@ -312,32 +344,37 @@ class Config(dict):
 		stemcell_criteria['version'] = stemcell_criteria.get('version', self.latest_stemcell(stemcell_criteria['os']))
 		return stemcell_criteria
 
+	def version_cache(self):
+		return version_cache.VersionCache(offline=self.get('offline', False))
+
 	def latest_stemcell(self, os):
-		if os == 'ubuntu-jammy':
-			headers = { 'Accept': 'application/json' }
-			response = requests.get('https://network.pivotal.io/api/v2/products/stemcells-ubuntu-jammy/releases', headers=headers)
-			response.raise_for_status()
-			releases = response.json()['releases']
-			versions = [r['version'] for r in releases]
-			latest_major = sorted(versions, key=float)[-1].split('.')[0]
-			return latest_major
-		elif os == 'ubuntu-xenial':
-			headers = { 'Accept': 'application/json' }
-			response = requests.get('https://network.pivotal.io/api/v2/products/stemcells-ubuntu-xenial/releases', headers=headers)
-			response.raise_for_status()
-			releases = response.json()['releases']
-			versions = [r['version'] for r in releases]
-			latest_major = sorted(versions, key=float)[-1].split('.')[0]
-			return latest_major
-		elif os == 'ubuntu-trusty':
-			headers = { 'Accept': 'application/json' }
-			response = requests.get('https://network.pivotal.io/api/v2/products/stemcells/releases', headers=headers)
-			response.raise_for_status()
-			releases = response.json()['releases']
-			versions = [r['version'] for r in releases]
-			latest_major = sorted(versions, key=float)[-1].split('.')[0]
-			return latest_major
-		return None # TODO - Look for latest on bosh.io for given os
+		try:
+			return stemcell.latest_stemcell(os, self.version_cache())
+		except version_cache.OfflineError:
+			if self.unresolved_ok:
+				return self.leave_unresolved('the latest {} stemcell'.format(os))
+			raise Exception('The latest {} stemcell is not known offline; pin stemcell_criteria.version in {} or build once online'.format(os, CONFIG_FILE))
+
+	def resolve_version(self, name, resolve):
+		"""Return the version of name pinned in the lock file, resolving and pinning it if there is none.
+
+		resolve is called with a VersionCache, and only when name is not pinned.
+		"""
+		lock = self.setdefault('version_lock', {})
+		if name not in lock:
+			try:
+				lock[name] = resolve(self.version_cache())
+			except version_cache.OfflineError:
+				if self.unresolved_ok:
+					# Not pinned: a placeholder must never end up in the lock file
+					return self.leave_unresolved('the latest {} version'.format(name))
+				raise Exception('The latest {} version is not known offline; pin it in {} or build once online'.format(name, LOCK_FILE))
+		return lock[name]
+
+	def leave_unresolved(self, what):
+		print('Warning:', what, 'is not known offline, using "{}" in its place'.format(UNRESOLVED_VERSION), file=sys.stderr)
+		self.unresolved.append(what)
+		return UNRESOLVED_VERSION
 
 	def _build_instance_definition(self, job):
 		instance_def = {
@@ -413,17 +450,59 @@ class Config(dict):
 		with open(HISTORY_FILE, 'wb') as history_file:
 			write_yaml(history_file, self['history'])
 
+	def save_lock(self):
+		lock = self.get('version_lock')
+		if lock:
+			template.write_if_changed(LOCK_FILE, yaml_util.dump(lock, default_flow_style=False, explicit_start=True, encoding='utf-8'))
+
+	def set_offline(self, offline=True):
+		self['offline'] = offline
+
+	def set_unresolved_ok(self, unresolved_ok=True):
+		self.unresolved_ok = unresolved_ok
+
 	def set_verbose(self, verbose=True):
 		self['verbose'] = verbose
 
 	def set_sha1(self, sha1=True):
 		self['sha1'] = sha1
 
-	def set_cache(self, cache=None):
+	def set_build_jobs(self, jobs=1):
+		self['build_jobs'] = max(jobs, 1)
+
+	def set_download_jobs(self, jobs=4, segments=1):
+		self['download_jobs'] = max(jobs, 1)
+		self['download_segments'] = max(segments, 1)
+
+	def set_compress_images(self, compress=True):
+		self['compress_images'] = compress
+
+	def set_native_release(self, native=True):
+		self['native_release'] = native
+
+	def set_force(self, force=True):
+		self['force'] = force
+
+	def set_explain(self, explain=True):
+		self['explain'] = explain
+
+	def set_reproducible(self, reproducible=True):
+		self['reproducible'] = reproducible
+
+	def set_keep_staging(self, keep_staging=True):
+		self['keep_staging'] = keep_staging
+
+	def set_compression_level(self, level=None):
+		if level is not None:
+			self['compression_level'] = min(max(level, 0), 9)
+
+	def set_cache(self, cache=None, max_size=None):
 		if cache is not None:
 			cache = os.path.realpath(os.path.expanduser(cache))
 			self['docker_cache'] = cache
 			self['cache'] = cache
+			if max_size is not None:
+				self['cache_max_size'] = max_size
 
 	def upgrade(self):
 		# v0.9 specified auto_services as a space-separated string of service names
@@ -437,7 +516,7 @@ class Config(dict):
 			if package.get('type') == 'docker-bosh':
 				manifest = package.get('manifest')
 				if manifest is not None and isinstance(manifest, str):
-					package['manifest'] = yaml.safe_load(manifest)
+					package['manifest'] = yaml_util.load(manifest)
 		# first releases required manifests to be multi-line strings, now we want them to be dicts
 		for package in self.get('packages', []):
 			manifest = package.get('manifest', None)
@@ -495,10 +574,10 @@ class Config(dict):
 		self['version'] = version
 
 def read_yaml(file):
-	return yaml.safe_load(file)
+	return yaml_util.load(file)
 
 def write_yaml(file, data):
-	file.write(yaml.safe_dump(data, default_flow_style=False, explicit_start=True, encoding='utf-8'))
+	file.write(yaml_util.dump(data, default_flow_style=False, explicit_start=True, encoding='utf-8'))
 
 def is_semver(version):
 	valid = re.compile('[0-9]+\\.[0-9]+\\.[0-9]+([\\-+][0-9a-zA-Z]+(\\.[0-9a-zA-Z]+)*)*$')
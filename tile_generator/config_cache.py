@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+# tile-generator
+#
+# Copyright (c) 2015-Present Pivotal Software, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+from . import build_state
+from .cache import sha256_file, user_cache_dir
+from .version import version_string
+from .version_cache import DEFAULT_TTL
+
+# Config.read() validates and transforms tile.yml from scratch, which for
+# a large tile takes seconds. The transformed config is stored as JSON,
+# one entry per tile, and reused while none of its inputs changed:
+#
+#   tile.yml and tile-lock.yml      by content
+#   files tile.yml names            by size and mtime (icon, package paths, manifests, charts, ...)
+#   tile-generator itself           by version, and size and mtime of its code
+#
+# The transformed config also holds the latest stemcell version, so
+# entries expire with the version cache TTL, except when offline.
+#
+# The cache directory may be shared (e.g. a CI volume), so entries are
+# plain data that can't run code when loaded. A config that JSON can't
+# represent exactly is not cached.
+
+PATH = os.path.dirname(os.path.realpath(__file__))
+
+def cache_dir():
+	return user_cache_dir('configs', 'TILE_GENERATOR_CONFIG_CACHE')
+
+def tool_digest():
+	if tool_digest.digest is None:
+		entries = [version_string]
+		for root, dirs, files in os.walk(PATH):
+			dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+			in_templates = os.path.relpath(root, PATH).split(os.sep)[0] == 'templates'
+			for name in sorted(files):
+				if in_templates or name.endswith('.py'):
+					stat = os.stat(os.path.join(root, name))
+					entries.append([os.path.relpath(os.path.join(root, name), PATH), stat.st_size, stat.st_mtime_ns])
+		tool_digest.digest = build_state.digest(entries)
+	return tool_digest.digest
+
+tool_digest.digest = None
+
+def is_local_path(value):
+	if not isinstance(value, str) or not value or '\n' in value:
+		return False
+	try:
+		return os.path.exists(value)
+	except ValueError:
+		return False
+
+def referenced_files(raw):
+	"""Return the local files and directories a raw tile.yml names, that transform() reads.
+
+	Only the keys that name files are looked at: the icon, and the path,
+	manifest, pre_start_file and files of each package (app bundles,
+	bosh releases and Helm charts).
+	"""
+	paths = [raw.get('icon_file')]
+	for package in raw.get('packages') or []:
+		if not isinstance(package, dict):
+			continue
+		paths += [package.get('path'), package.get('pre_start_file')]
+		manifest = package.get('manifest')
+		paths.append(manifest.get('path') if isinstance(manifest, dict) else manifest)
+		paths += [f.get('path') for f in package.get('files') or [] if isinstance(f, dict)]
+	return set(path for path in paths if is_local_path(path))
+
+def sha256_if_exists(path):
+	try:
+		return sha256_file(path)
+	except IOError:
+		return None
+
+class ConfigCache:
+
+	def __init__(self, config_file, lock_file, directory=None, ttl=DEFAULT_TTL, offline=False):
+		self.config_file = config_file
+		self.lock_file = lock_file
+		self.ttl = ttl
+		self.offline = offline
+		directory = cache_dir() if directory is None else directory
+		self.path = None
+		if directory:
+			name = hashlib.sha256(os.path.realpath(config_file).encode('utf-8')).hexdigest()
+			self.path = os.path.join(directory, name + '.json')
+		self.key = None
+
+	def inputs_key(self):
+		config = sha256_if_exists(self.config_file)
+		if config is None:
+			return None
+		return build_state.digest([config, sha256_if_exists(self.lock_file), tool_digest()])
+
+	def load(self):
+		"""Return the transformed config cached for this tile, or None."""
+		if self.path is None:
+			return None
+		self.key = self.inputs_key()
+		if self.key is None:
+			return None
+		try:
+			with open(self.path) as f:
+				entry = json.load(f)
+		except (IOError, ValueError):
+			# Missing or partial
+			return None
+		if not isinstance(entry, dict) or entry.get('key') != self.key:
+			return None
+		if not isinstance(entry.get('files'), dict) or not isinstance(entry.get('config'), dict):
+			return None
+		if not self.offline and time.time() - entry.get('created', 0) >= self.ttl:
+			return None
+		try:
+			for path, digest in entry['files'].items():
+				if build_state.file_digest(path) != digest:
+					return None
+		except OSError:
+			return None
+		return entry['config']
+
+	def save(self, config, files):
+		if self.path is None or self.key is None:
+			return
+		try:
+			entry = {
+				'key': self.key,
+				'created': time.time(),
+				'files': dict((path, build_state.file_digest(path)) for path in sorted(files)),
+				'config': config,
+			}
+			content = json.dumps(entry)
+		except (OSError, TypeError, ValueError):
+			return
+		# e.g. tuples and non-string keys would come back changed
+		if json.loads(content)['config'] != config:
+			return
+		staged = None
+		try:
+			directory = os.path.dirname(self.path)
+			os.makedirs(directory, exist_ok=True)
+			fd, staged = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+			with os.fdopen(fd, 'w') as f:
+				f.write(content)
+			os.rename(staged, self.path)
+		except OSError:
+			# Without a cache entry the next read just transforms again
+			if staged is not None and os.path.exists(staged):
+				os.remove(staged)
@@ -0,0 +1,198 @@
+# tile-generator
+#
+# Copyright (c) 2015-Present Pivotal Software, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import mock
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from . import config
+from . import config_cache
+from .config_cache import ConfigCache
+
+class TestConfigCache(unittest.TestCase):
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.tmpdir = tempfile.mkdtemp()
+		os.chdir(self.tmpdir)
+		self.directory = os.path.join(self.tmpdir, 'cache')
+		with open('tile.yml', 'w') as f:
+			f.write('name: my-tile\n')
+		with open('icon.png', 'wb') as f:
+			f.write(b'icon')
+		self.transformed = { 'name': 'my-tile', 'icon_file': 'aWNvbg==' }
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.tmpdir)
+
+	def cache(self, **kw):
+		return ConfigCache('tile.yml', 'tile-lock.yml', self.directory, **kw)
+
+	def store(self):
+		cache = self.cache()
+		self.assertIsNone(cache.load())
+		cache.save(self.transformed, ['icon.png'])
+
+	def test_hit(self):
+		self.store()
+		self.assertEqual(self.cache().load(), self.transformed)
+
+	def test_config_changed(self):
+		self.store()
+		with open('tile.yml', 'a') as f:
+			f.write('label: My Tile\n')
+		self.assertIsNone(self.cache().load())
+
+	def test_lock_file_changed(self):
+		self.store()
+		with open('tile-lock.yml', 'w') as f:
+			f.write('helm: v2.16.1\n')
+		self.assertIsNone(self.cache().load())
+
+	def test_referenced_file_changed(self):
+		self.store()
+		with open('icon.png', 'wb') as f:
+			f.write(b'new icon')
+		self.assertIsNone(self.cache().load())
+
+	def test_referenced_file_removed(self):
+		self.store()
+		os.remove('icon.png')
+		self.assertIsNone(self.cache().load())
+
+	def test_tool_changed(self):
+		self.store()
+		with mock.patch('tile_generator.config_cache.tool_digest', return_value='other'):
+			self.assertIsNone(self.cache().load())
+
+	def test_expired(self):
+		self.store()
+		with mock.patch('time.time', return_value=time.time() + 2 * config_cache.DEFAULT_TTL):
+			self.assertIsNone(self.cache().load())
+			self.assertEqual(self.cache(offline=True).load(), self.transformed)
+
+	def test_corrupt_entry(self):
+		self.store()
+		cache = self.cache()
+		with open(cache.path, 'wb') as f:
+			f.write(b'\x80\x04not json')
+		self.assertIsNone(cache.load())
+
+	def test_entries_are_json(self):
+		self.store()
+		with open(self.cache().path) as f:
+			self.assertEqual(json.load(f)['config'], self.transformed)
+
+	def test_config_json_cannot_represent_is_not_cached(self):
+		cache = self.cache()
+		cache.load()
+		cache.save({ 'name': 'my-tile', 'ports': (80, 443) }, [])
+		self.assertFalse(os.path.exists(cache.path))
+		cache.save({ 'name': 'my-tile', 'instances': { 1: 'one' } }, [])
+		self.assertFalse(os.path.exists(cache.path))
+
+	def test_disabled(self):
+		cache = ConfigCache('tile.yml', 'tile-lock.yml', '')
+		self.assertIsNone(cache.load())
+		cache.save(self.transformed, [])
+		self.assertIsNone(cache.load())
+
+	def test_referenced_files(self):
+		os.mkdir('chart')
+		with open('pre-start.sh', 'w') as f:
+			f.write('#!/bin/sh\n')
+		raw = {
+			'icon_file': 'icon.png',
+			'packages': [
+				{ 'name': 'chart', 'path': 'chart' },
+				{ 'name': 'app', 'path': 'missing.zip', 'manifest': { 'path': 'icon.png' }, 'pre_start_file': 'pre-start.sh' },
+				{ 'name': 'binary', 'files': [{ 'name': 'binary', 'path': 'https://example.com/binary' }] },
+			],
+			'script': 'icon.png\nmore',
+			'instances': 1,
+		}
+		self.assertEqual(config_cache.referenced_files(raw), set(['icon.png', 'chart', 'pre-start.sh']))
+
+	def test_only_file_keys_are_referenced(self):
+		os.mkdir('chart')
+		raw = {
+			'icon_file': 'icon.png',
+			'properties': [{ 'name': 'root', 'type': 'string', 'default': '/' }, { 'name': 'cwd', 'default': '.' }],
+			'packages': [{ 'name': 'chart', 'type': 'bosh-release', 'jobs': [{ 'name': 'chart' }] }],
+		}
+		self.assertEqual(config_cache.referenced_files(raw), set(['icon.png']))
+
+	def test_dangling_symlink(self):
+		os.mkdir('chart')
+		os.symlink('missing', os.path.join('chart', 'link'))
+		cache = self.cache()
+		cache.load()
+		cache.save(self.transformed, ['chart'])
+		self.assertEqual(self.cache().load(), self.transformed)
+
+@mock.patch('tile_generator.config.Config.latest_stemcell', return_value='1234')
+class TestCachedRead(unittest.TestCase):
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.tmpdir = tempfile.mkdtemp()
+		os.chdir(self.tmpdir)
+		with open('icon.png', 'wb') as f:
+			f.write(b'icon')
+		with open('tile.yml', 'w') as f:
+			f.write('name: my-tile\nlabel: My Tile\ndescription: A tile\nicon_file: icon.png\n')
+		with open('tile-history.yml', 'w') as f:
+			f.write('version: 1.0.0\n')
+		self.environ = mock.patch.dict(os.environ, { 'TILE_GENERATOR_CONFIG_CACHE': os.path.join(self.tmpdir, 'cache') })
+		self.environ.start()
+
+	def tearDown(self):
+		self.environ.stop()
+		os.chdir(self.cwd)
+		shutil.rmtree(self.tmpdir)
+
+	def test_second_read_skips_transform(self, mock_latest_stemcell):
+		expected = config.Config().read()
+		with mock.patch('tile_generator.config.Config.transform') as transform:
+			cached = config.Config().read()
+			transform.assert_not_called()
+		self.assertEqual(cached, expected)
+
+	def test_history_is_read_every_time(self, mock_latest_stemcell):
+		config.Config().read()
+		with open('tile-history.yml', 'w') as f:
+			f.write('version: 1.0.1\n')
+		self.assertEqual(config.Config().read()['history'], { 'version': '1.0.1' })
+
+	def test_offline_is_not_cached(self, mock_latest_stemcell):
+		cfg = config.Config()
+		cfg.set_offline()
+		cfg.read()
+		self.assertNotIn('offline', config.Config().read())
+
+	def test_unresolved_versions_are_not_cached(self, mock_latest_stemcell):
+		cfg = config.Config()
+		mock_latest_stemcell.side_effect = lambda os: cfg.leave_unresolved('the latest stemcell')
+		with mock.patch('sys.stderr'):
+			cfg.read()
+		self.assertEqual(cfg['stemcell_criteria']['version'], config.UNRESOLVED_VERSION)
+		mock_latest_stemcell.side_effect = None
+		self.assertEqual(config.Config().read()['stemcell_criteria']['version'], '1234')
+
+if __name__ == '__main__':
+	unittest.main()
@@ -17,6 +17,7 @@
 import mock
 import json
 import os
+import shutil
 import unittest
 import sys
 import tempfile
@@ -41,8 +42,22 @@ def capture_output():
     sys.stdout, sys.stderr = old_out, old_err
 
 
+@contextmanager
+def stemcell_fixture():
+  cache_dir = tempfile.mkdtemp()
+  fixture = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_stemcell_releases.json')
+  try:
+    with mock.patch.dict(os.environ, { 'TILE_GENERATOR_STEMCELL_RELEASES': fixture, 'TILE_GENERATOR_VERSION_CACHE': cache_dir }):
+      yield
+  finally:
+    shutil.rmtree(cache_dir)
+
+
 class BaseTest(unittest.TestCase):
   def setUp(self):
+    self.config_cache_patcher = mock.patch.dict(os.environ, { 'TILE_GENERATOR_CONFIG_CACHE': '' })
+    self.config_cache_patcher.start()
+
     self.latest_stemcell_patcher = mock.patch('tile_generator.config.Config.latest_stemcell', return_value='1234')
     self.latest_stemcell = self.latest_stemcell_patcher.start()
 
@@ -55,6 +70,7 @@ class BaseTest(unittest.TestCase):
     self.pre_start_file = tempfile.NamedTemporaryFile()
 
   def tearDown(self):
+    self.config_cache_patcher.stop()
     self.latest_stemcell_patcher.stop()
     self._update_compilation_vm_disk_size_patcher.stop()
     self.icon_file.close()
@@ -200,13 +216,54 @@ class TestConfigValidation(BaseTest):
     # Disable patching latest_stemcell
     self.latest_stemcell_patcher.stop()
 
-    self.config.validate()
+    with stemcell_fixture():
+      self.config.validate()
 
     # Enable so that tearDown does not barf
     self.latest_stemcell_patcher.start()
 
-    # Ensure we are using the real latest_stemcell
-    self.assertNotEqual(self.config['stemcell_criteria']['version'], '1234')
+    # Ensure we are using the real latest_stemcell, answered by the fixture
+    self.assertEqual(self.config['stemcell_criteria']['version'], '1')
+
+  def test_latest_stemcell_offline_uses_last_known(self):
+    self.latest_stemcell_patcher.stop()
+    with stemcell_fixture():
+      self.assertEqual(self.config.latest_stemcell('ubuntu-xenial'), '621')
+      self.config.set_offline()
+      with mock.patch('tile_generator.stemcell.FileSource.releases') as releases:
+        self.assertEqual(self.config.latest_stemcell('ubuntu-xenial'), '621')
+        releases.assert_not_called()
+    self.latest_stemcell_patcher.start()
+
+  def test_latest_stemcell_offline_requires_cached(self):
+    self.latest_stemcell_patcher.stop()
+    self.config.set_offline()
+    with stemcell_fixture():
+      with self.assertRaises(Exception) as context:
+        self.config.latest_stemcell('ubuntu-jammy')
+    self.latest_stemcell_patcher.start()
+    self.assertIn('stemcell_criteria.version', str(context.exception))
+
+  def test_latest_stemcell_offline_can_be_left_unresolved(self):
+    self.latest_stemcell_patcher.stop()
+    self.config.set_offline()
+    self.config.set_unresolved_ok()
+    with stemcell_fixture():
+      with capture_output() as (out, err):
+        self.assertEqual(self.config.latest_stemcell('ubuntu-jammy'), config.UNRESOLVED_VERSION)
+    self.latest_stemcell_patcher.start()
+    self.assertIn('ubuntu-jammy stemcell is not known offline', err.getvalue())
+    self.assertEqual(self.config.unresolved, ['the latest ubuntu-jammy stemcell'])
+
+  def test_offline_is_not_a_tile_key(self):
+    self.config.set_offline()
+    self.config.validate()
+    self.assertNotIn('offline', self.config.get('unknown_keys', []))
+
+  def test_version_lock_is_not_a_tile_key(self):
+    self.config['version_lock'] = {}
+    self.config.validate()
+    self.assertNotIn('version_lock', self.config.get('unknown_keys', []))
 
   def test_requires_package_names(self):
     with self.assertRaises(SystemExit):
@@ -422,6 +479,65 @@ containers:
     self.assertEqual([r['name'] for r in self.config['releases'].values()],
       ['z_name', 'd_name', 'a_name', 'b_name'])
 
+class TestVersionLock(BaseTest):
+  def setUp(self):
+    super(TestVersionLock, self).setUp()
+    self.cwd = os.getcwd()
+    self.tmpdir = tempfile.mkdtemp()
+    os.chdir(self.tmpdir)
+    self.resolve = mock.Mock(return_value='v2.16.1')
+
+  def tearDown(self):
+    os.chdir(self.cwd)
+    shutil.rmtree(self.tmpdir)
+    super(TestVersionLock, self).tearDown()
+
+  def test_resolves_and_pins(self):
+    with stemcell_fixture():
+      self.assertEqual(self.config.resolve_version('helm', self.resolve), 'v2.16.1')
+      self.assertEqual(self.config.resolve_version('helm', self.resolve), 'v2.16.1')
+    self.assertEqual(self.resolve.call_count, 1)
+    self.config.save_lock()
+    with open(config.LOCK_FILE) as f:
+      self.assertEqual(yaml.safe_load(f), { 'helm': 'v2.16.1' })
+
+  def test_lock_file_wins(self):
+    with open(config.LOCK_FILE, 'w') as f:
+      f.write('helm: v2.9.0\n')
+    self.config.read_lock()
+    self.assertEqual(self.config.resolve_version('helm', self.resolve), 'v2.9.0')
+    self.resolve.assert_not_called()
+
+  def test_offline_replays_lock_file(self):
+    with open(config.LOCK_FILE, 'w') as f:
+      f.write('kubectl: v1.17.0\n')
+    self.config.read_lock()
+    self.config.set_offline()
+    self.assertEqual(self.config.resolve_version('kubectl', self.resolve), 'v1.17.0')
+
+  def test_offline_without_pin(self):
+    self.config.set_offline()
+    with stemcell_fixture():
+      with self.assertRaises(Exception) as context:
+        self.config.resolve_version('helm', lambda cache: cache.resolve('helm', self.resolve))
+    self.assertIn(config.LOCK_FILE, str(context.exception))
+    self.resolve.assert_not_called()
+
+  def test_offline_without_pin_can_be_left_unresolved(self):
+    self.config.set_offline()
+    self.config.set_unresolved_ok()
+    with stemcell_fixture():
+      with capture_output() as (out, err):
+        self.assertEqual(self.config.resolve_version('helm', lambda cache: cache.resolve('helm', self.resolve)), config.UNRESOLVED_VERSION)
+    self.assertIn('helm version is not known offline', err.getvalue())
+    self.assertNotIn('helm', self.config['version_lock'])
+
+  def test_no_lock_file_without_pins(self):
+    self.config.read_lock()
+    self.config.save_lock()
+    self.assertFalse(os.path.exists(config.LOCK_FILE))
+
+
 class TestVersionMethods(BaseTest):
 
   def test_accepts_valid_semver(self):
@@ -20,7 +20,7 @@
 import os
 import sys
 import errno
-import yaml
+from . import yaml_util
 import json
 from . import opsmgr
 import random
@@ -83,7 +83,7 @@ def mkdir_p(dir):
 def get_file_properties(filename):
     try:
         with open(filename) as f:
-            properties = yaml.safe_load(f)
+            properties = yaml_util.load(f)
             if properties is None:
                 return {}
             else:
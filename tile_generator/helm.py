@@ -1,9 +1,11 @@
 import os
 import sys
-import yaml
+from . import yaml_util
 import json
+from .version_cache import VersionCache
 
-import requests
+HELM_LATEST_RELEASE_URL = 'https://api.github.com/repos/kubernetes/helm/releases/latest'
+KUBECTL_STABLE_RELEASE_URL = 'https://storage.googleapis.com/kubernetes-release/release/stable.txt'
 
 def find_required_images(values):
     images = []
@@ -33,10 +35,10 @@ def find_required_images(values):
 def get_chart_info(chart_dir):
     chart_file = os.path.join(chart_dir, 'Chart.yaml')
     with open(chart_file) as f:
-        chart = yaml.safe_load(f)
+        chart = yaml_util.load(f)
     values_file = os.path.join(chart_dir, 'values.yaml')
     with open(values_file) as f:
-        chart_values = yaml.safe_load(f)
+        chart_values = yaml_util.load(f)
 
     return {
         'name': chart.get('name', chart.get('Name')),
@@ -44,17 +46,13 @@ def get_chart_info(chart_dir):
         'required_images': find_required_images(chart_values),
     }
 
-def get_latest_release_tag():
-    result = requests.get('https://api.github.com/repos/kubernetes/helm/releases/latest')
-    result.raise_for_status()
-    release = result.json()
-    return release['tag_name']
+def get_latest_release_tag(cache=None):
+    cache = cache or VersionCache()
+    return cache.resolve_url(HELM_LATEST_RELEASE_URL, lambda response: response.json()['tag_name'])
 
-def get_latest_kubectl_tag():
-    result = requests.get('https://storage.googleapis.com/kubernetes-release/release/stable.txt')
-    result.raise_for_status()
-    release = result.text.strip()
-    return release
+def get_latest_kubectl_tag(cache=None):
+    cache = cache or VersionCache()
+    return cache.resolve_url(KUBECTL_STABLE_RELEASE_URL, lambda response: response.text.strip())
 
 if __name__ == '__main__':
     for chart in sys.argv[1:]:
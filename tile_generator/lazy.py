@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+
+# tile-generator
+#
+# Copyright (c) 2015-Present Pivotal Software, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import importlib.util
+import sys
+
+# The `tile` and `pcf` entry points are run many times per CI pipeline,
+# often just to print their version or query a single endpoint. Heavy
+# modules are bound with lazy.module(), which returns the module object
+# straight away and only executes it on first attribute access.
+
+def module(name, package=None):
+	name = importlib.util.resolve_name(name, package)
+	if name in sys.modules:
+		return sys.modules[name]
+	spec = importlib.util.find_spec(name)
+	if spec is None:
+		raise ImportError('No module named ' + repr(name), name=name)
+	loader = importlib.util.LazyLoader(spec.loader)
+	spec.loader = loader
+	lazy = importlib.util.module_from_spec(spec)
+	sys.modules[name] = lazy
+	loader.exec_module(lazy)
+	parent, _, child = name.rpartition('.')
+	if parent:
+		setattr(sys.modules[parent], child, lazy)
+	return lazy
@@ -0,0 +1,89 @@
+# tile-generator
+#
+# Copyright (c) 2015-Present Pivotal Software, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import subprocess
+import sys
+import unittest
+
+REPO_PATH = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+# Modules the entry points may only load once a subcommand needs them
+HEAVY_MODULES = ['requests', 'requests_toolbelt', 'pexpect', 'cerberus', 'jinja2', 'yaml', 'docker']
+
+# Total import time allowed for `tile --version` or `pcf --help`, in
+# seconds. Loading the heavy modules eagerly took about 0.5s.
+STARTUP_BUDGET = 0.25
+
+def python(*args):
+	env = dict(os.environ, PYTHONPATH=REPO_PATH)
+	return subprocess.run([sys.executable] + list(args), cwd=REPO_PATH, env=env,
+		stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+def import_times(*args):
+	"""Return (module, cumulative seconds, is top level) for each import made by a run."""
+	result = python('-X', 'importtime', *args)
+	imports = []
+	for line in result.stderr.splitlines():
+		if not line.startswith('import time:') or 'cumulative' in line:
+			continue
+		self_us, cumulative_us, name = line[len('import time:'):].split('|')
+		# Nested imports are indented below the module that made them
+		imports.append((name.strip(), int(cumulative_us) / 1000000.0, not name[1:].startswith(' ')))
+	return imports
+
+def startup_time(imports):
+	# site is imported by the interpreter before any of our code runs
+	return sum(seconds for module, seconds, top_level in imports if top_level and module != 'site')
+
+class TestLazyModule(unittest.TestCase):
+	def test_module_is_loaded_on_first_use(self):
+		result = python('-c',
+			'import sys\n'
+			'from tile_generator import lazy\n'
+			'helm = lazy.module(".helm", "tile_generator")\n'
+			'print("requests" in sys.modules)\n'
+			'print(callable(helm.get_chart_info))\n'
+			'print("requests" in sys.modules)\n'
+			'print(lazy.module("tile_generator.helm") is helm)\n')
+		self.assertEqual(result.stdout.split(), ['False', 'True', 'True', 'True'])
+
+	def test_missing_module(self):
+		from . import lazy
+		with self.assertRaises(ImportError):
+			lazy.module('.no_such_module', __package__)
+
+class TestStartup(unittest.TestCase):
+	def assertLightweight(self, *args):
+		imports = import_times(*args)
+		modules = set(module for module, seconds, top_level in imports)
+		self.assertEqual(sorted(modules.intersection(HEAVY_MODULES)), [])
+		self.assertLess(startup_time(imports), STARTUP_BUDGET)
+
+	def test_tile_version(self):
+		self.assertLightweight('-m', 'tile_generator.tile', '--version')
+
+	def test_tile_help(self):
+		self.assertLightweight('-m', 'tile_generator.tile', '--help')
+
+	def test_pcf_version(self):
+		self.assertLightweight('-m', 'tile_generator.pcf', '--version')
+
+	def test_pcf_help(self):
+		self.assertLightweight('-m', 'tile_generator.pcf', '--help')
+
+if __name__ == '__main__':
+	unittest.main()
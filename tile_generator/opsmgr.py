@@ -20,6 +20,7 @@
 
 import fcntl
 import glob
+import gzip
 import json
 import os
 import signal
@@ -28,11 +29,10 @@ import subprocess
 import sys
 import tempfile
 import termios
+import threading
 import time
-import yaml
+from . import yaml_util
 
-from pexpect import pxssh
-from requests_toolbelt import MultipartEncoderMonitor
 try:
 	# Python 3
 	from urllib.parse import urlparse
@@ -41,7 +41,6 @@ except ImportError:
 	from urllib.parse import urlparse
 
 import requests
-requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
 
 
 def find_credentials(target):
@@ -94,7 +93,7 @@ def get_credentials(target=None, non_interactive=False):
 		credential_file = 'metadata'
 	try:
 		with open(credential_file) as cred_file:
-			creds = yaml.safe_load(cred_file)
+			creds = yaml_util.load(cred_file)
 			if is_poolsmiths_env(creds):
 				creds['opsmgr'] = creds['ops_manager']
 				creds['opsmgr']['ssh_key'] = creds['ops_manager_private_key']
@@ -122,67 +121,196 @@ get_credentials.credentials = None
 def set_credentials(credentials):
 	get_credentials.credentials = credentials
 
-class auth(requests.auth.AuthBase):
-
-	def __init__(self, creds):
-		self.creds = creds
-
-	def __call__(self, request):
-		url = self.creds.get('opsmgr').get('url') + '/uaa/oauth/token'
-		username = self.creds.get('opsmgr').get('username')
-		password = self.creds.get('opsmgr').get('password')
+class TokenCache:
+	"""UAA access tokens, keyed by Ops Manager url and username.
+
+	Tokens are refreshed `refresh_margin` seconds before UAA says they
+	expire, so long running loops like logs() never race the expiry.
+	`fetch_count` counts the token grants actually requested from UAA.
+	"""
+
+	def __init__(self, refresh_margin=60):
+		self.refresh_margin = refresh_margin
+		self.fetch_count = 0
+		self._tokens = {}
+		self._lock = threading.Lock()
+
+	def key(self, creds):
+		opsmgr = creds.get('opsmgr')
+		return (opsmgr.get('url'), opsmgr.get('username'))
+
+	def get(self, creds):
+		key = self.key(creds)
+		with self._lock:
+			token = self._tokens.get(key)
+			if token is not None and time.time() < token['refresh_at']:
+				return token['authorization']
+			token = self.fetch(creds)
+			if token is None:
+				self._tokens.pop(key, None)
+				return None
+			self._tokens[key] = token
+			return token['authorization']
+
+	def invalidate(self, creds):
+		with self._lock:
+			self._tokens.pop(self.key(creds), None)
+
+	def clear(self):
+		with self._lock:
+			self._tokens.clear()
+			self.fetch_count = 0
+
+	def fetch(self, creds):
+		url = creds.get('opsmgr').get('url') + '/uaa/oauth/token'
 		headers = { 'Accept': 'application/json' }
 		data = {
 			'grant_type': 'password',
 			'client_id': 'opsman',
 			'client_secret': '',
-			'username': username,
-			'password': password,
+			'username': creds.get('opsmgr').get('username'),
+			'password': creds.get('opsmgr').get('password'),
 			'response_type': 'token',
 		}
-		response = requests.post(url, data=data, verify=False, headers=headers)
+		self.fetch_count += 1
+		response = get_client().request('POST', url, data=data, headers=headers)
 		if response.status_code != requests.codes.ok:
-			return requests.auth.HTTPBasicAuth(username, password)(request)
+			return None
 		response = response.json()
-		access_token = response.get('access_token')
-		token_type = response.get('token_type')
-		request.headers['Authorization'] = token_type + ' ' + access_token
+		expires_in = response.get('expires_in', 0)
+		return {
+			'authorization': response.get('token_type') + ' ' + response.get('access_token'),
+			'refresh_at': time.time() + max(int(expires_in) - self.refresh_margin, 0),
+		}
+
+token_cache = TokenCache()
+
+def token_fetch_count():
+	return token_cache.fetch_count
+
+class auth(requests.auth.AuthBase):
+
+	def __init__(self, creds, cache=None):
+		self.creds = creds
+		self.cache = cache if cache is not None else token_cache
+
+	def __call__(self, request):
+		authorization = self.cache.get(self.creds)
+		if authorization is None:
+			username = self.creds.get('opsmgr').get('username')
+			password = self.creds.get('opsmgr').get('password')
+			return requests.auth.HTTPBasicAuth(username, password)(request)
+		request.headers['Authorization'] = authorization
+		request.register_hook('response', self.handle_401)
 		return request
 
-def get(url, stream=False, check=True):
+	def handle_401(self, response, **kwargs):
+		# The cached token was revoked or expired early (e.g. Ops Manager
+		# restarted); re-authenticate and replay the request exactly once.
+		if response.status_code != 401 or hasattr(response.request.body, 'read'):
+			return response
+		self.cache.invalidate(self.creds)
+		authorization = self.cache.get(self.creds)
+		if authorization is None:
+			return response
+		response.content
+		response.close()
+		retry = response.request.copy()
+		retry.deregister_hook('response', self.handle_401)
+		retry.headers['Authorization'] = authorization
+		retried = response.connection.send(retry, **kwargs)
+		retried.history.append(response)
+		retried.request = retry
+		return retried
+
+class Client:
+	"""Shared, keep-alive HTTP session for all Ops Manager traffic.
+
+	Connections are pooled per host, so a command that makes a dozen
+	calls pays for a single TCP+TLS handshake. Time spent in each request
+	is accumulated per method in `latency`.
+	"""
+
+	def __init__(self, pool_size=10, timeout=None, retries=0):
+		self.timeout = timeout
+		self.latency = {}
+		self.session = requests.Session()
+		self.session.verify = False
+		requests.packages.urllib3.disable_warnings(requests.packages.urllib3.exceptions.InsecureRequestWarning)
+		adapter = requests.adapters.HTTPAdapter(
+			pool_connections=pool_size,
+			pool_maxsize=pool_size,
+			max_retries=retries)
+		self.session.mount('https://', adapter)
+		self.session.mount('http://', adapter)
+
+	def request(self, method, url, **kwargs):
+		kwargs.setdefault('timeout', self.timeout)
+		start = time.time()
+		try:
+			return self.session.request(method, url, **kwargs)
+		finally:
+			self.record(method, time.time() - start)
+
+	def record(self, method, seconds):
+		stats = self.latency.setdefault(method, { 'count': 0, 'total': 0.0, 'max': 0.0 })
+		stats['count'] += 1
+		stats['total'] += seconds
+		stats['max'] = max(stats['max'], seconds)
+
+	def report(self):
+		lines = []
+		for method in sorted(self.latency):
+			stats = self.latency[method]
+			lines.append('{} {} requests, {:.3f}s total, {:.3f}s avg, {:.3f}s max'.format(
+				method, stats['count'], stats['total'], stats['total'] / stats['count'], stats['max']))
+		return '\n'.join(lines)
+
+	def close(self):
+		self.session.close()
+
+def get_client():
+	if get_client.client is None:
+		get_client.client = Client()
+	return get_client.client
+
+get_client.client = None
+
+def configure_client(pool_size=10, timeout=None, retries=0):
+	if get_client.client is not None:
+		get_client.client.close()
+	get_client.client = Client(pool_size=pool_size, timeout=timeout, retries=retries)
+	return get_client.client
+
+def request(method, url, **kwargs):
 	creds = get_credentials()
 	url = creds.get('opsmgr').get('url') + url
+	return get_client().request(method, url, auth=auth(creds), **kwargs)
+
+def get(url, stream=False, check=True):
 	headers = { 'Accept': 'application/json' }
-	response = requests.get(url, auth=auth(creds), verify=False, headers=headers, stream=stream)
+	response = request('GET', url, headers=headers, stream=stream)
 	check_response(response, check=check)
 	return response
 
 def put(url, payload, check=True):
-	creds = get_credentials()
-	url = creds.get('opsmgr').get('url') + url
-	response = requests.put(url, auth=auth(creds), verify=False, data=payload)
+	response = request('PUT', url, data=payload)
 	check_response(response, check=check)
 	return response
 
 def put_json(url, payload):
-	creds = get_credentials()
-	url = creds.get('opsmgr').get('url') + url
-	response = requests.put(url, auth=auth(creds), verify=False, json=payload)
+	response = request('PUT', url, json=payload)
 	check_response(response)
 	return response
 
 def post(url, payload, files=None, check=True):
-	creds = get_credentials()
-	url = creds.get('opsmgr').get('url') + url
-	response = requests.post(url, auth=auth(creds), verify=False, data=payload, files=files)
+	response = request('POST', url, data=payload, files=files)
 	check_response(response, check)
 	return response
 
 def post_yaml(url, filename, payload):
-	creds = get_credentials()
-	url = creds.get('opsmgr').get('url') + url
-	files = { filename: yaml.safe_dump(payload) }
-	response = requests.post(url, auth=auth(creds), verify=False, files=files)
+	files = { filename: yaml_util.dump(payload) }
+	response = request('POST', url, files=files)
 	check_response(response)
 	return response
 
@@ -208,17 +336,14 @@ class ProgressBar:
 			self.last_update = monitor.bytes_read
 
 def upload(url, filename, check=True):
-	creds = get_credentials()
-	url = creds.get('opsmgr').get('url') + url
+	from requests_toolbelt import MultipartEncoderMonitor
 	multipart = MultipartEncoderMonitor.from_fields(
 		fields={
 			'product[file]': ('product[file]', open(filename, 'rb'), 'application/octet-stream')
 		},
 		callback=ProgressBar().update
 	)
-	response = requests.post(url,
-		auth=auth(creds),
-		verify=False,
+	response = request('POST', url,
 		data=multipart,
 		headers={ 'Content-Type': multipart.content_type }
 	)
@@ -238,9 +363,7 @@ def upload(url, filename, check=True):
 	return response
 
 def delete(url, check=True):
-	creds = get_credentials()
-	url = creds.get('opsmgr').get('url') + url
-	response = requests.delete(url, auth=auth(creds), verify=False)
+	response = request('DELETE', url)
 	check_response(response, check=check)
 	return response
 
@@ -256,6 +379,7 @@ def check_response(response, check=True):
 		raise Exception(message)
 
 def ssh(command=None, login_to_bosh=True, quiet=False):
+	from pexpect import pxssh
 	def print_if(message):
 		if not quiet: print(message)
 
@@ -588,23 +712,84 @@ def get_cfinfo():
 		'system_services_password': system_services_credentials.get('password', None)
 	}
 
-def logs(install_id):
+class LogFollower:
+	"""Tails the log of an installation while it runs.
+
+	Ops Manager only serves the log as a whole, wrapped in JSON, so the
+	follower remembers how much of it has been consumed and only splits
+	and prints what was appended since. Polling starts at `min_interval`
+	and backs off towards `max_interval` while the log is idle, dropping
+	back as soon as new output appears. If `output` is given the log is
+	also written to that file as it arrives (gzipped if it ends in .gz).
+	"""
+
+	def __init__(self, install_id, min_interval=1, max_interval=30, backoff=2, output=None):
+		self.install_id = install_id
+		self.min_interval = min_interval
+		self.max_interval = max(max_interval, min_interval)
+		self.backoff = backoff
+		self.interval = min_interval
+		self.offset = 0
+		self.partial = ''
+		self.output = output
+
+	def status(self):
+		return get('/api/installation/' + str(self.install_id)).json()['status']
+
+	def fetch(self):
+		return get('/api/installation/' + str(self.install_id) + '/logs').json()['logs']
+
+	def poll(self, final=False):
+		log = self.fetch()
+		if len(log) < self.offset:
+			# The log was truncated or rotated, start over
+			self.offset = 0
+			self.partial = ''
+		appended = log[self.offset:]
+		self.offset = len(log)
+		text = self.partial + appended
+		if final:
+			self.partial = ''
+		else:
+			text, newline, self.partial = text.rpartition('\n')
+			if not newline:
+				text, self.partial = '', text + self.partial
+		self.interval = self.min_interval if appended else min(self.interval * self.backoff, self.max_interval)
+		return appended, text.splitlines()
+
+	def follow(self):
+		logfile = self.open_output()
+		try:
+			running = True
+			while running:
+				install_status = self.status()
+				running = install_status == 'running'
+				appended, lines = self.poll(final=not running)
+				if logfile is not None and appended:
+					logfile.write(appended)
+				for line in lines:
+					if not line.startswith('{'):
+						print(' ', line.encode('utf-8'))
+				if running:
+					time.sleep(self.interval)
+			return install_status
+		finally:
+			if logfile is not None:
+				logfile.close()
+
+	def open_output(self):
+		if self.output is None:
+			return None
+		if self.output.endswith('.gz'):
+			return gzip.open(self.output, 'wt', encoding='utf-8')
+		return open(self.output, 'w', encoding='utf-8')
+
+def logs(install_id, max_interval=30, output=None):
 	if install_id is None:
 		install_id = last_install()
 		if install_id == 0:
 			raise Exception('No installation has ever been performed')
-	lines_shown = 0
-	running = True
-	while running:
-		install_status = get('/api/installation/' + str(install_id)).json()['status']
-		running = install_status == 'running'
-		log_lines = get('/api/installation/' + str(install_id) + '/logs').json()['logs'].splitlines()
-		for line in log_lines[lines_shown:]:
-			if not line.startswith('{'):
-				print(' ', line.encode('utf-8'))
-		lines_shown = len(log_lines)
-		if running:
-			time.sleep(1)
+	install_status = LogFollower(install_id, max_interval=max_interval, output=output).follow()
 	if not install_status.startswith('succ'):
 		raise Exception('- install finished with status: {}'.format(install_status))
 
@@ -15,6 +15,9 @@
 # limitations under the License.
 
 
+import gzip
+import os
+import tempfile
 import unittest
 import mock
 import json
@@ -92,6 +95,157 @@ class TestCheckResponse(unittest.TestCase):
 
 
 
+creds = {
+	'opsmgr': {
+		'url': 'https://opsmgr.example.com',
+		'username': 'admin',
+		'password': 'secret',
+	}
+}
+
+def token_response(access_token='token', expires_in=43199, status_code=200):
+	body = { 'access_token': access_token, 'token_type': 'bearer', 'expires_in': expires_in }
+	return build_response(bytes(json.dumps(body), encoding='utf-8'), status_code=status_code)
+
+def authorize(authenticator):
+	request = requests.Request('GET', 'https://opsmgr.example.com/api/products').prepare()
+	return authenticator(request).headers['Authorization']
+
+@mock.patch('tile_generator.opsmgr.Client.request')
+class TestTokenCache(unittest.TestCase):
+	def test_single_token_grant_per_session(self, mock_post):
+		mock_post.return_value = token_response()
+		cache = opsmgr.TokenCache()
+		for i in range(1000):
+			self.assertEqual(authorize(opsmgr.auth(creds, cache)), 'bearer token')
+		self.assertEqual(cache.fetch_count, 1)
+		self.assertEqual(mock_post.call_count, 1)
+
+	def test_refreshes_before_expiry(self, mock_post):
+		mock_post.side_effect = [ token_response('first', expires_in=120), token_response('second') ]
+		cache = opsmgr.TokenCache(refresh_margin=60)
+		with mock.patch('tile_generator.opsmgr.time.time', return_value=1000):
+			self.assertEqual(authorize(opsmgr.auth(creds, cache)), 'bearer first')
+		with mock.patch('tile_generator.opsmgr.time.time', return_value=1059):
+			self.assertEqual(authorize(opsmgr.auth(creds, cache)), 'bearer first')
+		with mock.patch('tile_generator.opsmgr.time.time', return_value=1061):
+			self.assertEqual(authorize(opsmgr.auth(creds, cache)), 'bearer second')
+		self.assertEqual(cache.fetch_count, 2)
+
+	def test_keys_on_url_and_username(self, mock_post):
+		mock_post.side_effect = [ token_response('one'), token_response('two') ]
+		other = { 'opsmgr': dict(creds['opsmgr'], username='other') }
+		cache = opsmgr.TokenCache()
+		self.assertEqual(authorize(opsmgr.auth(creds, cache)), 'bearer one')
+		self.assertEqual(authorize(opsmgr.auth(other, cache)), 'bearer two')
+		self.assertEqual(authorize(opsmgr.auth(creds, cache)), 'bearer one')
+		self.assertEqual(cache.fetch_count, 2)
+
+	def test_falls_back_to_basic_auth(self, mock_post):
+		mock_post.return_value = token_response(status_code=401)
+		cache = opsmgr.TokenCache()
+		self.assertTrue(authorize(opsmgr.auth(creds, cache)).startswith('Basic '))
+
+	def test_reauthenticates_once_on_401(self, mock_post):
+		mock_post.side_effect = [ token_response('stale'), token_response('fresh') ]
+		cache = opsmgr.TokenCache()
+		authenticator = opsmgr.auth(creds, cache)
+		request = authenticator(requests.Request('GET', 'https://opsmgr.example.com/api/products').prepare())
+		unauthorized = build_response(b'{}', status_code=401)
+		unauthorized.request = request
+		unauthorized.connection = mock.Mock()
+		unauthorized.connection.send.return_value = build_response(b'{}', status_code=401)
+		response = authenticator.handle_401(unauthorized)
+		self.assertEqual(unauthorized.connection.send.call_count, 1)
+		retry = unauthorized.connection.send.call_args[0][0]
+		self.assertEqual(retry.headers['Authorization'], 'bearer fresh')
+		self.assertEqual(response.status_code, 401)
+		self.assertEqual(cache.fetch_count, 2)
+
+
+class TestClient(unittest.TestCase):
+	def setUp(self):
+		opsmgr.set_credentials(creds)
+
+	def tearDown(self):
+		opsmgr.set_credentials(None)
+		opsmgr.get_client.client = None
+
+	def test_calls_share_one_session(self):
+		client = opsmgr.configure_client(pool_size=4, timeout=30)
+		with mock.patch.object(client.session, 'request', return_value=build_response(b'{}')) as mock_request, \
+				mock.patch('tile_generator.opsmgr.token_cache.get', return_value='bearer token'):
+			opsmgr.get('/api/products')
+			opsmgr.put('/api/v0/unlock', {})
+			opsmgr.delete('/api/products')
+		self.assertIs(opsmgr.get_client(), client)
+		self.assertEqual([c[0][0] for c in mock_request.call_args_list], ['GET', 'PUT', 'DELETE'])
+		self.assertEqual(mock_request.call_args_list[0][0][1], 'https://opsmgr.example.com/api/products')
+		self.assertEqual(mock_request.call_args_list[0][1]['timeout'], 30)
+
+	def test_pool_size_is_applied(self):
+		client = opsmgr.configure_client(pool_size=4)
+		adapter = client.session.get_adapter('https://opsmgr.example.com')
+		self.assertEqual(adapter._pool_maxsize, 4)
+		self.assertFalse(client.session.verify)
+
+	def test_records_latency_per_method(self):
+		client = opsmgr.Client()
+		with mock.patch.object(client.session, 'request', return_value=build_response(b'{}')):
+			client.request('GET', 'https://opsmgr.example.com/api/products')
+			client.request('GET', 'https://opsmgr.example.com/api/products')
+			client.request('POST', 'https://opsmgr.example.com/api/products')
+		self.assertEqual(client.latency['GET']['count'], 2)
+		self.assertEqual(client.latency['POST']['count'], 1)
+		self.assertIn('GET 2 requests', client.report())
+
+
+class TestLogFollower(unittest.TestCase):
+	def follower(self, logs, statuses, **kw):
+		follower = opsmgr.LogFollower(1, **kw)
+		follower.fetch = mock.Mock(side_effect=logs)
+		follower.status = mock.Mock(side_effect=statuses)
+		return follower
+
+	def test_only_new_lines_are_returned(self):
+		follower = self.follower(['a\nb\n', 'a\nb\nc\n'], [])
+		self.assertEqual(follower.poll()[1], ['a', 'b'])
+		self.assertEqual(follower.poll()[1], ['c'])
+		self.assertEqual(follower.offset, 6)
+
+	def test_partial_lines_are_held_back(self):
+		follower = self.follower(['a\nb', 'a\nbc\nd', 'a\nbc\nde'], [])
+		self.assertEqual(follower.poll()[1], ['a'])
+		self.assertEqual(follower.poll()[1], ['bc'])
+		self.assertEqual(follower.poll(final=True)[1], ['de'])
+
+	def test_backs_off_while_idle(self):
+		follower = self.follower(['a\n', 'a\n', 'a\n', 'a\n', 'a\nb\n'], [], max_interval=3)
+		intervals = []
+		for i in range(5):
+			follower.poll()
+			intervals.append(follower.interval)
+		self.assertEqual(intervals, [1, 2, 3, 3, 1])
+
+	def test_restarts_when_log_is_truncated(self):
+		follower = self.follower(['a\nb\n', 'c\n'], [])
+		follower.poll()
+		self.assertEqual(follower.poll()[1], ['c'])
+
+	@mock.patch('tile_generator.opsmgr.time.sleep')
+	def test_streams_log_to_compressed_file(self, mock_sleep):
+		tmpdir = tempfile.mkdtemp()
+		output = os.path.join(tmpdir, 'install.log.gz')
+		follower = self.follower(['a\n', 'a\nb'], ['running', 'succeeded'], output=output)
+		with capture_output():
+			self.assertEqual(follower.follow(), 'succeeded')
+		with gzip.open(output, 'rt') as f:
+			self.assertEqual(f.read(), 'a\nb')
+		mock_sleep.assert_called_once_with(1)
+		os.remove(output)
+		os.rmdir(tmpdir)
+
+
 @mock.patch('tile_generator.opsmgr.get')
 class TestGetChanges18(unittest.TestCase):
 	def test_default_install_errands(self, mock_get):
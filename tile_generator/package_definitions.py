@@ -1,7 +1,7 @@
 import copy
 import os
 import sys
-import yaml
+from . import yaml_util
 
 from . import package_flags as flag
 
@@ -17,7 +17,7 @@ def merge_dict(dct, merge_dct):
 # to be reachable by BasePackage
 def _to_yaml(manifest):
     try:
-        return yaml.safe_load(manifest)
+        return yaml_util.load(manifest)
     except:
         print('docker-bosh manifest must be valid yaml')
         sys.exit(1)
@@ -45,7 +45,10 @@ class BasePackage(object):
         files = package.get('files', [])
         path = package.get('path')
         if path is not None:
-            files += [ { 'path': path } ]
+            file = { 'path': path }
+            if package.get('sha256'):
+                file['sha256'] = package['sha256']
+            files += [ file ]
             package['path'] = os.path.basename(path)
         manifest = package.get('manifest', {})
         manifest_path = manifest.get('path', None)
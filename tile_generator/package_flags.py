@@ -328,7 +328,7 @@ class Helm(FlagBase):
                 'dir': 'blobs'
             }]
         if not 'helm_cli' in [p['name'] for p in release['packages']]:
-            latest_helm_tag = helm.get_latest_release_tag()
+            latest_helm_tag = config_obj.resolve_version('helm', helm.get_latest_release_tag)
             release['packages'] += [{
                 'name': 'helm_cli',
                 'files': [{
@@ -339,7 +339,7 @@ class Helm(FlagBase):
                 'dir': 'blobs'
             }]
         if not 'kubectl_cli' in [p['name'] for p in release['packages']]:
-            latest_kubectl_tag = helm.get_latest_kubectl_tag()
+            latest_kubectl_tag = config_obj.resolve_version('kubectl', helm.get_latest_kubectl_tag)
             release['packages'] += [{
                 'name': 'kubectl_cli',
                 'files': [{
@@ -19,11 +19,13 @@ import unittest
 import sys
 import tempfile
 import shutil
+import mock
 
 from contextlib import contextmanager
 from io import StringIO
 
-from .package_flags import get_disk_size_for_chart
+from .package_flags import get_disk_size_for_chart, Helm
+from .config import Config
 
 
 @contextmanager
@@ -108,5 +110,41 @@ class TestGetDiskSpaceForChart(unittest.TestCase):
         size = get_disk_size_for_chart(self.chart_directory, None)
         self.assertEqual(size, 4097)
 
+class TestHelmFlag(unittest.TestCase):
+    def setUp(self):
+        self.chart_directory = tempfile.mkdtemp()
+        with open(os.path.join(self.chart_directory, 'Chart.yaml'), 'w') as f:
+            f.write('name: my-chart\nversion: 1.0.0\n')
+        with open(os.path.join(self.chart_directory, 'values.yaml'), 'w') as f:
+            f.write('image:\n  repository: nginx\n  tag: 1.15\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.chart_directory)
+
+    def apply(self, config):
+        release = { 'name': 'my-tile', 'packages': [], 'jobs': [] }
+        Helm._apply(config, { 'name': 'my-chart', 'path': self.chart_directory }, release)
+        return dict((p['name'], p['files'][0]['path']) for p in release['packages'])
+
+    @mock.patch('tile_generator.helm.get_latest_kubectl_tag', return_value='v1.17.0')
+    @mock.patch('tile_generator.helm.get_latest_release_tag', return_value='v2.16.1')
+    def test_resolves_and_pins_cli_versions(self, mock_helm, mock_kubectl):
+        config = Config(name='my-tile', forms=[])
+        paths = self.apply(config)
+        self.assertIn('helm-v2.16.1-linux-amd64', paths['helm_cli'])
+        self.assertIn('/v1.17.0/', paths['kubectl_cli'])
+        self.assertEqual(config['version_lock'], { 'helm': 'v2.16.1', 'kubectl': 'v1.17.0' })
+
+    @mock.patch('tile_generator.helm.get_latest_kubectl_tag')
+    @mock.patch('tile_generator.helm.get_latest_release_tag')
+    def test_offline_replays_pinned_versions(self, mock_helm, mock_kubectl):
+        config = Config(name='my-tile', forms=[], version_lock={ 'helm': 'v2.9.0', 'kubectl': 'v1.10.0' })
+        config.set_offline()
+        paths = self.apply(config)
+        self.assertIn('helm-v2.9.0-linux-amd64', paths['helm_cli'])
+        self.assertIn('/v1.10.0/', paths['kubectl_cli'])
+        mock_helm.assert_not_called()
+        mock_kubectl.assert_not_called()
+
 if __name__ == '__main__':
 	unittest.main()
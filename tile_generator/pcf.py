@@ -19,7 +19,6 @@
 
 import os
 import sys
-import yaml
 import json
 import time
 import click
@@ -27,16 +26,26 @@ import subprocess
 
 PATH = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(os.path.join(PATH, os.path.join('..', 'lib')))
-from . import opsmgr
-from . import erb
+from . import lazy
 from .version import version_string
 
+opsmgr = lazy.module('.opsmgr', __package__)
+erb = lazy.module('.erb', __package__)
+yaml_util = lazy.module('.yaml_util', __package__)
+
 
 @click.group()
 @click.version_option(version_string, '-v', '--version', message='%(prog)s version %(version)s')
 @click.option('-t', '--target')
 @click.option('-n', '--non-interactive', is_flag=True)
-def cli(target, non_interactive):
+@click.option('--timeout', type=float, default=None, help='Timeout in seconds for each Ops Manager request')
+@click.option('--pool-size', type=int, default=10, help='Maximum number of pooled connections to Ops Manager')
+@click.option('--http-stats', is_flag=True, help='Report time spent in Ops Manager requests on exit')
+@click.pass_context
+def cli(ctx, target, non_interactive, timeout, pool_size, http_stats):
+	client = opsmgr.configure_client(pool_size=pool_size, timeout=timeout)
+	if http_stats:
+		ctx.call_on_close(lambda: click.echo(client.report(), err=True))
 	opsmgr.get_credentials(target, non_interactive)
 
 
@@ -110,7 +119,7 @@ def configure_cmd(product, properties_file, strict=False, skip_validation=False,
 	properties = {}
 	if properties_file is not None:
 		with open(properties_file) as f:
-			properties = yaml.safe_load(f)
+			properties = yaml_util.load(f)
 	opsmgr.configure(product, properties, strict, skip_validation, network)
 
 
@@ -264,7 +273,9 @@ def cleanup_cmd(product):
 @click.option('--product', help='product to select errands from. Only valid in combination with -deploy-errands or --delete-errands.')
 @click.option('--deploy-errands', help='Comma separated list of errands to run after install/update. For example: "deploy-all,configure-broker"')
 @click.option('--delete-errands', help='Comma separated list of errands to run before delete. For example: "pre_delete"')
-def apply_changes_cmd(product, deploy_errands, delete_errands):
+@click.option('--max-interval', type=float, default=30, help='Longest wait in seconds between log polls while the log is idle')
+@click.option('--log-file', default=None, help='Also write the installation log to this file (gzipped if it ends in .gz)')
+def apply_changes_cmd(product, deploy_errands, delete_errands, max_interval=30, log_file=None):
 	body = None
 	version = opsmgr.get_version()
 	pre_1_10 = version[0] == 1 and version[1] < 10
@@ -311,7 +322,7 @@ def apply_changes_cmd(product, deploy_errands, delete_errands):
 		install = response.json()['install']
 		install_id = install['id']
 		break
-	opsmgr.logs(install_id)
+	opsmgr.logs(install_id, max_interval=max_interval, output=log_file)
 
 
 def serialize_errands(product, type, form_key):
@@ -325,8 +336,10 @@ def serialize_errands(product, type, form_key):
 
 @cli.command('logs')
 @click.argument('install_id', required=False)
-def logs_cmd(install_id=None):
-	opsmgr.logs(install_id)
+@click.option('--max-interval', type=float, default=30, help='Longest wait in seconds between log polls while the log is idle')
+@click.option('--log-file', default=None, help='Also write the installation log to this file (gzipped if it ends in .gz)')
+def logs_cmd(install_id=None, max_interval=30, log_file=None):
+	opsmgr.logs(install_id, max_interval=max_interval, output=log_file)
 
 
 @cli.command('test-errand')
@@ -443,7 +456,7 @@ def credentials_cmd():
 		'app_domain': cf['apps_domain'],
 		'sys_domain': cf['system_domain'],
 	}
-	click.echo(yaml.safe_dump(creds, default_flow_style=False, explicit_start=True), nl=False)
+	click.echo(yaml_util.dump(creds, default_flow_style=False, explicit_start=True), nl=False)
 
 
 @cli.command('bosh-env')
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+
+# tile-generator
+#
+# Copyright (c) 2015-Present Pivotal Software, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import collections
+import concurrent.futures
+import glob
+import hashlib
+import io
+import os
+import shutil
+import struct
+import tarfile
+import tempfile
+import time
+import zlib
+from . import yaml_util
+from .cache import hash_file
+
+# Builds a final bosh release tarball directly from a release directory
+# laid out the way `bosh generate-package` / `bosh generate-job` leave it:
+#
+#   packages/<name>/{spec,packaging}   with files resolved in src/, then blobs/
+#   jobs/<name>/{spec,monit,templates/}
+#
+# Fingerprints follow bosh's "v2" scheme, so the versions written to
+# release.MF match those `bosh create-release --final` would choose.
+
+GZIP_BLOCK_SIZE = 1024 * 1024
+GZIP_WINDOW = 32 * 1024
+
+ReleaseFile = collections.namedtuple('ReleaseFile', ['path', 'relative_path', 'exclude_mode'])
+
+def sha1_file(filename):
+	return hash_file(filename, hashlib.sha1)
+
+def file_mode(path):
+	return '100755' if os.stat(path).st_mode & 0o111 else '100644'
+
+def sha256_multidigest(filename):
+	# bosh's multi-digest format, which names the algorithm of sha2 digests
+	return 'sha256:' + hash_file(filename, hashlib.sha256)
+
+def fingerprint(files, additional_chunks=(), sha2=False):
+	# With sha2, bosh digests each file and the fingerprint itself with sha256
+	file_digest = sha256_multidigest if sha2 else sha1_file
+	chunks = ['v2']
+	for f in sorted(files, key=lambda f: f.relative_path):
+		chunk = f.relative_path + ('' if os.path.isdir(f.path) else file_digest(f.path))
+		if not f.exclude_mode:
+			chunk += file_mode(f.path)
+		chunks.append(chunk)
+	chunks.append(','.join(sorted(additional_chunks)))
+	digest = hashlib.sha256 if sha2 else hashlib.sha1
+	return digest(''.join(chunks).encode('utf-8')).hexdigest()
+
+class ParallelGzipFile(io.RawIOBase):
+	"""A write-only gzip stream that deflates blocks on several threads.
+
+	Input is cut into fixed size blocks that are compressed independently,
+	each primed with the last 32K of the block before it, and joined with
+	sync flushes into a single gzip member, the way pigz does. Output is
+	byte-identical for a given level and block size regardless of the
+	number of threads.
+	"""
+
+	def __init__(self, fileobj, jobs=4, level=6, block_size=GZIP_BLOCK_SIZE):
+		self.fileobj = fileobj
+		self.jobs = max(jobs, 1)
+		self.level = level
+		self.block_size = block_size
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+		self.pending = collections.deque()
+		self.buffer = bytearray()
+		self.window = b''
+		self.crc = 0
+		self.size = 0
+		# Header with no name and a zero mtime, so output is reproducible
+		self.fileobj.write(b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff')
+
+	def writable(self):
+		return True
+
+	def write(self, data):
+		data = bytes(data)
+		self.crc = zlib.crc32(data, self.crc)
+		self.size += len(data)
+		self.buffer.extend(data)
+		while len(self.buffer) >= self.block_size:
+			self._submit(bytes(self.buffer[:self.block_size]))
+			del self.buffer[:self.block_size]
+		return len(data)
+
+	def _submit(self, block):
+		self.pending.append(self.executor.submit(self._deflate, block, self.window))
+		self.window = block[-GZIP_WINDOW:]
+		# Bound memory to a couple of blocks in flight per thread
+		while len(self.pending) > 2 * self.jobs:
+			self.fileobj.write(self.pending.popleft().result())
+
+	def _deflate(self, block, window):
+		if window:
+			compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=window)
+		else:
+			compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+		return compressor.compress(block) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+	def close(self):
+		if self.closed:
+			return
+		if self.buffer:
+			self._submit(bytes(self.buffer))
+			self.buffer = bytearray()
+		while self.pending:
+			self.fileobj.write(self.pending.popleft().result())
+		self.executor.shutdown()
+		# An empty final block terminates the deflate stream
+		self.fileobj.write(zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS).flush(zlib.Z_FINISH))
+		self.fileobj.write(struct.pack('<II', self.crc & 0xffffffff, self.size & 0xffffffff))
+		super(ParallelGzipFile, self).close()
+
+class HashingWriter(io.RawIOBase):
+
+	def __init__(self, fileobj, algorithm='sha1'):
+		self.fileobj = fileobj
+		self.digest = hashlib.new(algorithm)
+
+	def writable(self):
+		return True
+
+	def write(self, data):
+		self.digest.update(data)
+		return self.fileobj.write(data)
+
+def open_tgz(fileobj, jobs):
+	gz = ParallelGzipFile(fileobj, jobs)
+	return gz, tarfile.open(fileobj=gz, mode='w|', format=tarfile.GNU_FORMAT)
+
+def add_file(tar, path, arcname, epoch=None):
+	info = tar.gettarinfo(path, arcname)
+	info.uid = info.gid = 0
+	info.uname = info.gname = ''
+	if epoch is not None:
+		# Only whether a file is executable survives a reproducible build
+		info.mtime = epoch
+		info.mode = 0o755 if info.isdir() or info.mode & 0o111 else 0o644
+	if info.isdir():
+		tar.addfile(info)
+	else:
+		with open(path, 'rb') as f:
+			tar.addfile(info, f)
+
+def add_bytes(tar, arcname, data, mode=0o644, epoch=None):
+	info = tarfile.TarInfo(arcname)
+	info.size = len(data)
+	info.mode = mode
+	info.mtime = int(time.time()) if epoch is None else epoch
+	tar.addfile(info, io.BytesIO(data))
+
+class ReleaseBuilder:
+	"""Writes a final release tarball without shelling out to bosh.
+
+	Each package and job is archived once into a temporary .tgz, hashed
+	as it is written, and the outer tarball is then streamed with
+	release.MF first, followed by the job and package archives. With an
+	epoch every archived entry is timestamped with it, so the same
+	release directory always builds the same bytes.
+	"""
+
+	def __init__(self, release_dir, name, version, jobs=4, sha2=False, epoch=None):
+		self.release_dir = release_dir
+		self.name = name
+		self.version = version
+		self.jobs = max(jobs, 1)
+		self.sha2 = sha2
+		self.epoch = epoch
+
+	def read_spec(self, path):
+		with open(path) as f:
+			return yaml_util.load(f) or {}
+
+	def names(self, kind):
+		directory = os.path.join(self.release_dir, kind)
+		if not os.path.isdir(directory):
+			return []
+		return sorted(d for d in os.listdir(directory) if os.path.isdir(os.path.join(directory, d)))
+
+	def resolve_package_files(self, name, spec):
+		files = {}
+		for pattern in spec.get('files', []) or []:
+			matches = []
+			for root in ['src', 'blobs']:
+				base = os.path.join(self.release_dir, root)
+				matches = [m for m in glob.glob(os.path.join(base, pattern)) if os.path.isfile(m)]
+				if matches:
+					break
+			if not matches:
+				raise Exception('Package {} references missing file {}'.format(name, pattern))
+			for match in matches:
+				relative_path = os.path.relpath(match, base)
+				files.setdefault(relative_path, ReleaseFile(match, relative_path, False))
+		return list(files.values())
+
+	def package_files(self, name):
+		package_dir = os.path.join(self.release_dir, 'packages', name)
+		spec = self.read_spec(os.path.join(package_dir, 'spec'))
+		files = self.resolve_package_files(name, spec)
+		for script in ['packaging', 'pre_packaging']:
+			path = os.path.join(package_dir, script)
+			if os.path.isfile(path):
+				files.append(ReleaseFile(path, script, True))
+		return spec, files
+
+	def job_files(self, name):
+		job_dir = os.path.join(self.release_dir, 'jobs', name)
+		spec = self.read_spec(os.path.join(job_dir, 'spec'))
+		# Job files are fingerprinted with their modes, and the spec under
+		# the name it is archived as
+		files = [ReleaseFile(os.path.join(job_dir, 'spec'), 'job.MF', False)]
+		monit = os.path.join(job_dir, 'monit')
+		if os.path.isfile(monit):
+			files.append(ReleaseFile(monit, 'monit', False))
+		for template in sorted((spec.get('templates', {}) or {}).keys()):
+			relative_path = os.path.join('templates', template)
+			path = os.path.join(job_dir, relative_path)
+			if not os.path.isfile(path):
+				raise Exception('Job {} references missing template {}'.format(name, template))
+			files.append(ReleaseFile(path, relative_path, False))
+		return spec, files
+
+	def archive(self, files, staging_dir):
+		archive = tempfile.NamedTemporaryFile(dir=staging_dir, suffix='.tgz', delete=False)
+		with archive:
+			writer = HashingWriter(archive, 'sha256' if self.sha2 else 'sha1')
+			gz, tar = open_tgz(writer, self.jobs)
+			arcnames = sorted((f.relative_path, f.path) for f in files)
+			for arcname, path in arcnames:
+				add_file(tar, path, './' + arcname, self.epoch)
+			tar.close()
+			gz.close()
+		digest = writer.digest.hexdigest()
+		return archive.name, ('sha256:' + digest if self.sha2 else digest)
+
+	def build_package(self, name, staging_dir):
+		spec, files = self.package_files(name)
+		version = fingerprint(files, spec.get('dependencies', []) or [], self.sha2)
+		path, sha1 = self.archive(files, staging_dir)
+		return path, {
+			'name': name,
+			'version': version,
+			'fingerprint': version,
+			'sha1': sha1,
+			'dependencies': sorted(spec.get('dependencies', []) or []),
+		}
+
+	def build_job(self, name, staging_dir):
+		spec, files = self.job_files(name)
+		version = fingerprint(files, sha2=self.sha2)
+		path, sha1 = self.archive(files, staging_dir)
+		return path, {
+			'name': name,
+			'version': version,
+			'fingerprint': version,
+			'sha1': sha1,
+			'packages': spec.get('packages', []) or [],
+		}
+
+	def manifest(self, jobs, packages):
+		return {
+			'name': self.name,
+			'version': self.version,
+			'commit_hash': '00000000',
+			'uncommitted_changes': False,
+			'jobs': jobs,
+			'packages': packages,
+		}
+
+	def build(self, tarball):
+		staging_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.realpath(tarball)))
+		try:
+			packages = [self.build_package(name, staging_dir) for name in self.names('packages')]
+			jobs = [self.build_job(name, staging_dir) for name in self.names('jobs')]
+			manifest = self.manifest([j for p, j in jobs], [p for a, p in packages])
+			staged = tarball + '.partial'
+			with open(staged, 'wb') as f:
+				gz, tar = open_tgz(f, self.jobs)
+				add_bytes(tar, './release.MF', yaml_util.dump(manifest, default_flow_style=False).encode('utf-8'), epoch=self.epoch)
+				for kind, archives in [('jobs', jobs), ('packages', packages)]:
+					for path, entry in archives:
+						add_file(tar, path, './{}/{}.tgz'.format(kind, entry['name']), self.epoch)
+				tar.close()
+				gz.close()
+			os.rename(staged, tarball)
+			return manifest
+		finally:
+			shutil.rmtree(staging_dir)
+
+def build_release(release_dir, name, version, tarball, jobs=4, sha2=False, epoch=None):
+	return ReleaseBuilder(release_dir, name, version, jobs, sha2, epoch).build(tarball)
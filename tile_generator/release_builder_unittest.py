@@ -0,0 +1,304 @@
+# tile-generator
+#
+# Copyright (c) 2015-Present Pivotal Software, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import hashlib
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+import unittest
+import yaml
+from contextlib import contextmanager
+from distutils import spawn
+from io import StringIO
+
+import mock
+from . import bosh
+from . import release_builder
+from .release_builder import ReleaseBuilder, ReleaseFile, ParallelGzipFile
+
+@contextmanager
+def capture_output():
+	new_out, new_err = StringIO(), StringIO()
+	old_out, old_err = sys.stdout, sys.stderr
+	try:
+		sys.stdout, sys.stderr = new_out, new_err
+		yield sys.stdout, sys.stderr
+	finally:
+		sys.stdout, sys.stderr = old_out, old_err
+
+def write(path, content, mode=0o644):
+	if not os.path.isdir(os.path.dirname(path)):
+		os.makedirs(os.path.dirname(path))
+	with open(path, 'w') as f:
+		f.write(content)
+	os.chmod(path, mode)
+	return path
+
+def write_release_dir(release_dir):
+	write(os.path.join(release_dir, 'blobs', 'app', 'app.zip'), 'app contents')
+	write(os.path.join(release_dir, 'packages', 'app', 'spec'), '---\nname: app\n\ndependencies: []\n\nfiles:\n- app/app.zip\n')
+	write(os.path.join(release_dir, 'packages', 'app', 'packaging'), 'set -e\ncp app/app.zip ${BOSH_INSTALL_TARGET}\n')
+	write(os.path.join(release_dir, 'jobs', 'deploy-all', 'spec'), '---\nname: deploy-all\ntemplates:\n  deploy-all.sh.erb: bin/run\npackages:\n- app\nproperties: {}\n')
+	write(os.path.join(release_dir, 'jobs', 'deploy-all', 'monit'), '')
+	write(os.path.join(release_dir, 'jobs', 'deploy-all', 'templates', 'deploy-all.sh.erb'), '#!/bin/sh\necho deploy\n')
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'test_releases')
+SAMPLE_REDIS_RELEASE = os.path.join(os.path.dirname(__file__), '..', 'sample', 'resources', 'redis-13.1.2.tgz')
+
+def read_members(tarball):
+	with tarfile.open(tarball) as tar:
+		return [(m.name, tar.extractfile(m).read() if m.isfile() else None) for m in tar.getmembers()]
+
+class TestFingerprint(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def check_fingerprints(self, release_dir, kind, names=None):
+		# release.MF is the one bosh wrote when it built the release from
+		# these sources, so it holds bosh's own fingerprints for them
+		with open(os.path.join(release_dir, 'release.MF')) as f:
+			manifest = yaml.safe_load(f)
+		builder = ReleaseBuilder(release_dir, manifest['name'], manifest['version'])
+		for entry in manifest[kind]:
+			if names is not None and entry['name'] not in names:
+				continue
+			with self.subTest(release=manifest['name'], name=entry['name']):
+				sha2 = entry['sha1'].startswith('sha256:')
+				if kind == 'jobs':
+					spec, files = builder.job_files(entry['name'])
+					actual = release_builder.fingerprint(files, sha2=sha2)
+				else:
+					spec, files = builder.package_files(entry['name'])
+					actual = release_builder.fingerprint(files, spec.get('dependencies', []), sha2)
+				self.assertEqual(actual, entry['fingerprint'])
+
+	def test_job_fingerprints_match_bosh(self):
+		for release in ['no-op-release', 'redis']:
+			self.check_fingerprints(os.path.join(FIXTURES, release), 'jobs')
+
+	def test_sha2_job_fingerprints_match_bosh(self):
+		self.check_fingerprints(os.path.join(FIXTURES, 'runtime-test-release'), 'jobs')
+
+	@unittest.skipUnless(os.path.isfile(SAMPLE_REDIS_RELEASE), 'requires the sample redis release')
+	def test_package_fingerprints_match_bosh(self):
+		# The package's source is too large to keep with the fixtures, so it
+		# is taken from the release tarball bosh built from it
+		release_dir = os.path.join(self.tmpdir, 'redis')
+		shutil.copytree(os.path.join(FIXTURES, 'redis'), release_dir)
+		with tarfile.open(SAMPLE_REDIS_RELEASE) as release:
+			package = release.extractfile('packages/redis.tgz')
+			with tarfile.open(fileobj=io.BytesIO(package.read())) as tar:
+				tar.extractall(os.path.join(release_dir, 'src'), members=[m for m in tar.getmembers() if m.name.startswith('./redis/')])
+		self.check_fingerprints(release_dir, 'packages')
+
+	def test_depends_on_executable_bit(self):
+		blob = write(os.path.join(self.tmpdir, 'blob'), 'blob')
+		before = release_builder.fingerprint([ReleaseFile(blob, 'blob', False)])
+		os.chmod(blob, 0o755)
+		self.assertNotEqual(release_builder.fingerprint([ReleaseFile(blob, 'blob', False)]), before)
+		self.assertEqual(
+			release_builder.fingerprint([ReleaseFile(blob, 'blob', True)]),
+			release_builder.fingerprint([ReleaseFile(blob, 'blob', True)]))
+
+class TestParallelGzipFile(unittest.TestCase):
+	def compress(self, data, jobs):
+		out = io.BytesIO()
+		gz = ParallelGzipFile(out, jobs=jobs, block_size=64 * 1024)
+		for i in range(0, len(data), 10000):
+			gz.write(data[i:i + 10000])
+		gz.close()
+		return out.getvalue()
+
+	def test_round_trips_through_gzip(self):
+		data = b''.join(hashlib.sha1(str(i).encode()).hexdigest().encode() for i in range(20000))
+		compressed = self.compress(data, 4)
+		self.assertEqual(gzip.decompress(compressed), data)
+		self.assertLess(len(compressed), len(data))
+
+	def test_output_does_not_depend_on_thread_count(self):
+		data = os.urandom(300 * 1024) + b'\0' * 300 * 1024
+		self.assertEqual(self.compress(data, 1), self.compress(data, 8))
+
+	def test_empty_stream(self):
+		self.assertEqual(gzip.decompress(self.compress(b'', 2)), b'')
+
+class TestReleaseBuilder(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.release_dir = os.path.join(self.tmpdir, 'my-release')
+		self.tarball = os.path.join(self.tmpdir, 'my-release-1.0.0.tgz')
+		write_release_dir(self.release_dir)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def test_writes_release_mf_first(self):
+		ReleaseBuilder(self.release_dir, 'my-release', '1.0.0').build(self.tarball)
+		names = [name for name, content in read_members(self.tarball)]
+		self.assertEqual(names, ['./release.MF', './jobs/deploy-all.tgz', './packages/app.tgz'])
+		self.assertEqual(bosh.read_manifest(self.tarball)['version'], '1.0.0')
+
+	def test_manifest_describes_archives(self):
+		manifest = ReleaseBuilder(self.release_dir, 'my-release', '1.0.0').build(self.tarball)
+		members = dict(read_members(self.tarball))
+		self.assertEqual(yaml.safe_load(members['./release.MF']), manifest)
+		package, = manifest['packages']
+		job, = manifest['jobs']
+		self.assertEqual(package['sha1'], hashlib.sha1(members['./packages/app.tgz']).hexdigest())
+		self.assertEqual(job['sha1'], hashlib.sha1(members['./jobs/deploy-all.tgz']).hexdigest())
+		self.assertEqual(package['version'], package['fingerprint'])
+		self.assertEqual(job['packages'], ['app'])
+
+	def test_sha2_digests(self):
+		manifest = ReleaseBuilder(self.release_dir, 'my-release', '1.0.0', sha2=True).build(self.tarball)
+		members = dict(read_members(self.tarball))
+		self.assertEqual(manifest['packages'][0]['sha1'], 'sha256:' + hashlib.sha256(members['./packages/app.tgz']).hexdigest())
+
+	def test_archive_contents(self):
+		ReleaseBuilder(self.release_dir, 'my-release', '1.0.0').build(self.tarball)
+		members = dict(read_members(self.tarball))
+		with tarfile.open(fileobj=io.BytesIO(members['./packages/app.tgz'])) as tar:
+			self.assertEqual(tar.getnames(), ['./app/app.zip', './packaging'])
+		with tarfile.open(fileobj=io.BytesIO(members['./jobs/deploy-all.tgz'])) as tar:
+			self.assertEqual(tar.getnames(), ['./job.MF', './monit', './templates/deploy-all.sh.erb'])
+
+	def test_src_takes_precedence_over_blobs(self):
+		before = ReleaseBuilder(self.release_dir, 'my-release', '1.0.0').build(self.tarball)
+		write(os.path.join(self.release_dir, 'src', 'app', 'app.zip'), 'newer contents')
+		after = ReleaseBuilder(self.release_dir, 'my-release', '1.0.0').build(self.tarball)
+		self.assertNotEqual(before['packages'][0]['fingerprint'], after['packages'][0]['fingerprint'])
+		self.assertEqual(before['jobs'], after['jobs'])
+
+	def test_epoch_makes_builds_reproducible(self):
+		with mock.patch('time.time', return_value=1000000000):
+			ReleaseBuilder(self.release_dir, 'my-release', '1.0.0', epoch=315532800).build(self.tarball)
+		with open(self.tarball, 'rb') as f:
+			before = f.read()
+		for root, dirs, files in os.walk(self.release_dir):
+			for name in files:
+				os.utime(os.path.join(root, name), (2000000000, 2000000000))
+		os.chmod(os.path.join(self.release_dir, 'blobs', 'app', 'app.zip'), 0o600)
+		with mock.patch('time.time', return_value=2000000000):
+			ReleaseBuilder(self.release_dir, 'my-release', '1.0.0', epoch=315532800).build(self.tarball)
+		with open(self.tarball, 'rb') as f:
+			self.assertEqual(f.read(), before)
+		with tarfile.open(self.tarball) as tar:
+			self.assertEqual(set(m.mtime for m in tar.getmembers()), set([315532800]))
+
+	def test_missing_file_fails(self):
+		os.remove(os.path.join(self.release_dir, 'blobs', 'app', 'app.zip'))
+		with self.assertRaises(Exception):
+			ReleaseBuilder(self.release_dir, 'my-release', '1.0.0').build(self.tarball)
+		self.assertFalse(os.path.exists(self.tarball))
+
+@mock.patch('tile_generator.bosh.run_bosh')
+class TestNativeBoshRelease(unittest.TestCase):
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.tmpdir = tempfile.mkdtemp()
+		os.chdir(self.tmpdir)
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.tmpdir)
+
+	def test_builds_without_bosh(self, mock_run_bosh):
+		source = write(os.path.join(self.tmpdir, 'app.zip'), 'app contents')
+		release = {
+			'name': 'my-release',
+			'packages': [{ 'name': 'app', 'files': [{ 'name': 'app.zip', 'path': source }] }],
+			'jobs': [{ 'name': 'deploy-all', 'lifecycle': 'errand', 'package': { 'name': 'app' } }],
+		}
+		context = { 'version': '1.0.0', 'native_release': True, 'packages': [], 'releases': {}, 'all_properties': [] }
+		br = bosh.BoshRelease(release, context)
+		with capture_output():
+			metadata = br.get_metadata()
+		mock_run_bosh.assert_not_called()
+		self.assertEqual(metadata['file'], 'my-release-1.0.0.tgz')
+		self.assertEqual(metadata['version'], '1.0.0')
+
+	def build(self, jobs):
+		source = os.path.join(self.tmpdir, 'app.zip')
+		if not os.path.exists(source):
+			write(source, 'app contents')
+		release = {
+			'name': 'my-release',
+			'packages': [{ 'name': 'app', 'files': [{ 'name': 'app.zip', 'path': source }] }],
+			'jobs': [{ 'name': job, 'lifecycle': 'errand', 'package': { 'name': 'app' } } for job in jobs],
+		}
+		context = { 'version': '1.0.0', 'native_release': True, 'packages': [], 'releases': {}, 'all_properties': [] }
+		br = bosh.BoshRelease(release, context)
+		with capture_output():
+			br.get_metadata()
+		return br
+
+	def test_rebuild_keeps_unchanged_files(self, mock_run_bosh):
+		first = self.build(['deploy-all'])
+		self.assertTrue(all(changed for path, changed in first.rendered))
+		spec = os.path.join('release', 'my-release', 'jobs', 'deploy-all', 'spec')
+		os.utime(spec, (1, 1))
+		second = self.build(['deploy-all'])
+		self.assertEqual([changed for path, changed in second.rendered], [False] * len(first.rendered))
+		self.assertEqual(os.stat(spec).st_mtime, 1)
+		self.assertEqual(os.listdir(os.path.join('release', 'my-release')).count('my-release-1.0.0.tgz'), 1)
+
+	def test_rebuild_drops_removed_jobs(self, mock_run_bosh):
+		self.build(['deploy-all', 'delete-all'])
+		self.build(['deploy-all'])
+		self.assertEqual(os.listdir(os.path.join('release', 'my-release', 'jobs')), ['deploy-all'])
+		manifest = bosh.read_manifest(os.path.join('release', 'my-release', 'my-release-1.0.0.tgz'))
+		self.assertEqual([job['name'] for job in manifest['jobs']], ['deploy-all'])
+
+@unittest.skipUnless(spawn.find_executable('bosh'), 'requires the bosh cli')
+class TestBoshCompatibility(unittest.TestCase):
+	"""Build the same release directory with bosh and natively and compare."""
+
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.release_dir = os.path.join(self.tmpdir, 'my-release')
+		subprocess.check_output(['bosh', 'init-release', '--dir', self.release_dir])
+		write_release_dir(self.release_dir)
+		blob = os.path.join(self.release_dir, 'blobs', 'app', 'app.zip')
+		shutil.move(blob, os.path.join(self.tmpdir, 'app.zip'))
+		subprocess.check_output(['bosh', 'add-blob', os.path.join(self.tmpdir, 'app.zip'), 'app/app.zip', '--dir', self.release_dir])
+		write(os.path.join(self.release_dir, 'config', 'final.yml'), '---\nname: my-release\nblobstore:\n  provider: local\n  options:\n    blobstore_path: ' + os.path.join(self.tmpdir, 'blobstore') + '\n')
+		subprocess.check_output(['git', 'init'], cwd=self.release_dir)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def versions(self, manifest):
+		return dict(
+			[('job/' + j['name'], (j['version'], j['fingerprint'])) for j in manifest['jobs']] +
+			[('package/' + p['name'], (p['version'], p['fingerprint'], p['dependencies'])) for p in manifest['packages']])
+
+	def test_fingerprints_match_bosh(self):
+		bosh_tarball = os.path.join(self.tmpdir, 'bosh.tgz')
+		subprocess.check_output(['bosh', 'create-release', '--force', '--final', '--version', '1.0.0',
+			'--tarball', bosh_tarball, '--dir', self.release_dir])
+		native = ReleaseBuilder(self.release_dir, 'my-release', '1.0.0').build(os.path.join(self.tmpdir, 'native.tgz'))
+		self.assertEqual(self.versions(native), self.versions(bosh.read_manifest(bosh_tarball)))
+
+if __name__ == '__main__':
+	unittest.main()
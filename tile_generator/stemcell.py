@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+
+# tile-generator
+#
+# Copyright (c) 2015-Present Pivotal Software, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+import os
+import requests
+
+# Where the latest stemcell line for each supported os is looked up. The
+# releases normally come from the Pivotal Network API; setting
+# TILE_GENERATOR_STEMCELL_RELEASES to a JSON file that maps product slugs
+# to API responses substitutes that file, for tests and air-gapped CI.
+
+PRODUCTS = {
+	'ubuntu-jammy': 'stemcells-ubuntu-jammy',
+	'ubuntu-xenial': 'stemcells-ubuntu-xenial',
+	'ubuntu-trusty': 'stemcells',
+}
+
+class PivnetSource:
+
+	url = 'https://network.pivotal.io/api/v2/products/{}/releases'
+
+	def location(self, product):
+		return self.url.format(product)
+
+	def releases(self, product):
+		headers = { 'Accept': 'application/json' }
+		response = requests.get(self.location(product), headers=headers)
+		response.raise_for_status()
+		return response.json()['releases']
+
+class FileSource:
+
+	def __init__(self, path):
+		self.path = os.path.realpath(path)
+
+	def location(self, product):
+		return 'file://' + self.path + '#' + product
+
+	def releases(self, product):
+		with open(self.path) as f:
+			return json.load(f)[product]['releases']
+
+def default_source():
+	path = os.environ.get('TILE_GENERATOR_STEMCELL_RELEASES')
+	return FileSource(path) if path else PivnetSource()
+
+def latest_major(releases):
+	versions = [r['version'] for r in releases]
+	return sorted(versions, key=float)[-1].split('.')[0]
+
+def latest_stemcell(stemcell_os, cache, source=None):
+	"""Return the newest stemcell line for stemcell_os, or None if it is not one we know."""
+	product = PRODUCTS.get(stemcell_os)
+	if product is None:
+		return None # TODO - Look for latest on bosh.io for given os
+	source = source or default_source()
+	return cache.resolve(source.location(product), lambda: latest_major(source.releases(product)))
@@ -0,0 +1,50 @@
+# tile-generator
+#
+# Copyright (c) 2015-Present Pivotal Software, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import unittest
+import mock
+from . import stemcell
+from .version_cache import VersionCache
+
+FIXTURE = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_stemcell_releases.json')
+
+class TestStemcell(unittest.TestCase):
+	def test_latest_major(self):
+		self.assertEqual(stemcell.latest_major([{ 'version': '3468.5' }, { 'version': '3586.100' }]), '3586')
+
+	def test_file_source(self):
+		source = stemcell.FileSource(FIXTURE)
+		self.assertEqual(len(source.releases('stemcells-ubuntu-jammy')), 3)
+		self.assertEqual(stemcell.latest_stemcell('ubuntu-trusty', VersionCache(''), source), '3586')
+
+	def test_default_source(self):
+		with mock.patch.dict(os.environ, { 'TILE_GENERATOR_STEMCELL_RELEASES': FIXTURE }):
+			self.assertIsInstance(stemcell.default_source(), stemcell.FileSource)
+		with mock.patch.dict(os.environ):
+			os.environ.pop('TILE_GENERATOR_STEMCELL_RELEASES', None)
+			self.assertIsInstance(stemcell.default_source(), stemcell.PivnetSource)
+
+	def test_sources_are_cached_separately(self):
+		self.assertNotEqual(stemcell.FileSource(FIXTURE).location('stemcells'), stemcell.PivnetSource().location('stemcells'))
+
+	def test_unknown_os(self):
+		source = mock.Mock()
+		self.assertIsNone(stemcell.latest_stemcell('windows2019', VersionCache(''), source))
+		source.releases.assert_not_called()
+
+if __name__ == '__main__':
+	unittest.main()
@@ -21,9 +21,12 @@ import os
 import re
 import sys
 import errno
-import yaml
+import functools
+import hashlib
 
-from jinja2 import Template, Environment, FileSystemLoader, exceptions, pass_context
+from . import yaml_util
+from .cache import user_cache_dir
+from jinja2 import Template, Environment, FileSystemBytecodeCache, FileSystemLoader, exceptions, pass_context
 
 PATH = os.path.dirname(os.path.realpath(__file__))
 TEMPLATE_PATH = os.path.realpath(os.path.join(PATH, 'templates'))
@@ -71,17 +74,11 @@ def expand_selector(input):
 
 
 def render_yaml(input):
-    # Inspired by https://stackoverflow.com/questions/50519454/python-yaml-dump-using-block-style-without-quotes
-    def multiline_representer(dumper, data):
-        return dumper.represent_scalar("tag:yaml.org,2002:str", data, style="|" if "\n" in data else None)
-
-    yaml.SafeDumper.add_representer(str, multiline_representer)
-    yaml.SafeDumper.ignore_aliases = lambda *args: True
-    return yaml.safe_dump(input, default_flow_style=False, width=float("inf"))
+    return yaml_util.dump_block(input, default_flow_style=False, width=float("inf"))
 
 
 def render_yaml_literal(input):
-    return yaml.safe_dump(input, default_flow_style=False, default_style='|', width=float("inf"))
+    return yaml_util.dump(input, default_flow_style=False, default_style='|', width=float("inf"))
 
 
 def render_shell_string(input):
@@ -191,32 +188,82 @@ def render_shell_variable_name(s):
     return re.sub(r'[^a-zA-Z0-9]+', '_', s).upper()
 
 
+@functools.lru_cache(maxsize=256)
+def compile_inline(input):
+    # The same snippets (plan and property templates from tile.yml) are
+    # rendered over and over, so each is only compiled once
+    return Template(input)
+
+
 @pass_context
-def render(context, input):
-    template = Template(input)
-    return template.render(context)
+def render_inline(context, input):
+    return compile_inline(input).render(context)
+
+
+def bytecode_cache_dir():
+    return user_cache_dir('templates', 'TILE_GENERATOR_TEMPLATE_CACHE')
+
+
+def bytecode_cache(directory=None):
+    # Jinja keys cached bytecode on the template name and a checksum of
+    # its source, so an upgrade or an edited template is never served stale
+    directory = bytecode_cache_dir() if directory is None else directory
+    if not directory:
+        return None
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError:
+        return None
+    return FileSystemBytecodeCache(directory)
 
 
-TEMPLATE_ENVIRONMENT = Environment(trim_blocks=True, lstrip_blocks=True, extensions=['jinja2.ext.do'])
-TEMPLATE_ENVIRONMENT.loader = FileSystemLoader(TEMPLATE_PATH)
-TEMPLATE_ENVIRONMENT.filters['hyphens'] = render_hyphens
-TEMPLATE_ENVIRONMENT.filters['expand_selector'] = expand_selector
-TEMPLATE_ENVIRONMENT.filters['yaml'] = render_yaml
-TEMPLATE_ENVIRONMENT.filters['yaml_literal'] = render_yaml_literal
-TEMPLATE_ENVIRONMENT.filters['shell_string'] = render_shell_string
-TEMPLATE_ENVIRONMENT.filters['shell_variable_name'] = render_shell_variable_name
-TEMPLATE_ENVIRONMENT.filters['plans_json'] = render_plans_json
-TEMPLATE_ENVIRONMENT.filters['property'] = render_property
-TEMPLATE_ENVIRONMENT.filters['env_variable'] = render_env_variable
-TEMPLATE_ENVIRONMENT.filters['render'] = render
+def make_environment(bytecode_cache=None):
+    # The bundled templates never change while tile-generator runs, so
+    # there is no need to stat them on every lookup
+    environment = Environment(trim_blocks=True, lstrip_blocks=True, extensions=['jinja2.ext.do'],
+                              auto_reload=False, bytecode_cache=bytecode_cache)
+    environment.loader = FileSystemLoader(TEMPLATE_PATH)
+    environment.filters['hyphens'] = render_hyphens
+    environment.filters['expand_selector'] = expand_selector
+    environment.filters['yaml'] = render_yaml
+    environment.filters['yaml_literal'] = render_yaml_literal
+    environment.filters['shell_string'] = render_shell_string
+    environment.filters['shell_variable_name'] = render_shell_variable_name
+    environment.filters['plans_json'] = render_plans_json
+    environment.filters['property'] = render_property
+    environment.filters['env_variable'] = render_env_variable
+    environment.filters['render'] = render_inline
+    return environment
+
+
+TEMPLATE_ENVIRONMENT = make_environment(bytecode_cache())
+
+
+def render_to_string(template_file, config):
+    return TEMPLATE_ENVIRONMENT.get_template(template_file).render(config)
 
 
 def render(target_path, template_file, config):
+    """Render template_file to target_path and return whether the file changed."""
+    return write_if_changed(target_path, bytes(render_to_string(template_file, config), 'utf-8'))
+
+
+def write_if_changed(target_path, content):
+    # Leave files that already hold this content untouched, so their
+    # modification times only move when they really change
+    try:
+        if os.path.getsize(target_path) == len(content):
+            with open(target_path, 'rb') as target:
+                if hashlib.sha256(target.read()).digest() == hashlib.sha256(content).digest():
+                    return False
+    except (IOError, OSError):
+        pass
     target_dir = os.path.dirname(target_path)
     if target_dir != '':
         mkdir_p(target_dir)
     with open(target_path, 'wb') as target:
-        target.write(bytes(TEMPLATE_ENVIRONMENT.get_template(template_file).render(config), 'utf-8'))
+        target.write(content)
+    return True
 
 
 def exists(template_file):
@@ -15,6 +15,9 @@
 # limitations under the License.
 
 
+import os
+import shutil
+import tempfile
 import unittest
 from . import template
 
@@ -53,3 +56,55 @@ class TestVariableNameFilter(unittest.TestCase):
 	def test_uppercases_letters(self):
 		self.assertEqual(template.render_shell_variable_name('foo'), 'FOO')
 		self.assertEqual(template.render_shell_variable_name('Foo'), 'FOO')
+
+class TestInlineRender(unittest.TestCase):
+	def test_render_filter_compiles_each_snippet_once(self):
+		template.compile_inline.cache_clear()
+		environment = template.make_environment()
+		page = environment.from_string('{% for p in plans %}{{ snippet | render }},{% endfor %}')
+		output = page.render(plans=range(3), snippet='{{ name }}-plan', name='my')
+		self.assertEqual(output, 'my-plan,my-plan,my-plan,')
+		info = template.compile_inline.cache_info()
+		self.assertEqual((info.misses, info.hits), (1, 2))
+
+class TestBytecodeCache(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def test_compiled_templates_are_stored(self):
+		environment = template.make_environment(template.bytecode_cache(self.tmpdir))
+		first = environment.get_template('packages/spec').render(package={ 'name': 'app' }, files=[])
+		self.assertNotEqual(os.listdir(self.tmpdir), [])
+		environment = template.make_environment(template.bytecode_cache(self.tmpdir))
+		self.assertEqual(environment.get_template('packages/spec').render(package={ 'name': 'app' }, files=[]), first)
+
+	def test_empty_directory_disables_the_cache(self):
+		self.assertIsNone(template.bytecode_cache(''))
+
+class TestWriteIfChanged(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.target = os.path.join(self.tmpdir, 'jobs', 'spec')
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def test_reports_changes(self):
+		self.assertTrue(template.write_if_changed(self.target, b'one'))
+		self.assertFalse(template.write_if_changed(self.target, b'one'))
+		self.assertTrue(template.write_if_changed(self.target, b'two'))
+		with open(self.target, 'rb') as f:
+			self.assertEqual(f.read(), b'two')
+
+	def test_unchanged_file_keeps_its_mtime(self):
+		template.write_if_changed(self.target, b'one')
+		os.utime(self.target, (1, 1))
+		template.write_if_changed(self.target, b'one')
+		self.assertEqual(os.stat(self.target).st_mtime, 1)
+
+	def test_render_returns_changed(self):
+		self.assertTrue(template.render(self.target, 'packages/spec', { 'package': { 'name': 'app' }, 'files': [] }))
+		self.assertFalse(template.render(self.target, 'packages/spec', { 'package': { 'name': 'app' }, 'files': [] }))
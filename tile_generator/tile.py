@@ -19,15 +19,17 @@
 
 import click
 import sys
-import yaml
 import os
 import types
-from . import build
-from . import template
-from . import config
-from .config import Config
+from . import lazy
 from.version import version_string
 
+# Loaded on first use, so that `tile --version` and `tile --help` don't
+# pay for jinja2, cerberus, requests and yaml
+build = lazy.module('.build', __package__)
+template = lazy.module('.template', __package__)
+config = lazy.module('.config', __package__)
+
 @click.group()
 @click.version_option(version_string, '-v', '--version', message='%(prog)s version %(version)s')
 def cli():
@@ -54,13 +56,40 @@ def init_cmd(name):
 @click.option('--verbose', is_flag=True)
 @click.option('--sha1', is_flag=True)
 @click.option('--cache', type=str, default=None)
-def build_cmd(version, verbose, sha1, cache):
-	cfg = Config().read()
+@click.option('--cache-max-size', type=str, default=None, help='Evict least recently used cache entries beyond this size (e.g. 20G)')
+@click.option('--jobs', '-j', type=int, default=1, help='Number of bosh releases to build concurrently')
+@click.option('--download-jobs', type=int, default=4, help='Number of files to download concurrently for each package')
+@click.option('--download-segments', type=int, default=1, help='Fetch large files as this many parallel byte ranges when the server allows it')
+@click.option('--compress-images', is_flag=True, help='Gzip docker images as they are exported')
+@click.option('--native-release', is_flag=True, help='Build generated bosh releases without the bosh cli')
+@click.option('--force', is_flag=True, help='Rebuild every release, even if its inputs are unchanged')
+@click.option('--explain', is_flag=True, help='Print why each build step was rerun or skipped')
+@click.option('--reproducible', is_flag=True, help='Build a byte-for-byte reproducible .pivotal, timestamped from SOURCE_DATE_EPOCH or the tile version (needs --native-release)')
+@click.option('--keep-staging', is_flag=True, help='Keep the files added to the .pivotal in the product directory')
+@click.option('--compression-level', type=click.IntRange(0, 9), default=None, help='Deflate level for compressible zip entries (0 stores everything)')
+@click.option('--offline', is_flag=True, help='Use the last known latest versions instead of looking them up')
+def build_cmd(version, verbose, sha1, cache, cache_max_size, jobs, download_jobs, download_segments, compress_images, native_release, force, explain, reproducible, keep_staging, compression_level, offline):
+	cfg = config.Config()
+	cfg.set_offline(offline)
+	cfg.read()
 
+	prior_version = cfg.get('history', {}).get('version')
 	cfg.set_version(version)
+	if explain and version is None and prior_version is not None:
+		print('version bumped from', prior_version, 'to', cfg['version'] + ', so every generated release is rebuilt;',
+			'use "tile build ' + prior_version + '" to rebuild', prior_version, 'in place')
 	cfg.set_verbose(verbose)
 	cfg.set_sha1(sha1)
-	cfg.set_cache(cache)
+	cfg.set_cache(cache, cache_max_size)
+	cfg.set_build_jobs(jobs)
+	cfg.set_download_jobs(download_jobs, download_segments)
+	cfg.set_compress_images(compress_images)
+	cfg.set_native_release(native_release)
+	cfg.set_force(force)
+	cfg.set_explain(explain)
+	cfg.set_reproducible(reproducible)
+	cfg.set_keep_staging(keep_staging)
+	cfg.set_compression_level(compression_level)
 	print('name:', cfg.get('name', '<unspecified>'))
 	print('label:', cfg.get('label', '<unspecified>'))
 	print('description:', cfg.get('description', '<unspecified>'))
@@ -71,13 +100,19 @@ def build_cmd(version, verbose, sha1, cache):
 	print()
 	build.build(cfg)
 	cfg.save_history()
+	cfg.save_lock()
 
 @cli.command('expand')
 @click.argument('version', required=False)
 def expand_cmd(version):
-	cfg = Config().read()
+	# Expanding only reports the configuration, so never go to the network,
+	# and report versions that are not known offline as unresolved
+	cfg = config.Config()
+	cfg.set_offline()
+	cfg.set_unresolved_ok()
+	cfg.read()
 	cfg.set_version(version)
-	config.write_yaml(sys.stdout, dict(cfg))
+	config.write_yaml(sys.stdout.buffer, dict(cfg))
 
 def main():
   try:
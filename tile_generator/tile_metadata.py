@@ -1,13 +1,7 @@
-import yaml
 import copy
 from . import template as template_helper
-
-
-# Inspired by: https://stackoverflow.com/questions/6432605/any-yaml-libraries-in-python-that-support-dumping-of-long-strings-as-block-liter
-class literal_unicode(str): pass
-def literal_unicode_representer(dumper, data):
-    return dumper.represent_scalar('tag:yaml.org,2002:str', data, style='|')
-yaml.SafeDumper.add_representer(literal_unicode, literal_unicode_representer)
+from . import yaml_util
+from .yaml_util import literal_unicode
 
 
 class TileMetadata(object):
@@ -570,10 +564,10 @@ class TileMetadata(object):
                         }
                         if template.get('consumes'):
                             if type(template.get('consumes')) is not dict:
-                                template['consumes'] = yaml.load(template['consumes'], yaml.Loader)
-                            temp['consumes'] = literal_unicode(yaml.dump(template.get('consumes'), default_flow_style=False))
+                                template['consumes'] = yaml_util.load(template['consumes'])
+                            temp['consumes'] = literal_unicode(yaml_util.dump(template.get('consumes'), default_flow_style=False))
                         if template.get('provides'):
-                            temp['provides'] = literal_unicode(yaml.dump(template.get('provides'), default_flow_style=False))
+                            temp['provides'] = literal_unicode(yaml_util.dump(template.get('provides'), default_flow_style=False))
                         bosh_release_job['templates'].append(temp)
 
                     bosh_release_job['resource_definitions'] = [{
@@ -683,7 +677,7 @@ class TileMetadata(object):
                     if job.get('run_pre_delete_errand_default'):
                         job_type['run_pre_delete_errand_default'] = job.get('run_pre_delete_errand_default')
                     if release.get('consumes_for_deployment'):
-                        job_type['templates'][0]["consumes"] = literal_unicode(yaml.dump(release.get('consumes_for_deployment'), default_flow_style=False))
+                        job_type['templates'][0]["consumes"] = literal_unicode(yaml_util.dump(release.get('consumes_for_deployment'), default_flow_style=False))
 
                     instance_def = {
                     'configurable': False,
@@ -739,5 +733,5 @@ class TileMetadata(object):
         # TODO: this should be making a copy not clobbering the original.
         for runtime_conf in self.config.get('runtime_configs', {}):
             if runtime_conf.get('runtime_config'):
-                runtime_conf['runtime_config'] = yaml.dump(runtime_conf['runtime_config'], default_flow_style=False)
+                runtime_conf['runtime_config'] = yaml_util.dump(runtime_conf['runtime_config'], default_flow_style=False)
         self.tile_metadata['runtime_configs'] = self.config.get('runtime_configs')
@@ -17,14 +17,24 @@
 # limitations under the License.
 
 
+import collections
+import concurrent.futures
+import contextvars
 import errno
+import gzip
+import hashlib
+import io
 import os
 import os.path
 import requests
 import shutil
 import sys
 import re
+import time
 import zipfile
+import zlib
+from .cache import DownloadCache, sha256_file
+from .version_cache import VersionCache
 try:
 	# Python 3
 	from urllib.request import urlretrieve
@@ -42,60 +52,363 @@ def mkdir_p(dir, clobber=False):
 		if e.errno != errno.EEXIST:
 			raise
 
-def download(url, filename, cache=None):
-	if cache is not None:
-		basename = os.path.basename(filename)
-		cachename = os.path.join(cache, basename)
-		if os.path.isfile(cachename):
-			print('- using cached version of', basename)
-			shutil.copy(cachename, filename)
-			return
-	# Special url to find a file associated with a github release.
-	# github://cf-platform-eng/meta-buildpack/meta-buildpack.tgz
-	# will find the file named meta-buildpack-0.0.3.tgz in the latest
-	# release for https://github.com/cf-platform-eng/meta-buildpack
-	if url.startswith("github:"):
-		repo_name = url.replace('github:', '', 1).lstrip("/")
-		file_name = os.path.basename(repo_name)
-		repo_name = os.path.dirname(repo_name)
-		url = "https://api.github.com/repos/" + repo_name + "/releases/latest"
-		headers = {}
-		if os.getenv('GITHUB_API_TOKEN'):
-			headers['Authorization'] = 'token ' + os.environ['GITHUB_API_TOKEN']
-		response = requests.get(url, headers=headers, stream=True)
+DOWNLOAD_POOL_SIZE = 16
+
+def http_session():
+	# A single session shared by all downloads (and download threads),
+	# so requests to the same host reuse pooled connections.
+	if http_session.session is None:
+		session = requests.Session()
+		adapter = requests.adapters.HTTPAdapter(
+			pool_connections=DOWNLOAD_POOL_SIZE,
+			pool_maxsize=DOWNLOAD_POOL_SIZE)
+		session.mount('https://', adapter)
+		session.mount('http://', adapter)
+		http_session.session = session
+	return http_session.session
+
+http_session.session = None
+
+def submit_in_context(executor, fn, *args, **kwargs):
+	"""Submit fn to run in a copy of the caller's context.
+
+	Worker threads start with an empty context, so without this anything
+	the caller set there, such as where its output is buffered during a
+	parallel build, would not follow the work to the pool.
+	"""
+	return executor.submit(contextvars.copy_context().run, fn, *args, **kwargs)
+
+def download_all(downloads, cache=None, jobs=4, **options):
+	"""Download each (url, filename, sha256) tuple using up to `jobs` threads.
+
+	Returns once every file has landed, re-raising the first failure.
+	Any other options are passed on to download().
+	"""
+	if jobs <= 1 or len(downloads) <= 1:
+		for url, filename, sha256 in downloads:
+			download(url, filename, cache, sha256, **options)
+		return
+	with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+		futures = [submit_in_context(executor, download, url, filename, cache, sha256, **options) for url, filename, sha256 in downloads]
+		for future in concurrent.futures.as_completed(futures):
+			if future.exception() is not None:
+				for f in futures:
+					f.cancel()
+				raise future.exception()
+
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 5
+DOWNLOAD_BACKOFF = 2
+# Files smaller than this are not worth splitting into segments
+MIN_SEGMENT_SIZE = 8 * 1024 * 1024
+
+RETRYABLE_ERRORS = (
+	requests.exceptions.ConnectionError,
+	requests.exceptions.ChunkedEncodingError,
+	requests.exceptions.Timeout,
+)
+
+def with_retries(fetch, retries=DOWNLOAD_RETRIES, backoff=DOWNLOAD_BACKOFF):
+	attempt = 0
+	while True:
+		try:
+			return fetch()
+		except RETRYABLE_ERRORS + (requests.exceptions.HTTPError,) as e:
+			response = getattr(e, 'response', None)
+			if response is not None and response.status_code < 500:
+				raise
+			attempt += 1
+			if attempt > retries:
+				raise
+			wait_to_retry(attempt, backoff, e)
+
+def wait_to_retry(attempt, backoff, error):
+	delay = backoff * 2 ** (attempt - 1)
+	print('- retrying download in', delay, 'seconds after:', error, file=sys.stderr)
+	time.sleep(delay)
+
+def stream_download(url, chunk_size=DOWNLOAD_CHUNK_SIZE, retries=DOWNLOAD_RETRIES, backoff=DOWNLOAD_BACKOFF):
+	"""Open url and return its Content-Length (or None) and an iterator over its content.
+
+	Failed requests are retried like http_download's. A connection dropped
+	mid-stream is resumed with a range request from the last byte
+	delivered, so nothing already consumed is fetched or delivered twice.
+	That needs an ETag or Last-Modified, to be sure the rest comes from the
+	same content; without one, or if the server doesn't resume, the error
+	is raised.
+	"""
+	def get(headers=None):
+		response = http_session().get(url, headers=headers or {}, stream=True)
 		response.raise_for_status()
-		release = response.json()
-		assets = release.get('assets', [])
-		url = None
+		return response
+	response = with_retries(get, retries, backoff)
+	size = response.headers.get('Content-Length')
+	validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+
+	def chunks(response):
+		offset = 0
+		attempt = 0
+		while True:
+			try:
+				for chunk in response.iter_content(chunk_size=chunk_size):
+					if chunk:
+						offset += len(chunk)
+						yield chunk
+				return
+			except RETRYABLE_ERRORS as e:
+				attempt += 1
+				if attempt > retries or not validator:
+					raise
+				wait_to_retry(attempt, backoff, e)
+			headers = { 'Range': 'bytes={}-'.format(offset), 'If-Range': validator }
+			response = with_retries(lambda: get(headers), retries, backoff)
+			if response.status_code != 206:
+				raise Exception('cannot resume download of ' + url + ', it changed or the server ignores ranges')
+
+	return int(size) if size else None, chunks(response)
+
+def http_download(url, filename, chunk_size=DOWNLOAD_CHUNK_SIZE, retries=DOWNLOAD_RETRIES, segments=1):
+	"""Download url to filename, resuming from where a dropped connection left off.
+
+	Data is written to `filename.partial` and only renamed into place once
+	complete. The ETag or Last-Modified of the response is kept beside it
+	in `filename.partial.validator`, so a later run only resumes the
+	partial file if the url still serves the same content. If `segments`
+	is more than one and the server accepts byte ranges, the file is
+	fetched as that many ranges in parallel into `filename.segments`,
+	which is discarded if any range fails.
+
+	Returns the ETag or Last-Modified of the downloaded content, if any.
+	"""
+	start = time.time()
+	partial = filename + '.partial'
+	size = None
+	if segments > 1:
+		head = http_session().head(url, allow_redirects=True)
+		length = int(head.headers.get('Content-Length', 0))
+		if head.ok and head.headers.get('Accept-Ranges') == 'bytes' and length >= MIN_SEGMENT_SIZE:
+			size = length
+			partial = filename + '.segments'
+			validator = head.headers.get('ETag') or head.headers.get('Last-Modified')
+			try:
+				segmented_download(head.url, partial, size, segments, chunk_size, retries, validator)
+			except BaseException:
+				remove_if_exists(partial)
+				raise
+	if size is None:
+		validator = with_retries(lambda: resume_download(url, partial, chunk_size), retries)
+		size = os.path.getsize(partial)
+		remove_if_exists(partial + '.validator')
+	os.rename(partial, filename)
+	elapsed = max(time.time() - start, 0.001)
+	print('- downloaded {} ({:.1f} MB in {:.1f}s, {:.1f} MB/s)'.format(
+		os.path.basename(filename), size / 1048576.0, elapsed, size / 1048576.0 / elapsed))
+	return validator
+
+def head_validator(url):
+	"""Return the final url url redirects to and the ETag or Last-Modified it serves now.
+
+	The validator is None if the server sends neither or the request fails
+	with an HTTP error; connection errors are raised.
+	"""
+	response = http_session().head(url, allow_redirects=True)
+	if not response.ok:
+		return response.url, None
+	return response.url, response.headers.get('ETag') or response.headers.get('Last-Modified')
+
+def cached_digest(cache, url, sha256=None, offline=False):
+	"""Return the digest of the cached copy of a remote url if it can be used, or None.
+
+	A pinned sha256 always can. Otherwise an http(s) url is only served
+	from the cache while it still serves what was cached, going by its
+	ETag or Last-Modified, and a url without either is downloaded again.
+	Offline, or if the server can't be reached, the last download is
+	used as is. Docker tags can't be checked without docker and are
+	served from the cache until evicted.
+	"""
+	if cache is None:
+		return None
+	if sha256 is not None or offline or url.split(':', 1)[0] not in ['http', 'https']:
+		return cache.lookup(url, sha256)
+	if cache.lookup(url) is None:
+		return None
+	try:
+		final_url, validator = head_validator(url)
+	except requests.exceptions.RequestException as e:
+		print('- could not check', url, 'for changes, using the cached version:', e, file=sys.stderr)
+		return cache.lookup(url)
+	if validator is None:
+		return None
+	return cache.lookup(url, validator=validator)
+
+def remove_if_exists(filename):
+	try:
+		os.remove(filename)
+	except OSError as e:
+		if e.errno != errno.ENOENT:
+			raise
+
+def resume_download(url, partial, chunk_size):
+	validator_file = partial + '.validator'
+	try:
+		with open(validator_file) as f:
+			validator = f.read().strip()
+	except IOError:
+		validator = None
+	offset = os.path.getsize(partial) if os.path.isfile(partial) else 0
+	headers = {}
+	if offset > 0 and validator:
+		# Only resume if the file has not changed since we started it
+		headers['Range'] = 'bytes={}-'.format(offset)
+		headers['If-Range'] = validator
+	response = http_session().get(url, headers=headers, stream=True)
+	if response.status_code == 416 and 'Range' in headers:
+		# The partial file is complete if it is as long as the content
+		if response.headers.get('Content-Range', '').rpartition('/')[2] == str(offset):
+			return validator
+		headers = {}
+		response = http_session().get(url, stream=True)
+	response.raise_for_status()
+	resume = response.status_code == 206 and 'Range' in headers
+	if not resume:
+		remove_if_exists(validator_file)
+	with open(partial, 'ab' if resume else 'wb') as file:
+		validator = response.headers.get('ETag') or response.headers.get('Last-Modified')
+		if not resume and validator:
+			# Without a validator the partial file is never resumed
+			with open(validator_file, 'w') as f:
+				f.write(validator)
+		for chunk in response.iter_content(chunk_size=chunk_size):
+			if chunk:
+				file.write(chunk)
+	return validator
+
+def segmented_download(url, partial, size, segments, chunk_size, retries, validator=None):
+	with open(partial, 'wb') as file:
+		file.truncate(size)
+	segment_size = -(-size // segments)
+	ranges = [(begin, min(begin + segment_size, size) - 1) for begin in range(0, size, segment_size)]
+	fd = os.open(partial, os.O_WRONLY)
+	try:
+		def fetch_segment(begin, end):
+			position = [begin]
+			def fetch():
+				headers = { 'Range': 'bytes={}-{}'.format(position[0], end) }
+				if validator:
+					# Every range must come from the same version of the file
+					headers['If-Range'] = validator
+				response = http_session().get(url, headers=headers, stream=True)
+				response.raise_for_status()
+				if response.status_code != 206:
+					raise Exception('server ignored range request for ' + url)
+				for chunk in response.iter_content(chunk_size=chunk_size):
+					if chunk:
+						os.pwrite(fd, chunk, position[0])
+						position[0] += len(chunk)
+			if position[0] <= end:
+				with_retries(fetch, retries)
+		with concurrent.futures.ThreadPoolExecutor(max_workers=segments) as executor:
+			for future in [submit_in_context(executor, fetch_segment, begin, end) for begin, end in ranges]:
+				future.result()
+	finally:
+		os.close(fd)
+
+def export_image(docker_cli, docker_image, filename, compress=False, chunk_size=DOWNLOAD_CHUNK_SIZE):
+	"""Stream `docker save` output for an image to filename.
+
+	Only one chunk is held in memory at a time, however large the image.
+	With compress the tar is gzipped on the way to disk, which `docker load`
+	accepts as is. The image is written to `filename.partial` and renamed
+	into place, so a file already at filename is replaced, never
+	overwritten.
+	"""
+	image = docker_cli.get_image(docker_image)
+	if hasattr(image, 'read'):
+		chunks = iter(lambda: image.read(chunk_size), b'')
+	else:
+		chunks = image
+	partial = filename + '.partial'
+	if compress:
+		image_tar = gzip.GzipFile(partial, 'wb', compresslevel=6, mtime=0)
+	else:
+		image_tar = open(partial, 'wb')
+	with image_tar:
+		for chunk in chunks:
+			image_tar.write(chunk)
+	os.rename(partial, filename)
+
+def is_remote(url):
+	return url.split(':', 1)[0] in ['http', 'https', 'github', 'docker']
+
+GITHUB_RELEASE_URL = 'https://api.github.com/repos/{}/releases/latest'
+
+def github_release(response):
+	# Only the asset names and urls are kept, the full release is large
+	release = response.json()
+	return {
+		'tag_name': release.get('tag_name'),
+		'assets': [{ 'name': a['name'], 'browser_download_url': a['browser_download_url'] } for a in release.get('assets', [])],
+	}
+
+def resolve_github_url(url, offline=False):
+	"""Find the download url of the latest release asset a github: url refers to.
+
+	github://cf-platform-eng/meta-buildpack/meta-buildpack.tgz
+	will find the file named meta-buildpack-0.0.3.tgz in the latest
+	release for https://github.com/cf-platform-eng/meta-buildpack
+
+	The resolved url is cached, so until it expires later downloads
+	skip the GitHub API entirely. After that the release is revalidated
+	with its ETag, which costs nothing against the rate limit when the
+	release has not changed.
+	"""
+	repo_name = url.replace('github:', '', 1).lstrip("/")
+	file_name = os.path.basename(repo_name)
+	repo_name = os.path.dirname(repo_name)
+	cache = VersionCache(offline=offline)
+	headers = {}
+	if os.getenv('GITHUB_API_TOKEN'):
+		headers['Authorization'] = 'token ' + os.environ['GITHUB_API_TOKEN']
+	def find_asset():
+		release = cache.resolve_url(GITHUB_RELEASE_URL.format(repo_name), github_release, headers)
 		pattern = re.compile('.*\\.'.join(file_name.rsplit('.', 1))+'\\Z')
-		for asset in assets:
+		for asset in release['assets']:
 			if pattern.match(asset['name']) is not None:
-				url = asset['browser_download_url']
-				break
-		if url is None:
-			print('no matching asset found for repo', repo_name, 'file', file_name, file=sys.stderr)
-			sys.exit(1)
-		# Fallthrough intentional, we now proceed to download the URL we found
+				return asset['browser_download_url']
+		print('no matching asset found for repo', repo_name, 'file', file_name, file=sys.stderr)
+		sys.exit(1)
+	return cache.resolve(url, find_asset)
+
+def download(url, filename, cache=None, sha256=None, segments=1, compress_images=False, offline=False):
+	# Special url to find a file associated with a github release. It is
+	# resolved up front, so the download cache is keyed on the release
+	# asset and a new release is never mistaken for a cached one.
+	if url.startswith("github:"):
+		url = resolve_github_url(url, offline)
+	source = url
+	if cache is not None and not isinstance(cache, DownloadCache):
+		cache = DownloadCache.open(cache)
+	# Local files are always at hand, only remote sources are worth caching
+	if cache is not None and is_remote(url):
+		digest = cached_digest(cache, url, sha256, offline)
+		if digest is not None and cache.fetch(url, filename, digest):
+			print('- using cached version of', os.path.basename(filename))
+			return
+	else:
+		cache = None
+	validator = None
 	if url.startswith("http:") or url.startswith("https"):
 		# [mboldt:20160908] Using urllib.urlretrieve gave an "Access
 		# Denied" page when trying to download docker boshrelease.
 		# I don't know why. requests.get works. Do what works.
-		response = requests.get(url, stream=True)
-		response.raise_for_status()
-		with open(filename, 'wb') as file:
-			for chunk in response.iter_content(chunk_size=1024):
-				if chunk:
-					file.write(chunk)
+		validator = http_download(url, filename, segments=segments)
 	elif url.startswith("docker:"):
 		docker_image = url.replace('docker:', '', 1)
 		try:
 			from docker.client import Client
 			docker_cli = Client.from_env()
 			docker_cli.pull(docker_image)
-			image = docker_cli.get_image(docker_image)
-			image_tar = open(filename,'wb')
-			image_tar.write(image.data)
-			image_tar.close()
+			export_image(docker_cli, docker_image, filename, compress_images)
 		except KeyError as e:
 			print('docker not configured on this machine (or environment variables are not properly set)', file=sys.stderr)
 			sys.exit(1)
@@ -107,26 +420,253 @@ def download(url, filename, cache=None):
 	elif os.path.isdir(url):
 		shutil.copytree(url, filename)
 	else:
-		shutil.copy(url, filename)
-	if cache:
-		if os.path.isdir(filename):
-			basename = os.path.basename(filename)
-			cachedir = os.path.join(cache, basename)
-			if os.path.exists(cachedir):
-				shutil.rmtree(cachedir)
-			shutil.copytree(filename, os.path.join(cache, basename))
-		elif os.path.isfile(filename):
-			shutil.copy(filename, cache)
+		# Replace rather than overwrite, filename may be linked to a cached object
+		partial = filename + '.partial'
+		shutil.copy(url, partial)
+		os.rename(partial, filename)
+	if sha256 is not None and os.path.isfile(filename):
+		actual = sha256_file(filename)
+		if actual != sha256:
+			print('sha256 mismatch for', source, 'expected', sha256, 'but got', actual, file=sys.stderr)
+			sys.exit(1)
+	if cache is not None:
+		if os.path.isfile(filename):
+			cache.store(source, filename, sha256, validator)
+		else:
+			print(filename, 'is not a file. Cannot cache.', file=sys.stderr)
+
+# Entries with these extensions are already compressed and are stored as is
+COMPRESSED_EXTENSIONS = set([
+	'.7z', '.bz2', '.ear', '.gif', '.gz', '.jar', '.jpeg', '.jpg', '.pivotal', '.png',
+	'.tbz', '.tgz', '.txz', '.war', '.webp', '.whl', '.woff', '.woff2', '.xz', '.zip',
+])
+ZIP_COMPRESSION_LEVEL = 6
+ZIP_CHUNK_SIZE = 8 * 1024 * 1024
+# Larger entries are deflated as they stream in, rather than in memory on a worker
+ZIP_PARALLEL_MAX_SIZE = 64 * 1024 * 1024
+
+# The range of timestamps a zip entry can carry (1980-01-01 to 2107-12-31)
+ZIP_MIN_EPOCH = 315532800
+ZIP_MAX_EPOCH = 4354819199
+
+def is_compressed(name):
+	return os.path.splitext(name)[1].lower() in COMPRESSED_EXTENSIONS
+
+def source_date_epoch(version):
+	"""The fixed time of everything archived by a reproducible build of a tile version."""
+	epoch = os.environ.get('SOURCE_DATE_EPOCH')
+	if epoch:
+		return min(max(int(epoch), ZIP_MIN_EPOCH), ZIP_MAX_EPOCH)
+	# Otherwise derive the time from the version, one minute per patch
+	# release, so it only changes with the version and migrations still
+	# sort in release order.
+	major, minor, patch = ([int(n) for n in re.findall(r'\d+', version)[:3]] + [0, 0, 0])[:3]
+	return min(ZIP_MIN_EPOCH + ((major * 100 + minor) * 1000 + patch) * 60, ZIP_MAX_EPOCH)
+
+def zip_entry_info(arcname, filename=None, epoch=None):
+	if epoch is None and filename is not None:
+		return zipfile.ZipInfo.from_file(filename, arcname)
+	# Entries built from memory, and every entry of a reproducible build,
+	# get the same creator system, and permissions that only keep whether
+	# a file is executable
+	info = zipfile.ZipInfo(arcname, time.gmtime(epoch)[:6] if epoch is not None else time.localtime()[:6])
+	info.create_system = 3
+	mode = 0o644
+	if filename is not None:
+		stat = os.stat(filename)
+		info.file_size = stat.st_size
+		if stat.st_mode & 0o111:
+			mode = 0o755
+	info.external_attr = mode << 16
+	return info
+
+class ZipWriter:
+	"""Adds entries to an open ZipFile, choosing per entry whether to deflate.
+
+	Files that are already compressed are stored; everything else is
+	deflated. Small entries are read and deflated on a pool of worker
+	threads, several at a time, and appended to the archive in the order
+	they were added. The sha256 of every entry's content is collected in
+	digests. With an epoch, every entry is timestamped with it and keeps
+	only whether it is executable, so the archive is reproducible.
+	"""
+
+	def __init__(self, archive, level=None, jobs=4, epoch=None):
+		self.archive = archive
+		self.epoch = epoch
+		self.level = ZIP_COMPRESSION_LEVEL if level is None else level
+		self.jobs = max(jobs, 1)
+		self.predeflate = can_write_deflated(archive)
+		self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.jobs)
+		self.pending = collections.deque()
+		self.digests = collections.OrderedDict()
+
+	def compress_type(self, arcname):
+		if self.level == 0 or is_compressed(arcname):
+			return zipfile.ZIP_STORED
+		return zipfile.ZIP_DEFLATED
+
+	def add_file(self, filename, arcname, info=None):
+		if info is None:
+			info = zip_entry_info(arcname, filename, self.epoch)
+		info.compress_type = self.compress_type(arcname)
+		if info.compress_type == zipfile.ZIP_STORED or info.file_size > ZIP_PARALLEL_MAX_SIZE:
+			self.flush()
+			self.digests[arcname] = self.stream(filename, info)
+		else:
+			self.submit(info, self.read, filename)
+
+	def add_data(self, data, arcname, info=None):
+		if info is None:
+			info = zip_entry_info(arcname, epoch=self.epoch)
+		info.compress_type = self.compress_type(arcname)
+		if info.compress_type == zipfile.ZIP_STORED:
+			self.flush()
+			self.archive.writestr(info, data)
+			self.digests[arcname] = hashlib.sha256(data).hexdigest()
+		else:
+			self.submit(info, lambda: data)
+
+	def add_stream(self, chunks, arcname, size=None, info=None):
+		"""Add an entry from an iterable of byte chunks, such as a download."""
+		if info is None:
+			info = zip_entry_info(arcname, epoch=self.epoch)
+		info.compress_type = self.compress_type(arcname)
+		set_compress_level(info, self.level)
+		if size is not None:
+			info.file_size = size
+		self.flush()
+		digest = hashlib.sha256()
+		with self.archive.open(info, 'w', force_zip64=size is None) as target:
+			for chunk in chunks:
+				digest.update(chunk)
+				target.write(chunk)
+		self.digests[arcname] = digest.hexdigest()
+		return self.digests[arcname]
+
+	def read(self, filename):
+		with open(filename, 'rb') as f:
+			return f.read()
+
+	def stream(self, filename, info):
+		digest = hashlib.sha256()
+		buffer = bytearray(ZIP_CHUNK_SIZE)
+		view = memoryview(buffer)
+		set_compress_level(info, self.level)
+		with open(filename, 'rb', buffering=0) as source, self.archive.open(info, 'w') as target:
+			if hasattr(os, 'posix_fadvise'):
+				os.posix_fadvise(source.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+			while True:
+				size = source.readinto(buffer)
+				if not size:
+					break
+				digest.update(view[:size])
+				target.write(view[:size])
+		return digest.hexdigest()
+
+	def deflate(self, read, *args):
+		data = read(*args)
+		if not self.predeflate:
+			return hashlib.sha256(data).hexdigest(), None, len(data), data
+		compressor = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+		compressed = compressor.compress(data) + compressor.flush()
+		return hashlib.sha256(data).hexdigest(), zlib.crc32(data), len(data), compressed
+
+	def submit(self, info, read, *args):
+		self.pending.append((info, self.executor.submit(self.deflate, read, *args)))
+		# Bound memory to a couple of entries in flight per thread
+		while len(self.pending) > 2 * self.jobs:
+			self.write_next()
+
+	def write_next(self):
+		info, future = self.pending.popleft()
+		digest, crc, size, compressed = future.result()
+		if self.predeflate:
+			write_deflated(self.archive, info, crc, size, compressed)
 		else:
-			print(filename, 'is not a file or directory. Cannot cache.', file=sys.stderr)
-
-def zip_dir(zipfilename, dirname):
-	with zipfile.ZipFile(zipfilename, 'w', allowZip64=True) as packagezip:
-		if os.path.isdir(dirname):
-			for root, dirs, files in os.walk(dirname):
-				for file in files:
-					abspath = os.path.join(root, file)
-					relpath = abspath[len(dirname)+1:] # +1 for trailing slash.
-					packagezip.write(abspath, relpath)
-		elif os.path.isfile(dirname):
-			packagezip.write(dirname, os.path.basename(dirname))
+			self.archive.writestr(info, compressed, zipfile.ZIP_DEFLATED, self.level)
+		self.digests[info.filename] = digest
+
+	def flush(self):
+		while self.pending:
+			self.write_next()
+
+	def close(self):
+		try:
+			self.flush()
+		finally:
+			self.executor.shutdown()
+
+# ZipFile has no public way to append content that is already deflated,
+# so write_deflated() relies on its internals. They are laid out the same
+# in every version in this range; on any other, entries are deflated as
+# they are written instead, which is slower but only uses public API.
+PREDEFLATE_VERSIONS = ((3, 7), (3, 13))
+
+def can_write_deflated(archive):
+	return (sys.implementation.name == 'cpython'
+		and PREDEFLATE_VERSIONS[0] <= sys.version_info[:2] <= PREDEFLATE_VERSIONS[1]
+		and all(hasattr(archive, name) for name in ['_lock', '_seekable', 'start_dir', '_writecheck', '_didModify'])
+		and hasattr(zipfile.ZipInfo, 'FileHeader'))
+
+def set_compress_level(info, level):
+	# ZipInfo.compress_level is public from Python 3.13 on
+	if hasattr(info, 'compress_level'):
+		info.compress_level = level
+	elif hasattr(info, '_compresslevel'):
+		info._compresslevel = level
+
+def write_deflated(archive, info, crc, size, compressed):
+	"""Append an entry whose content was deflated ahead of time.
+
+	This mirrors what ZipFile.open(info, 'w') does for a seekable archive,
+	except the sizes and CRC are known before the header is written. Only
+	call it when can_write_deflated(archive).
+	"""
+	info.compress_type = zipfile.ZIP_DEFLATED
+	info.CRC = crc & 0xffffffff
+	info.file_size = size
+	info.compress_size = len(compressed)
+	zip64 = size > zipfile.ZIP64_LIMIT or len(compressed) > zipfile.ZIP64_LIMIT
+	with archive._lock:
+		if archive._seekable:
+			archive.fp.seek(archive.start_dir)
+		info.header_offset = archive.fp.tell()
+		archive._writecheck(info)
+		archive._didModify = True
+		archive.fp.write(info.FileHeader(zip64))
+		archive.fp.write(compressed)
+		archive.filelist.append(info)
+		archive.NameToInfo[info.filename] = info
+		archive.start_dir = archive.fp.tell()
+
+class HashingFile:
+	"""A write-only file that hashes everything written through it.
+
+	It deliberately can't seek: ZipFile then writes data descriptors
+	instead of going back to patch entry headers, so every byte is
+	written exactly once and the digest of the archive is known as soon
+	as it is closed.
+	"""
+
+	def __init__(self, fileobj, algorithm='sha1'):
+		self.fileobj = fileobj
+		self.digest = hashlib.new(algorithm)
+		self.offset = 0
+
+	def write(self, data):
+		self.digest.update(data)
+		self.offset += len(data)
+		return self.fileobj.write(data)
+
+	def tell(self):
+		return self.offset
+
+	def seek(self, *args):
+		raise io.UnsupportedOperation('seek')
+
+	def flush(self):
+		self.fileobj.flush()
+
+	def hexdigest(self):
+		return self.digest.hexdigest()
@@ -0,0 +1,486 @@
+# tile-generator
+#
+# Copyright (c) 2015-Present Pivotal Software, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gzip
+import hashlib
+import json
+import mock
+import os
+import re
+import requests
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+import zipfile
+from contextlib import contextmanager
+from io import BytesIO, StringIO
+
+from . import util
+from .version_cache import VersionCache
+
+@contextmanager
+def capture_output():
+	new_out, new_err = StringIO(), StringIO()
+	old_out, old_err = sys.stdout, sys.stderr
+	try:
+		sys.stdout, sys.stderr = new_out, new_err
+		yield sys.stdout, sys.stderr
+	finally:
+		sys.stdout, sys.stderr = old_out, old_err
+
+class FakeServer(object):
+	"""Serves `content` like a range-capable HTTP server, optionally
+	dropping the connection after `drop_after` bytes of the first request."""
+
+	def __init__(self, content, drop_after=None, ranges=True, etag='"v1"'):
+		self.content = content
+		self.drop_after = drop_after
+		self.ranges = ranges
+		self.etag = etag
+		self.requests = []
+		self.lock = threading.Lock()
+
+	def response(self, status_code, body, headers={}):
+		response = mock.Mock()
+		response.status_code = status_code
+		response.ok = status_code < 400
+		response.url = 'https://example.com/release.tgz'
+		response.headers = dict(headers)
+		def raise_for_status():
+			if status_code >= 400:
+				raise requests.exceptions.HTTPError(response=response)
+		response.raise_for_status = raise_for_status
+		drop_after = self.drop_after
+		self.drop_after = None
+		def iter_content(chunk_size=1):
+			for i in range(0, len(body), chunk_size):
+				if drop_after is not None and i >= drop_after:
+					raise requests.exceptions.ConnectionError('connection reset')
+				yield body[i:i + chunk_size]
+		response.iter_content = iter_content
+		return response
+
+	def head(self, url, **kw):
+		headers = { 'Content-Length': str(len(self.content)), 'ETag': self.etag }
+		if self.ranges:
+			headers['Accept-Ranges'] = 'bytes'
+		return self.response(200, b'', headers)
+
+	def get(self, url, headers={}, **kw):
+		with self.lock:
+			self.requests.append(headers.get('Range'))
+			match = re.match(r'bytes=(\d+)-(\d*)', headers.get('Range', ''))
+			stale = headers.get('If-Range', self.etag) != self.etag
+			if not self.ranges or match is None or stale:
+				return self.response(200, self.content, { 'ETag': self.etag })
+			begin = int(match.group(1))
+			end = int(match.group(2)) if match.group(2) else len(self.content) - 1
+			if begin >= len(self.content):
+				return self.response(416, b'', { 'Content-Range': 'bytes */{}'.format(len(self.content)) })
+			return self.response(206, self.content[begin:end + 1], { 'ETag': self.etag })
+
+@mock.patch('tile_generator.util.time.sleep')
+class TestHttpDownload(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.filename = os.path.join(self.tmpdir, 'release.tgz')
+		self.content = os.urandom(64 * 1024)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def download(self, server, **kw):
+		with mock.patch('tile_generator.util.http_session', return_value=server):
+			with capture_output() as (out, err):
+				util.http_download('https://example.com/release.tgz', self.filename, chunk_size=4096, **kw)
+		with open(self.filename, 'rb') as f:
+			self.assertEqual(f.read(), self.content)
+		self.assertFalse(os.path.exists(self.filename + '.partial'))
+		self.assertFalse(os.path.exists(self.filename + '.partial.validator'))
+		return out.getvalue()
+
+	def write_partial(self, content, validator=None):
+		with open(self.filename + '.partial', 'wb') as f:
+			f.write(content)
+		if validator is not None:
+			with open(self.filename + '.partial.validator', 'w') as f:
+				f.write(validator)
+
+	def test_resumes_after_dropped_connection(self, mock_sleep):
+		server = FakeServer(self.content, drop_after=40 * 1024)
+		self.download(server)
+		self.assertEqual(server.requests, [None, 'bytes=40960-'])
+		mock_sleep.assert_called_once_with(util.DOWNLOAD_BACKOFF)
+
+	def test_restarts_when_server_ignores_range(self, mock_sleep):
+		server = FakeServer(self.content, drop_after=40 * 1024, ranges=False)
+		self.download(server)
+		self.assertEqual(len(server.requests), 2)
+
+	def test_gives_up_after_retries(self, mock_sleep):
+		server = mock.Mock()
+		server.get.side_effect = requests.exceptions.ConnectionError('down')
+		with mock.patch('tile_generator.util.http_session', return_value=server):
+			with capture_output():
+				with self.assertRaises(requests.exceptions.ConnectionError):
+					util.http_download('https://example.com/release.tgz', self.filename, retries=2)
+		self.assertEqual(server.get.call_count, 3)
+
+	def test_does_not_retry_client_errors(self, mock_sleep):
+		server = FakeServer(self.content)
+		server.get = mock.Mock(return_value=server.response(404, b''))
+		with mock.patch('tile_generator.util.http_session', return_value=server):
+			with self.assertRaises(requests.exceptions.HTTPError):
+				util.http_download('https://example.com/release.tgz', self.filename)
+		self.assertEqual(server.get.call_count, 1)
+
+	def test_segmented_download(self, mock_sleep):
+		server = FakeServer(self.content)
+		with mock.patch('tile_generator.util.MIN_SEGMENT_SIZE', 1024):
+			self.download(server, segments=4)
+		self.assertEqual(sorted(server.requests), ['bytes=0-16383', 'bytes=16384-32767', 'bytes=32768-49151', 'bytes=49152-65535'])
+
+	def test_resumes_partial_left_by_earlier_run(self, mock_sleep):
+		self.write_partial(self.content[:1000], '"v1"')
+		server = FakeServer(self.content)
+		self.download(server)
+		self.assertEqual(server.requests, ['bytes=1000-'])
+
+	def test_restarts_when_partial_is_stale(self, mock_sleep):
+		self.write_partial(b'x' * 1000, '"v0"')
+		server = FakeServer(self.content)
+		self.download(server)
+		self.assertEqual(server.requests, ['bytes=1000-'])
+
+	def test_discards_partial_without_validator(self, mock_sleep):
+		self.write_partial(b'x' * 1000)
+		server = FakeServer(self.content)
+		self.download(server)
+		self.assertEqual(server.requests, [None])
+
+	def test_full_length_partial_must_match_content_length(self, mock_sleep):
+		self.write_partial(b'x' * (len(self.content) + 10), '"v1"')
+		self.download(FakeServer(self.content))
+
+	def test_failed_segmented_download_is_discarded(self, mock_sleep):
+		server = FakeServer(self.content)
+		get = server.get
+		def fail_last_segment(url, headers={}, **kw):
+			if headers.get('Range', '').startswith('bytes=49152-'):
+				server.requests.append(headers['Range'])
+				return server.response(404, b'')
+			return get(url, headers, **kw)
+		server.get = fail_last_segment
+		with mock.patch('tile_generator.util.MIN_SEGMENT_SIZE', 1024):
+			with mock.patch('tile_generator.util.http_session', return_value=server):
+				with self.assertRaises(requests.exceptions.HTTPError):
+					util.http_download('https://example.com/release.tgz', self.filename, chunk_size=4096, segments=4)
+		self.assertEqual([f for f in os.listdir(self.tmpdir)], [])
+		server = FakeServer(self.content)
+		self.download(server)
+		self.assertEqual(server.requests, [None])
+
+	def test_segments_must_come_from_one_version(self, mock_sleep):
+		server = FakeServer(self.content)
+		head = server.head
+		def changed_after_head(url, **kw):
+			response = head(url, **kw)
+			server.etag = '"v2"'
+			return response
+		server.head = changed_after_head
+		with mock.patch('tile_generator.util.MIN_SEGMENT_SIZE', 1024):
+			with mock.patch('tile_generator.util.http_session', return_value=server):
+				with self.assertRaises(Exception):
+					util.http_download('https://example.com/release.tgz', self.filename, chunk_size=4096, segments=4)
+		self.assertEqual(os.listdir(self.tmpdir), [])
+
+	def test_reports_throughput(self, mock_sleep):
+		output = self.download(FakeServer(self.content))
+		self.assertIn('- downloaded release.tgz', output)
+		self.assertIn('MB/s', output)
+
+RELEASE = {
+	'tag_name': 'v0.0.3',
+	'assets': [
+		{ 'name': 'meta-buildpack-0.0.3.tgz', 'browser_download_url': 'https://github.com/o/r/releases/download/v0.0.3/meta-buildpack-0.0.3.tgz' },
+		{ 'name': 'other.zip', 'browser_download_url': 'https://github.com/o/r/releases/download/v0.0.3/other.zip' },
+	],
+}
+
+@mock.patch('tile_generator.util.time.sleep')
+class TestStreamDownload(unittest.TestCase):
+	def setUp(self):
+		self.content = os.urandom(64 * 1024)
+
+	def stream(self, server):
+		with mock.patch('tile_generator.util.http_session', return_value=server):
+			with capture_output():
+				size, chunks = util.stream_download('https://example.com/release.tgz', chunk_size=4096)
+				return b''.join(chunks)
+
+	def test_streams_content(self, mock_sleep):
+		server = FakeServer(self.content)
+		self.assertEqual(self.stream(server), self.content)
+		self.assertEqual(server.requests, [None])
+
+	def test_resumes_after_dropped_connection(self, mock_sleep):
+		server = FakeServer(self.content, drop_after=40 * 1024)
+		self.assertEqual(self.stream(server), self.content)
+		self.assertEqual(server.requests, [None, 'bytes=40960-'])
+
+	def test_changed_content_is_not_spliced(self, mock_sleep):
+		server = FakeServer(self.content, drop_after=40 * 1024)
+		get = server.get
+		def get_then_change(url, headers={}, **kw):
+			response = get(url, headers, **kw)
+			server.etag = '"v2"'
+			return response
+		server.get = get_then_change
+		with self.assertRaises(Exception) as context:
+			self.stream(server)
+		self.assertIn('cannot resume', str(context.exception))
+
+	def test_no_validator_fails_instead_of_resuming(self, mock_sleep):
+		server = FakeServer(self.content, drop_after=40 * 1024, etag=None)
+		with self.assertRaises(requests.exceptions.ConnectionError):
+			self.stream(server)
+		self.assertEqual(server.requests, [None])
+
+def github_response(status_code, release=None, etag='"v3"'):
+	response = requests.Response()
+	response.status_code = status_code
+	response._content = json.dumps(release).encode('utf-8') if release is not None else b''
+	response.headers['ETag'] = etag
+	return response
+
+@mock.patch('requests.get')
+class TestResolveGithubUrl(unittest.TestCase):
+	url = 'github://o/r/meta-buildpack.tgz'
+	api_url = 'https://api.github.com/repos/o/r/releases/latest'
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.environ = mock.patch.dict(os.environ, { 'TILE_GENERATOR_VERSION_CACHE': self.directory })
+		self.environ.start()
+
+	def tearDown(self):
+		self.environ.stop()
+		shutil.rmtree(self.directory)
+
+	def expire(self):
+		cache = VersionCache()
+		for key in [self.url, self.api_url]:
+			entry = cache.get(key)
+			with mock.patch('time.time', return_value=entry['fetched'] - 2 * cache.ttl):
+				cache.put(key, entry['value'], entry.get('etag'))
+
+	def test_resolves_asset(self, mock_get):
+		mock_get.return_value = github_response(200, RELEASE)
+		self.assertEqual(util.resolve_github_url(self.url), RELEASE['assets'][0]['browser_download_url'])
+		self.assertEqual(mock_get.call_args[0][0], self.api_url)
+
+	def test_resolved_url_skips_api(self, mock_get):
+		mock_get.return_value = github_response(200, RELEASE)
+		util.resolve_github_url(self.url)
+		self.assertEqual(util.resolve_github_url(self.url), RELEASE['assets'][0]['browser_download_url'])
+		self.assertEqual(mock_get.call_count, 1)
+
+	def test_files_in_one_repo_share_release(self, mock_get):
+		mock_get.return_value = github_response(200, RELEASE)
+		util.resolve_github_url(self.url)
+		self.assertEqual(util.resolve_github_url('github://o/r/other.zip'), RELEASE['assets'][1]['browser_download_url'])
+		self.assertEqual(mock_get.call_count, 1)
+
+	def test_expired_release_is_revalidated(self, mock_get):
+		mock_get.return_value = github_response(200, RELEASE)
+		util.resolve_github_url(self.url)
+		self.expire()
+		mock_get.return_value = github_response(304)
+		self.assertEqual(util.resolve_github_url(self.url), RELEASE['assets'][0]['browser_download_url'])
+		self.assertEqual(mock_get.call_args[1]['headers']['If-None-Match'], '"v3"')
+
+	def test_offline_uses_recorded_url(self, mock_get):
+		mock_get.return_value = github_response(200, RELEASE)
+		util.resolve_github_url(self.url)
+		self.expire()
+		self.assertEqual(util.resolve_github_url(self.url, offline=True), RELEASE['assets'][0]['browser_download_url'])
+		self.assertEqual(mock_get.call_count, 1)
+
+	def test_sends_token(self, mock_get):
+		mock_get.return_value = github_response(200, RELEASE)
+		with mock.patch.dict(os.environ, { 'GITHUB_API_TOKEN': 'secret' }):
+			util.resolve_github_url(self.url)
+		self.assertEqual(mock_get.call_args[1]['headers']['Authorization'], 'token secret')
+
+	def test_missing_asset(self, mock_get):
+		mock_get.return_value = github_response(200, RELEASE)
+		with self.assertRaises(SystemExit):
+			with capture_output():
+				util.resolve_github_url('github://o/r/missing.tgz')
+
+	def test_concurrent_lookups_are_coalesced(self, mock_get):
+		started = threading.Event()
+		release = threading.Event()
+		def slow_get(url, headers=None):
+			started.set()
+			release.wait(5)
+			return github_response(200, RELEASE)
+		mock_get.side_effect = slow_get
+		results = []
+		threads = [threading.Thread(target=lambda: results.append(util.resolve_github_url(self.url))) for i in range(4)]
+		threads[0].start()
+		started.wait(5)
+		for thread in threads[1:]:
+			thread.start()
+		release.set()
+		for thread in threads:
+			thread.join()
+		self.assertEqual(results, [RELEASE['assets'][0]['browser_download_url']] * 4)
+		self.assertEqual(mock_get.call_count, 1)
+
+	def test_download_caches_resolved_asset(self, mock_get):
+		mock_get.return_value = github_response(200, RELEASE)
+		cache = mock.Mock()
+		cache.fetch.return_value = True
+		with mock.patch('tile_generator.util.DownloadCache', mock.Mock):
+			with mock.patch('tile_generator.util.head_validator', return_value=(None, '"1"')):
+				with capture_output():
+					util.download(self.url, os.path.join(self.directory, 'meta-buildpack.tgz'), cache)
+		cache.lookup.assert_called_with(RELEASE['assets'][0]['browser_download_url'], validator='"1"')
+		cache.fetch.assert_called_once_with(RELEASE['assets'][0]['browser_download_url'], mock.ANY, cache.lookup.return_value)
+
+class TestExportImage(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.filename = os.path.join(self.tmpdir, 'image.tgz')
+		self.content = os.urandom(3 * 1024 * 1024 + 17)
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def docker_cli(self, image):
+		docker_cli = mock.Mock()
+		docker_cli.get_image.return_value = image
+		return docker_cli
+
+	def test_streams_raw_response_in_chunks(self):
+		raw = mock.Mock(wraps=BytesIO(self.content))
+		util.export_image(self.docker_cli(raw), 'busybox', self.filename, chunk_size=1024 * 1024)
+		with open(self.filename, 'rb') as f:
+			self.assertEqual(f.read(), self.content)
+		for call in raw.read.call_args_list:
+			self.assertEqual(call[0], (1024 * 1024,))
+
+	def test_accepts_chunk_generators(self):
+		chunks = [self.content[:10], self.content[10:]]
+		util.export_image(self.docker_cli(iter(chunks)), 'busybox', self.filename)
+		with open(self.filename, 'rb') as f:
+			self.assertEqual(f.read(), self.content)
+
+	def test_compresses_on_the_fly(self):
+		util.export_image(self.docker_cli(BytesIO(self.content)), 'busybox', self.filename, compress=True)
+		with gzip.open(self.filename, 'rb') as f:
+			self.assertEqual(f.read(), self.content)
+
+class TestZipWriter(unittest.TestCase):
+	def setUp(self):
+		self.tmpdir = tempfile.mkdtemp()
+		self.app = os.path.join(self.tmpdir, 'app')
+		os.makedirs(os.path.join(self.app, 'lib'))
+		for i in range(20):
+			with open(os.path.join(self.app, 'lib', 'module%d.js' % i), 'w') as f:
+				f.write('console.log("module %d");\n' % i * 100)
+		with open(os.path.join(self.app, 'vendor.jar'), 'wb') as f:
+			f.write(os.urandom(4096))
+
+	def tearDown(self):
+		shutil.rmtree(self.tmpdir)
+
+	def zip(self, name, **kw):
+		zipfilename = os.path.join(self.tmpdir, name)
+		with zipfile.ZipFile(zipfilename, 'w', allowZip64=True) as archive:
+			writer = util.ZipWriter(archive, **kw)
+			for root, dirs, files in os.walk(self.app):
+				for filename in files:
+					path = os.path.join(root, filename)
+					writer.add_file(path, os.path.relpath(path, self.app))
+			writer.close()
+		return zipfilename
+
+	def test_compresses_text_and_stores_archives(self):
+		with zipfile.ZipFile(self.zip('app.zip')) as z:
+			self.assertIsNone(z.testzip())
+			self.assertEqual(z.getinfo('vendor.jar').compress_type, zipfile.ZIP_STORED)
+			info = z.getinfo('lib/module3.js')
+			self.assertEqual(info.compress_type, zipfile.ZIP_DEFLATED)
+			self.assertLess(info.compress_size, info.file_size)
+			self.assertEqual(z.read('lib/module3.js'), b'console.log("module 3");\n' * 100)
+
+	def test_entries_keep_walk_order(self):
+		expected = []
+		for root, dirs, files in os.walk(self.app):
+			expected += [os.path.relpath(os.path.join(root, f), self.app) for f in files]
+		with zipfile.ZipFile(self.zip('app.zip', jobs=8)) as z:
+			self.assertEqual(z.namelist(), expected)
+
+	def test_thread_count_does_not_change_output(self):
+		with open(self.zip('one.zip', jobs=1), 'rb') as one, open(self.zip('many.zip', jobs=8), 'rb') as many:
+			self.assertEqual(one.read(), many.read())
+
+	def test_epoch_ignores_mtimes_and_modes(self):
+		with open(self.zip('before.zip', epoch=315532800), 'rb') as f:
+			before = f.read()
+		os.utime(os.path.join(self.app, 'vendor.jar'), (2000000000, 2000000000))
+		os.chmod(os.path.join(self.app, 'lib', 'module3.js'), 0o600)
+		with open(self.zip('after.zip', epoch=315532800), 'rb') as f:
+			self.assertEqual(f.read(), before)
+		os.chmod(os.path.join(self.app, 'vendor.jar'), 0o755)
+		with zipfile.ZipFile(self.zip('exec.zip', epoch=315532800)) as z:
+			self.assertEqual(z.getinfo('vendor.jar').external_attr >> 16, 0o755)
+			self.assertEqual(z.getinfo('lib/module3.js').external_attr >> 16, 0o644)
+
+	def test_level_zero_stores_everything(self):
+		with zipfile.ZipFile(self.zip('app.zip', level=0)) as z:
+			self.assertEqual(set(i.compress_type for i in z.infolist()), set([zipfile.ZIP_STORED]))
+
+	def test_fallback_without_zipfile_internals(self):
+		with mock.patch('tile_generator.util.can_write_deflated', return_value=False):
+			with mock.patch('tile_generator.util.write_deflated') as mock_write_deflated:
+				fallback = self.zip('fallback.zip')
+		mock_write_deflated.assert_not_called()
+		with zipfile.ZipFile(fallback) as z, zipfile.ZipFile(self.zip('app.zip')) as expected:
+			self.assertIsNone(z.testzip())
+			self.assertEqual(z.namelist(), expected.namelist())
+			for info in expected.infolist():
+				self.assertEqual(z.getinfo(info.filename).compress_type, info.compress_type)
+				self.assertEqual(z.getinfo(info.filename).compress_size, info.compress_size)
+				self.assertEqual(z.read(info.filename), expected.read(info.filename))
+
+	def test_digests(self):
+		with zipfile.ZipFile(os.path.join(self.tmpdir, 'out.zip'), 'w') as z:
+			writer = util.ZipWriter(z)
+			writer.add_data(b'text', 'a.txt')
+			writer.add_data(b'gzipped', 'b.gz')
+			writer.close()
+		self.assertEqual(list(writer.digests.items()), [
+			('a.txt', hashlib.sha256(b'text').hexdigest()),
+			('b.gz', hashlib.sha256(b'gzipped').hexdigest()),
+		])
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+# tile-generator
+#
+# Copyright (c) 2015-Present Pivotal Software, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import concurrent.futures
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import requests
+from .cache import user_cache_dir
+
+# Caches the answers to "what is the latest version of X" questions, such
+# as the newest stemcell line, so that they are asked of remote APIs at
+# most once per TTL rather than on every `tile build` and `tile expand`.
+#
+#   <cache>/<sha256 of key>.json   { key, value, fetched, etag }
+#
+# In offline mode the last known value is used however old it is, and
+# the network is never touched. Online, a failed lookup falls back to a
+# stale value when there is one.
+
+DEFAULT_TTL = 24 * 60 * 60
+
+class OfflineError(Exception):
+	pass
+
+def cache_dir():
+	return user_cache_dir('versions', 'TILE_GENERATOR_VERSION_CACHE')
+
+class VersionCache:
+
+	_in_flight = {}
+	_in_flight_lock = threading.Lock()
+
+	def __init__(self, directory=None, ttl=DEFAULT_TTL, offline=False):
+		self.directory = cache_dir() if directory is None else directory
+		self.ttl = ttl
+		self.offline = offline
+
+	def path(self, key):
+		return os.path.join(self.directory, hashlib.sha256(key.encode('utf-8')).hexdigest() + '.json')
+
+	def get(self, key):
+		if not self.directory:
+			return None
+		try:
+			with open(self.path(key)) as f:
+				entry = json.load(f)
+		except (IOError, ValueError):
+			return None
+		return entry if entry.get('key') == key else None
+
+	def put(self, key, value, etag=None):
+		entry = { 'key': key, 'value': value, 'fetched': time.time() }
+		if etag:
+			entry['etag'] = etag
+		if not self.directory:
+			return entry
+		try:
+			os.makedirs(self.directory, exist_ok=True)
+			fd, staged = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+			with os.fdopen(fd, 'w') as f:
+				json.dump(entry, f, indent=2, sort_keys=True)
+			os.rename(staged, self.path(key))
+		except OSError:
+			# An unwritable cache only costs us the next lookup
+			pass
+		return entry
+
+	def is_fresh(self, entry):
+		return time.time() - entry.get('fetched', 0) < self.ttl
+
+	def resolve(self, key, fetch):
+		"""Return the cached value for key, calling fetch() when it is missing or expired."""
+		return self._resolve(key, lambda entry: (fetch(), None))
+
+	def resolve_url(self, url, parse, headers=None):
+		"""Return parse(response) for url, cached under the url.
+
+		An expired entry is revalidated with If-None-Match, so an
+		unchanged resource costs a 304 and no parsing.
+		"""
+		def fetch(entry):
+			request_headers = dict(headers or {})
+			if entry is not None and entry.get('etag'):
+				request_headers['If-None-Match'] = entry['etag']
+			response = requests.get(url, headers=request_headers)
+			if response.status_code == requests.codes.not_modified and entry is not None:
+				return entry['value'], entry['etag']
+			response.raise_for_status()
+			return parse(response), response.headers.get('ETag')
+		return self._resolve(url, fetch)
+
+	def _resolve(self, key, fetch):
+		entry = self.get(key)
+		if entry is not None and (self.offline or self.is_fresh(entry)):
+			return entry['value']
+		if self.offline:
+			raise OfflineError('No cached value for {} and running offline'.format(key))
+		# Threads looking up the same key at once share a single request
+		in_flight = (self.directory, key)
+		with VersionCache._in_flight_lock:
+			future = VersionCache._in_flight.get(in_flight)
+			leader = future is None
+			if leader:
+				future = VersionCache._in_flight[in_flight] = concurrent.futures.Future()
+		if not leader:
+			return future.result()
+		try:
+			# Another thread may have refreshed the entry just before us
+			entry = self.get(key)
+			if entry is not None and self.is_fresh(entry):
+				value = entry['value']
+			else:
+				value = self._refresh(key, entry, fetch)
+			future.set_result(value)
+			return value
+		except BaseException as e:
+			future.set_exception(e)
+			raise
+		finally:
+			with VersionCache._in_flight_lock:
+				del VersionCache._in_flight[in_flight]
+
+	def _refresh(self, key, entry, fetch):
+		try:
+			value, etag = fetch(entry)
+		except requests.exceptions.RequestException as e:
+			if entry is None:
+				raise
+			print('Warning: using cached value for {} after failed lookup ({})'.format(key, e), file=sys.stderr)
+			return entry['value']
+		self.put(key, value, etag)
+		return value
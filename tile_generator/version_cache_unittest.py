@@ -0,0 +1,157 @@
+# tile-generator
+#
+# Copyright (c) 2015-Present Pivotal Software, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+import requests
+from .version_cache import VersionCache, OfflineError
+
+class TestVersionCache(unittest.TestCase):
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.fetch = mock.Mock(return_value='2.0')
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def age(self, cache, key, seconds):
+		entry = cache.get(key)
+		with mock.patch('time.time', return_value=entry['fetched'] - seconds):
+			cache.put(key, entry['value'])
+
+	def test_fetches_once_within_ttl(self):
+		cache = VersionCache(self.directory, ttl=60)
+		self.assertEqual(cache.resolve('key', self.fetch), '2.0')
+		self.assertEqual(VersionCache(self.directory, ttl=60).resolve('key', self.fetch), '2.0')
+		self.assertEqual(self.fetch.call_count, 1)
+
+	def test_refetches_when_expired(self):
+		cache = VersionCache(self.directory, ttl=60)
+		cache.resolve('key', self.fetch)
+		self.age(cache, 'key', 120)
+		self.fetch.return_value = '3.0'
+		self.assertEqual(cache.resolve('key', self.fetch), '3.0')
+		self.assertEqual(self.fetch.call_count, 2)
+
+	def test_offline_uses_stale_value(self):
+		VersionCache(self.directory, ttl=60).resolve('key', self.fetch)
+		cache = VersionCache(self.directory, ttl=60, offline=True)
+		self.age(cache, 'key', 120)
+		self.assertEqual(cache.resolve('key', self.fetch), '2.0')
+		self.assertEqual(self.fetch.call_count, 1)
+
+	def test_offline_without_value(self):
+		with self.assertRaises(OfflineError):
+			VersionCache(self.directory, offline=True).resolve('key', self.fetch)
+		self.fetch.assert_not_called()
+
+	def test_failed_lookup_falls_back_to_stale_value(self):
+		cache = VersionCache(self.directory, ttl=60)
+		cache.resolve('key', self.fetch)
+		self.age(cache, 'key', 120)
+		self.fetch.side_effect = requests.exceptions.ConnectionError('unreachable')
+		self.assertEqual(cache.resolve('key', self.fetch), '2.0')
+
+	def test_failed_lookup_without_value(self):
+		self.fetch.side_effect = requests.exceptions.ConnectionError('unreachable')
+		with self.assertRaises(requests.exceptions.ConnectionError):
+			VersionCache(self.directory).resolve('key', self.fetch)
+
+	def test_keys_are_separate(self):
+		cache = VersionCache(self.directory)
+		cache.resolve('a', lambda: '1')
+		cache.resolve('b', lambda: '2')
+		self.assertEqual(cache.get('a')['value'], '1')
+		self.assertEqual(cache.get('b')['value'], '2')
+
+	def test_disabled_cache(self):
+		cache = VersionCache('')
+		self.assertEqual(cache.resolve('key', self.fetch), '2.0')
+		self.assertEqual(cache.resolve('key', self.fetch), '2.0')
+		self.assertEqual(self.fetch.call_count, 2)
+
+	def test_unwritable_cache(self):
+		cache = VersionCache(os.path.join(self.directory, 'file', 'versions'))
+		open(os.path.join(self.directory, 'file'), 'w').close()
+		self.assertEqual(cache.resolve('key', self.fetch), '2.0')
+
+def response(status_code, body='', etag=None):
+	response = requests.Response()
+	response.status_code = status_code
+	response._content = body.encode('utf-8')
+	if etag is not None:
+		response.headers['ETag'] = etag
+	return response
+
+@mock.patch('requests.get')
+class TestConditionalLookup(unittest.TestCase):
+	url = 'https://example.com/latest'
+
+	def setUp(self):
+		self.directory = tempfile.mkdtemp()
+		self.cache = VersionCache(self.directory, ttl=60)
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def parse(self, response):
+		return response.text.strip()
+
+	def expire(self):
+		entry = self.cache.get(self.url)
+		with mock.patch('time.time', return_value=entry['fetched'] - 120):
+			self.cache.put(self.url, entry['value'], entry.get('etag'))
+
+	def test_stores_etag(self, mock_get):
+		mock_get.return_value = response(200, 'v1.0\n', '"abc"')
+		self.assertEqual(self.cache.resolve_url(self.url, self.parse), 'v1.0')
+		self.assertEqual(self.cache.get(self.url)['etag'], '"abc"')
+		self.assertEqual(mock_get.call_args[1]['headers'], {})
+
+	def test_revalidates_expired_entry(self, mock_get):
+		mock_get.return_value = response(200, 'v1.0', '"abc"')
+		self.cache.resolve_url(self.url, self.parse)
+		self.expire()
+		mock_get.return_value = response(304)
+		self.assertEqual(self.cache.resolve_url(self.url, self.parse), 'v1.0')
+		self.assertEqual(mock_get.call_args[1]['headers'], { 'If-None-Match': '"abc"' })
+		self.assertTrue(self.cache.is_fresh(self.cache.get(self.url)))
+		self.assertEqual(self.cache.get(self.url)['etag'], '"abc"')
+
+	def test_replaces_changed_entry(self, mock_get):
+		mock_get.return_value = response(200, 'v1.0', '"abc"')
+		self.cache.resolve_url(self.url, self.parse)
+		self.expire()
+		mock_get.return_value = response(200, 'v2.0', '"def"')
+		self.assertEqual(self.cache.resolve_url(self.url, self.parse), 'v2.0')
+		self.assertEqual(self.cache.get(self.url)['etag'], '"def"')
+
+	def test_fresh_entry_skips_request(self, mock_get):
+		mock_get.return_value = response(200, 'v1.0', '"abc"')
+		self.cache.resolve_url(self.url, self.parse)
+		self.cache.resolve_url(self.url, self.parse)
+		self.assertEqual(mock_get.call_count, 1)
+
+	def test_http_error(self, mock_get):
+		mock_get.return_value = response(403, 'rate limited')
+		with self.assertRaises(requests.exceptions.HTTPError):
+			self.cache.resolve_url(self.url, self.parse)
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+
+# tile-generator
+#
+# Copyright (c) 2015-Present Pivotal Software, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import collections
+import yaml
+
+# All YAML parsing and emitting goes through here, so that it uses the
+# libyaml bindings when PyYAML was built with them and the pure Python
+# implementation otherwise. Both produce the same documents.
+#
+# Representers are registered on our own dumper classes, once, rather
+# than on yaml.SafeDumper, so that one caller's formatting choices never
+# leak into another's output.
+
+try:
+	from yaml import CSafeLoader as SafeLoader, CSafeDumper as BaseDumper
+	LIBYAML = True
+except ImportError:
+	from yaml import SafeLoader, SafeDumper as BaseDumper
+	LIBYAML = False
+
+YAMLError = yaml.YAMLError
+
+# Inspired by: https://stackoverflow.com/questions/6432605/any-yaml-libraries-in-python-that-support-dumping-of-long-strings-as-block-liter
+class literal_unicode(str): pass
+
+def literal_unicode_representer(dumper, data):
+	# libyaml only emits exact str values, not subclasses
+	return dumper.represent_scalar('tag:yaml.org,2002:str', str(data), style='|')
+
+# Inspired by https://stackoverflow.com/questions/50519454/python-yaml-dump-using-block-style-without-quotes
+def multiline_representer(dumper, data):
+	return dumper.represent_scalar('tag:yaml.org,2002:str', data, style='|' if '\n' in data else None)
+
+def ordered_dict_representer(dumper, data):
+	# Written as a plain mapping, keeping its order
+	return dumper.represent_dict(data.items())
+
+class Dumper(BaseDumper):
+	pass
+
+Dumper.add_representer(literal_unicode, literal_unicode_representer)
+Dumper.add_representer(collections.OrderedDict, ordered_dict_representer)
+
+class BlockDumper(Dumper):
+	"""Writes multi-line strings as block literals and never emits aliases."""
+
+	def ignore_aliases(self, data):
+		return True
+
+BlockDumper.add_representer(str, multiline_representer)
+
+def load(stream):
+	return yaml.load(stream, Loader=SafeLoader)
+
+def dump(data, stream=None, Dumper=Dumper, **kwargs):
+	# libyaml takes the line width as a C int, where -1 means unlimited
+	if LIBYAML and kwargs.get('width') == float('inf'):
+		kwargs['width'] = -1
+	return yaml.dump(data, stream, Dumper=Dumper, **kwargs)
+
+def dump_block(data, **kwargs):
+	return dump(data, Dumper=BlockDumper, **kwargs)
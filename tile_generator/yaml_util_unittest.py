@@ -0,0 +1,67 @@
+# tile-generator
+#
+# Copyright (c) 2015-Present Pivotal Software, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import unittest
+import yaml
+from . import yaml_util
+
+DOCUMENT = {
+	'name': 'my-tile',
+	'version': '1.2.3',
+	'script': 'line one\nline two\n',
+	'jobs': [{ 'name': 'job', 'instances': 2, 'enabled': True, 'ratio': 0.5 }],
+	'long': 'word ' * 100,
+}
+
+class TestYamlUtil(unittest.TestCase):
+	def test_round_trip(self):
+		self.assertEqual(yaml_util.load(yaml_util.dump(DOCUMENT)), DOCUMENT)
+
+	def test_load_is_safe(self):
+		with self.assertRaises(yaml_util.YAMLError):
+			yaml_util.load('!!python/object/apply:os.system ["true"]')
+
+	def test_literal_unicode(self):
+		self.assertEqual(yaml_util.dump({ 'a': yaml_util.literal_unicode('x') }), 'a: |-\n  x\n')
+
+	def test_ordered_dict_keeps_its_order(self):
+		data = collections.OrderedDict([('b', 1), ('a', 2)])
+		self.assertEqual(yaml_util.dump(data, default_flow_style=False), 'b: 1\na: 2\n')
+
+	def test_dump_block(self):
+		shared = { 'k': 'v' }
+		result = yaml_util.dump_block({ 'script': 'a\nb\n', 'one': shared, 'two': shared }, default_flow_style=False)
+		self.assertIn('script: |\n  a\n  b\n', result)
+		self.assertNotIn('&', result)
+
+	def test_representers_do_not_leak(self):
+		yaml_util.dump_block({ 'script': 'a\nb\n' })
+		self.assertEqual(yaml.safe_dump({ 'script': 'a\nb\n' }), "script: 'a\n\n  b\n\n  '\n")
+
+	def test_unlimited_width(self):
+		result = yaml_util.dump({ 'long': DOCUMENT['long'] }, width=float('inf'))
+		self.assertEqual(len(result.splitlines()), 1)
+
+	@unittest.skipUnless(yaml_util.LIBYAML, 'PyYAML was built without libyaml')
+	def test_matches_pure_python(self):
+		expected = yaml.dump(DOCUMENT, Dumper=yaml.SafeDumper, default_flow_style=False, width=float('inf'))
+		self.assertEqual(yaml_util.dump(DOCUMENT, default_flow_style=False, width=float('inf')), expected)
+		document = yaml.safe_dump(DOCUMENT)
+		self.assertEqual(yaml_util.load(document), yaml.load(document, Loader=yaml.SafeLoader))
+
+if __name__ == '__main__':
+	unittest.main()